@@ -0,0 +1,73 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+
+import metrics
+from utils import debug
+
+# How often a file is checked for changes, in seconds
+CHECK_INTERVAL = 2
+# Files smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+FILE_READS = metrics.counter(
+    "photoviewer_static_file_reads_total", "Static files read from disk to be served"
+)
+
+
+class Asset(object):
+    """The contents of a static file, with its gzipped form and ETag."""
+
+    __slots__ = ("body", "gzipped", "etag", "content_type", "signature")
+
+    def __init__(self, body, content_type, signature):
+        self.body = body
+        self.content_type = content_type
+        # The size and modification time that the contents were read with
+        self.signature = signature
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        gzipped = gzip.compress(body, 9) if len(body) >= MIN_COMPRESS_SIZE else None
+        # Only keep the compressed form if it's actually smaller.
+        self.gzipped = gzipped if gzipped and len(gzipped) < len(body) else None
+
+
+class AssetCache(object):
+    """Holds static files such as main.html in memory, so that serving them
+    doesn't touch the disk.
+
+    Each file is read and compressed once, and read again if its size or
+    modification time has changed. To keep that check cheap, a file is looked
+    at no more than once every `check_interval` seconds.
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Maps path to (Asset, time it was last checked)
+        self.assets = {}
+
+    def get(self, pth):
+        """Returns the Asset for the file, or None if it can't be read."""
+        now = self.clock()
+        with self.lock:
+            asset, checked = self.assets.get(pth, (None, None))
+            if asset and now - checked < self.check_interval:
+                return asset
+            try:
+                stat = os.stat(pth)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if not asset or asset.signature != signature:
+                    with open(pth, "rb") as ff:
+                        body = ff.read()
+                    FILE_READS.inc()
+                    ctype = mimetypes.guess_type(pth)[0] or "application/octet-stream"
+                    asset = Asset(body, ctype, signature)
+                    debug(f"Loaded static file {pth}")
+            except OSError:
+                self.assets.pop(pth, None)
+                return None
+            self.assets[pth] = (asset, now)
+            return asset
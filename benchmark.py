@@ -0,0 +1,510 @@
+"""Benchmarks for the frame's hot paths, run entirely on this machine: etcd and
+the registration server are replaced by the stand-ins in standins.py, and the
+frame's files are kept in a scratch directory that is used as the home
+directory, so a real installation is never touched.
+
+    python benchmark.py run [--quick | --full] [--only adjust,log,...] [--output FILE]
+    python benchmark.py compare OLD.json NEW.json [--threshold PCT]
+
+`run` writes the results to a JSON file. Every result is a time or a size, so
+lower is better; `compare` lists the results that grew by more than the
+threshold, and exits with status 1 if there are any.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import http.client
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+import urllib.request
+
+# Percentage increase that counts as a regression
+THRESHOLD_PCT = 10
+# Megapixel sizes of the synthetic photos, with their dimensions
+PHOTO_SIZES = {12: (4000, 3000), 24: (6000, 4000), 48: (8000, 6000)}
+# A scan or panorama far larger than a worker could decode at full size
+LARGE_SIZE = (16384, 12208)
+# The requests a long-polling browser makes in a minute: a photo change and a
+# BROWSER_CYCLE timeout on /status, and revalidating the page.
+BROWSER_MINUTE = ("/status", "/status", "/")
+# Renditions made by the adjust benchmark: at the original size, and for a
+# 1080p display in each format
+ADJUST_VARIANTS = {
+    "": None,
+    ".1080p_jpeg": [1920, 1080, "jpeg", 85],
+    ".1080p_webp": [1920, 1080, "webp", 80],
+}
+LOG_LINE = "2024-01-01 12:00:00,000 INFO Showing photo img{num:07d}.jpg\n"
+RARE_TERM = "needle"
+
+PROFILES = {
+    "quick": {
+        "adjust_mp": [12],
+        "log_mb": [10],
+        "rotation_sizes": [1000, 100000],
+        "http_clients": [1, 8],
+        "images": 1000,
+    },
+    "default": {
+        "adjust_mp": [12, 24, 48],
+        "log_mb": [10, 100],
+        "rotation_sizes": [1000, 100000, 1000000],
+        "http_clients": [1, 8, 16],
+        "images": 10000,
+    },
+    "full": {
+        "adjust_mp": [12, 24, 48],
+        "log_mb": [10, 100, 1000],
+        "rotation_sizes": [1000, 100000, 1000000],
+        "http_clients": [1, 8, 16],
+        "images": 100000,
+    },
+}
+
+
+def _median_time(func, repeat=5):
+    times = []
+    for num in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _percentile(vals, pct):
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(len(vals) * pct / 100))]
+
+
+def _free_port():
+    import socket
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_adjust(opts, workdir):
+    """image.adjust() and image.render() on synthetic photos, each in a fresh
+    worker process so that its peak memory can be measured.
+    """
+    from PIL import Image
+
+    import render
+
+    results = {}
+    for megapixels in opts["adjust_mp"]:
+        width, height = PHOTO_SIZES[megapixels]
+        src = os.path.join(workdir, f"photo_{megapixels}mp.jpg")
+        if not os.path.exists(src):
+            gradient = Image.linear_gradient("L").resize((width, height))
+            bands = [gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), gradient]
+            Image.merge("RGB", bands).save(src, "JPEG", quality=90)
+        for variant, output in ADJUST_VARIANTS.items():
+            times = []
+            peak = 0
+            out = os.path.join(workdir, "adjusted")
+            for num in range(3):
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, initializer=render._init_worker, initargs=(0,)
+                ) as pool:
+                    err, seconds, peak_rss = pool.submit(
+                        render._render_one, src, out, [1.1, 1.1, 1.1], "H", output
+                    ).result()
+                if err:
+                    raise RuntimeError(f"adjust failed on {megapixels} MP: {err}")
+                times.append(seconds)
+                peak = max(peak, peak_rss)
+            prefix = f"adjust.{megapixels}mp{variant}"
+            results[f"{prefix}.seconds"] = statistics.median(times)
+            results[f"{prefix}.peak_rss_bytes"] = peak
+            results[f"{prefix}.output_bytes"] = os.path.getsize(out)
+    return results
+
+
+def bench_large(opts, workdir):
+    """A 200 MP image, adjusted and rendered for 1080p in a worker held to the
+    default worker_mb limit. Fails if either can't be done within it; the same
+    check is made on a smaller image by tests/test_render.py.
+    """
+    from PIL import Image
+
+    import render
+
+    src = os.path.join(workdir, "photo_200mp.jpg")
+    if not os.path.exists(src):
+        # Grayscale, so that making it doesn't need 600 MB here.
+        Image.linear_gradient("L").resize(LARGE_SIZE).save(src, "JPEG", quality=90)
+    max_bytes = render.image_budget(render.WORKER_MB)
+    results = {}
+    for variant, output in (("adjust", None), ("1080p_jpeg", ADJUST_VARIANTS[".1080p_jpeg"])):
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, initializer=render._init_worker, initargs=(render.WORKER_MB * render.MB,)
+        ) as pool:
+            err, seconds, peak_rss = pool.submit(
+                render._render_one,
+                src,
+                os.path.join(workdir, "large"),
+                [1.1, 1.1, 1.1],
+                "H",
+                output,
+                max_bytes,
+            ).result()
+        if err:
+            raise RuntimeError(f"{variant} failed on 200 MP within {render.WORKER_MB} MB: {err}")
+        results[f"large.200mp.{variant}.seconds"] = seconds
+        results[f"large.200mp.{variant}.peak_rss_bytes"] = peak_rss
+    return results
+
+
+def _make_log(pth, megabytes):
+    if os.path.exists(pth) and os.path.getsize(pth) >= megabytes * 1024 * 1024:
+        return
+    target = megabytes * 1024 * 1024
+    block = "".join(LOG_LINE.format(num=num) for num in range(1000))
+    with open(pth, "w") as ff:
+        written = 0
+        while written < target:
+            if written and written % (10 * 1024 * 1024) < len(block):
+                # A line the filter will find, about every 10 MB.
+                ff.write(f"2024-01-01 12:00:00,000 ERROR {RARE_TERM} in the haystack\n")
+            ff.write(block)
+            written += len(block)
+
+
+def bench_log(opts, workdir):
+    """utils.read_log() on large logs: the last 1000 lines, and a search for a
+    rare term that has to read much more of the file.
+    """
+    import utils
+
+    results = {}
+    saved = utils.LOG_FILE
+    try:
+        for megabytes in opts["log_mb"]:
+            pth = os.path.join(workdir, f"bench_{megabytes}mb.log")
+            _make_log(pth, megabytes)
+            utils.LOG_FILE = pth
+            results[f"read_log.{megabytes}mb.tail_seconds"] = _median_time(
+                lambda: utils.read_log(1000)
+            )
+            results[f"read_log.{megabytes}mb.filter_seconds"] = _median_time(
+                lambda: utils.read_log(5, RARE_TERM), repeat=3
+            )
+    finally:
+        utils.LOG_FILE = saved
+    return results
+
+
+def bench_rotation(opts, workdir):
+    """Building the rotation and stepping through it, in both selection
+    modes.
+    """
+    import shuffle
+    import standins
+    import stats
+
+    results = {}
+    steps = 10000
+    for size in opts["rotation_sizes"]:
+        names = standins.make_image_names(size)
+        start = time.perf_counter()
+        rotation = shuffle.Rotation(names)
+        rotation.current()
+        results[f"rotation.{size}.setup_seconds"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for num in range(steps):
+            rotation.step()
+        results[f"rotation.{size}.step_seconds"] = (time.perf_counter() - start) / steps
+        results[f"rotation.{size}.upcoming_seconds"] = _median_time(lambda: rotation.upcoming(3))
+
+        stats_dir = tempfile.mkdtemp(dir=workdir)
+        display_stats = stats.DisplayStats(
+            os.path.join(stats_dir, "stats.dat"), os.path.join(stats_dir, "stats.names")
+        )
+        selector = stats.WeightedSelector(rotation, display_stats)
+        start = time.perf_counter()
+        for num in range(steps // 10):
+            display_stats.record_shown(selector.step(), time.time())
+        results[f"rotation.{size}.weighted_step_seconds"] = (time.perf_counter() - start) / (
+            steps // 10
+        )
+        display_stats.close()
+        shutil.rmtree(stats_dir)
+    return results
+
+
+def _load(url, clients, requests_per_client):
+    """Fetches the URL from several clients at once, and returns the
+    latencies.
+    """
+
+    def client():
+        latencies = []
+        for num in range(requests_per_client):
+            start = time.perf_counter()
+            with urllib.request.urlopen(url, timeout=30) as resp:
+                resp.read()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as pool:
+        futures = [pool.submit(client) for num in range(clients)]
+        return [val for future in futures for val in future.result()]
+
+
+def _browser_minutes(mgr, port, minutes):
+    """Makes the requests of a long-polling browser over a kept-alive
+    connection, publishing a photo change before each /status so that none of
+    them wait. Returns the connections the server accepted, the requests it
+    handled, the static files it read from disk, the response body bytes, and
+    the seconds taken, per minute of browser traffic.
+    """
+    import assets
+    import photo
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    etag = None
+    connections = photo.HTTP_CONNECTIONS.value
+    requests_ = photo.HTTP_REQUESTS.value
+    file_reads = assets.FILE_READS.value
+    body_bytes = 0
+    start = time.perf_counter()
+    for minute in range(minutes):
+        for path in BROWSER_MINUTE:
+            headers = {"Accept-Encoding": "gzip"}
+            if path == "/status":
+                seq = mgr.channel.publish(f"http://localhost/photo{minute}.jpg")
+                path = f"/status?format=json&since={seq - 1}"
+            elif etag:
+                headers["If-None-Match"] = etag
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            body_bytes += len(resp.read())
+            etag = resp.getheader("ETag") or etag
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return {
+        "http.browser_minute.connections": (photo.HTTP_CONNECTIONS.value - connections) / minutes,
+        "http.browser_minute.requests": (photo.HTTP_REQUESTS.value - requests_) / minutes,
+        "http.browser_minute.file_reads": (assets.FILE_READS.value - file_reads) / minutes,
+        "http.browser_minute.body_bytes": body_bytes / minutes,
+        "http.browser_minute.seconds": elapsed / minutes,
+    }
+
+
+def bench_http(opts, workdir):
+    """/status and /log latency with several clients requesting at once, and
+    the cost of a minute of a browser's requests.
+    """
+    import channel
+    import photo
+    import utils
+    import watchdog
+
+    log_pth = os.path.join(workdir, "bench_10mb.log")
+    _make_log(log_pth, 10)
+    saved = utils.LOG_FILE, photo.PORT
+    utils.LOG_FILE = log_pth
+    photo.PORT = _free_port()
+    mgr = types.SimpleNamespace(
+        server_mode=photo.SERVER_MODE,
+        max_connections=photo.MAX_CONNECTIONS,
+        watchdog=watchdog.Watchdog(),
+        channel=channel.PhotoChannel(),
+    )
+    mgr.channel.publish("http://localhost/photo.jpg")
+    mgr.webserver = photo.ServerSupervisor(mgr)
+    mgr.webserver.start()
+    results = {}
+    try:
+        if not mgr.webserver.ready.wait(photo.SERVER_START_TIMEOUT):
+            raise RuntimeError("The webserver didn't start")
+        base = f"http://127.0.0.1:{photo.PORT}"
+        for clients in opts["http_clients"]:
+            for name, path, count in (("status", "/status", 50), ("log", "/log?size=1000", 10)):
+                latencies = _load(f"{base}{path}", clients, count)
+                prefix = f"http.{name}.c{clients}"
+                results[f"{prefix}.p50_seconds"] = _percentile(latencies, 50)
+                results[f"{prefix}.p95_seconds"] = _percentile(latencies, 95)
+        results.update(_browser_minutes(mgr, photo.PORT, 100))
+    finally:
+        mgr.webserver.stop()
+        utils.LOG_FILE, photo.PORT = saved
+    return results
+
+
+def _write_config(reg, pkid):
+    import utils
+
+    with open(utils.CONFIG_FILE, "w") as ff:
+        ff.write(
+            f"[frame]\npkid = {pkid}\n\n[host]\nreg_url = {reg.reg_url}\ndl_url = {reg.dl_url}\n"
+        )
+
+
+def _stop_manager(mgr):
+    mgr.kill_timer()
+    mgr.stop_webserver()
+    mgr.cec.close()
+
+
+def bench_startup(opts, workdir):
+    """Reading the config, and starting the frame with and without a state
+    snapshot, against the stand-in servers. Also times navigate(), which
+    includes queueing the snapshot to be saved.
+    """
+    import photo
+    import standins
+    import utils
+
+    pkid = "bench"
+    reg = standins.RegistrationServer(standins.make_image_names(opts["images"]), pkid).start()
+    fake = standins.FakeEtcd()
+    fake.put(f"{utils.BASE_KEY.format(pkid=pkid)}settings", {"name": "bench", "interval_time": 10})
+    utils.etcd_client = fake
+    utils.etcd_checked_at = None
+    _write_config(reg, pkid)
+    saved_port = photo.PORT
+    photo.PORT = _free_port()
+    for pth in (utils.SNAPSHOT_FILE, utils.NAMES_FILE):
+        if os.path.exists(pth):
+            os.unlink(pth)
+    results = {}
+    try:
+        start = time.perf_counter()
+        mgr = photo.ImageManager()
+        results["startup.cold_seconds"] = time.perf_counter() - start
+        try:
+            results["read_config_seconds"] = _median_time(mgr._read_config)
+            mgr._started = True
+            start = time.perf_counter()
+            mgr.show_photo()
+            results["startup.show_photo_seconds"] = time.perf_counter() - start
+            results["navigate_seconds"] = _median_time(mgr.navigate, repeat=20)
+        finally:
+            _stop_manager(mgr)
+
+        start = time.perf_counter()
+        mgr = photo.ImageManager()
+        results["startup.snapshot_seconds"] = time.perf_counter() - start
+        _stop_manager(mgr)
+    finally:
+        reg.stop()
+        photo.PORT = saved_port
+    return results
+
+
+BENCHMARKS = {
+    "adjust": bench_adjust,
+    "large": bench_large,
+    "log": bench_log,
+    "rotation": bench_rotation,
+    "http": bench_http,
+    "startup": bench_startup,
+}
+
+
+def _git_revision():
+    import proc
+
+    try:
+        out, err = proc.run(["git", "rev-parse", "HEAD"], timeout=10)
+    except (OSError, proc.subprocess.SubprocessError):
+        return None
+    return out.strip() or None
+
+
+def run(args):
+    profile = "quick" if args.quick else "full" if args.full else "default"
+    opts = PROFILES[profile]
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="photoviewer-bench-")
+    # The frame's paths all hang off the home directory, and are set when utils
+    # is first imported.
+    os.environ["HOME"] = workdir
+    os.makedirs(os.path.join(workdir, "projects", "photoviewer"), exist_ok=True)
+    revision = _git_revision()
+    results = {}
+    for name in names:
+        print(f"Running {name}...", flush=True)
+        start = time.perf_counter()
+        results.update(BENCHMARKS[name](opts, workdir))
+        print(f"    done in {time.perf_counter() - start:.1f}s", flush=True)
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": revision,
+            "profile": profile,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    output = args.output or f"benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, "w") as ff:
+        json.dump(report, ff, indent=2, sort_keys=True)
+    for key, val in sorted(results.items()):
+        print(f"{key}: {val:.6g}")
+    print(f"Results written to {output}")
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+def compare(args):
+    with open(args.old) as ff:
+        old = json.load(ff)["results"]
+    with open(args.new) as ff:
+        new = json.load(ff)["results"]
+    regressions = []
+    for key in sorted(set(old) & set(new)):
+        before, after = old[key], new[key]
+        change = (after - before) / before * 100 if before else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key}: {before:.6g} -> {after:.6g} ({change:+.1f}%){flag}")
+    for key in sorted(set(old) ^ set(new)):
+        print(f"{key}: only in {'old' if key in old else 'new'} results")
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold}%")
+        return 1
+    print("No regressions")
+    return 0
+
+
+def main():
+    aparser = argparse.ArgumentParser(description="Benchmark the photoviewer's hot paths")
+    commands = aparser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    size = run_parser.add_mutually_exclusive_group()
+    size.add_argument("--quick", action="store_true", help="Fewer, smaller cases")
+    size.add_argument("--full", action="store_true", help="Include the 1 GB log")
+    run_parser.add_argument("--only", help=f"Comma-separated: {','.join(BENCHMARKS)}")
+    run_parser.add_argument("--output", help="Where to write the JSON results")
+    run_parser.add_argument("--workdir", help="Keep the scratch files here")
+    compare_parser = commands.add_parser("compare", help="Compare two sets of results")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD_PCT)
+    args = aparser.parse_args()
+    return run(args) if args.command == "run" else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
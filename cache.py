@@ -0,0 +1,213 @@
+import collections
+import os
+import queue
+import threading
+
+import requests
+
+import utils
+from utils import debug, error, info
+
+# Default upper limit for the cache size
+MAX_CACHE_MB = 2048
+# Always leave at least this much free space on the card
+RESERVE_MB = 512
+# How many upcoming images to download ahead of time
+PREFETCH_COUNT = 3
+DOWNLOAD_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = ".part"
+MB = 1024 * 1024
+
+
+class ImageCache(object):
+    """Keeps local copies of downloaded images in IMAGE_DIR so that the browser
+    can load them from the frame instead of the CDN.
+
+    The cache is limited to `max_bytes`, and will never use more than the free
+    space on the card minus `reserve_bytes`. When space is needed, the least
+    recently used images are removed first.
+
+    If `on_cached` is given, it is called with the name of each image once it
+    has been downloaded.
+    """
+
+    def __init__(
+        self,
+        dl_url,
+        cache_dir=utils.IMAGE_DIR,
+        max_bytes=MAX_CACHE_MB * MB,
+        reserve_bytes=RESERVE_MB * MB,
+        on_cached=None,
+    ):
+        self.dl_url = dl_url
+        self.on_cached = on_cached
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.reserve_bytes = reserve_bytes
+        self.lock = threading.Lock()
+        # Maps file name to size, with the least recently used first.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.session = requests.Session()
+        self.session.headers["user-agent"] = "photoviewer"
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._worker = None
+        self._load()
+
+    def _load(self):
+        """Builds the LRU order from the files already on disk, using their
+        modification times.
+        """
+        found = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                if entry.name.endswith(PARTIAL_SUFFIX):
+                    # Left over from an interrupted download
+                    os.unlink(entry.path)
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        found.sort()
+        with self.lock:
+            for mtime, fname, size in found:
+                self.entries[fname] = size
+                self.total_bytes += size
+        info(f"Image cache has {len(found)} images using {self.total_bytes} bytes")
+
+    def set_limits(self, max_bytes=None, reserve_bytes=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if reserve_bytes is not None:
+            self.reserve_bytes = reserve_bytes
+
+    @staticmethod
+    def is_valid_name(fname):
+        return bool(fname) and os.path.basename(fname) == fname and not fname.startswith(".")
+
+    def path_for(self, fname):
+        return os.path.join(self.cache_dir, fname)
+
+    def get(self, fname):
+        """Returns the local path for the image if it is in the cache, marking it
+        as recently used. Returns None if it isn't cached.
+        """
+        with self.lock:
+            if fname not in self.entries:
+                return None
+            self.entries.move_to_end(fname)
+        pth = self.path_for(fname)
+        try:
+            # Keep the LRU order across restarts
+            os.utime(pth)
+        except FileNotFoundError:
+            self._forget(fname)
+            return None
+        return pth
+
+    def contains(self, fname):
+        with self.lock:
+            return fname in self.entries
+
+    def _forget(self, fname):
+        with self.lock:
+            size = self.entries.pop(fname, None)
+            if size is not None:
+                self.total_bytes -= size
+
+    def _budget(self):
+        freespace = utils.get_freespace(self.cache_dir)
+        # The space already used by the cache is available to it, too.
+        available = self.total_bytes + freespace - self.reserve_bytes
+        return max(0, min(self.max_bytes, available))
+
+    def _make_room(self, size):
+        """Removes the least recently used images until there is room for an
+        image of `size` bytes. Returns False if there isn't enough space even
+        with the cache emptied.
+        """
+        budget = self._budget()
+        if size > budget:
+            return False
+        while True:
+            with self.lock:
+                if not self.entries or self.total_bytes + size <= budget:
+                    return True
+                fname, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+            debug("Evicting cached image", fname)
+            try:
+                os.unlink(self.path_for(fname))
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, fname):
+        """Downloads the image into the cache if it isn't already there, and
+        returns its local path, or None if it couldn't be cached.
+        """
+        if not self.is_valid_name(fname):
+            return None
+        pth = self.get(fname)
+        if pth:
+            return pth
+        url = os.path.join(self.dl_url, fname)
+        pth = self.path_for(fname)
+        partial = pth + PARTIAL_SUFFIX
+        debug("Downloading image", fname)
+        try:
+            with self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+                resp.raise_for_status()
+                expected = int(resp.headers.get("content-length") or 0)
+                if not self._make_room(expected):
+                    info(f"Not enough space to cache image '{fname}'")
+                    return None
+                with open(partial, "wb") as ff:
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        ff.write(chunk)
+        except (requests.RequestException, OSError) as e:
+            error(f"Could not download image '{fname}': {e}")
+            if os.path.exists(partial):
+                os.unlink(partial)
+            return None
+        size = os.path.getsize(partial)
+        if not self._make_room(size):
+            info(f"Not enough space to cache image '{fname}'")
+            os.unlink(partial)
+            return None
+        os.replace(partial, pth)
+        with self.lock:
+            self.entries[fname] = size
+            self.total_bytes += size
+        debug(f"Cached image '{fname}' ({size} bytes)")
+        if self.on_cached:
+            try:
+                self.on_cached(fname)
+            except Exception as e:
+                error(f"Error handling newly cached image '{fname}': {e}")
+        return pth
+
+    def prefetch(self, fnames):
+        """Queues the images to be downloaded in the background."""
+        for fname in fnames:
+            with self.lock:
+                if fname in self.entries or fname in self._pending:
+                    continue
+                self._pending.add(fname)
+            self._queue.put(fname)
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="prefetch", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            fname = self._queue.get()
+            try:
+                self.fetch(fname)
+            except Exception as e:
+                error(f"Prefetch of '{fname}' failed: {e}")
+            finally:
+                with self.lock:
+                    self._pending.discard(fname)
@@ -0,0 +1,63 @@
+import threading
+
+
+class PhotoChannel(object):
+    """Publishes photo changes to any number of waiting clients.
+
+    Every change gets the next sequence number. A client keeps the number of
+    the last change it has seen, and waits for anything newer, so clients never
+    take a change away from each other, and a client that reconnects picks up
+    whatever it missed.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.url = ""
+        self.upcoming = []
+
+    def publish(self, url, upcoming=()):
+        """Records a new photo URL, along with the URLs of the photos expected
+        to follow it, and wakes all waiting clients. Returns the sequence number
+        of the change.
+        """
+        with self.cond:
+            self.seq += 1
+            self.url = url
+            self.upcoming = list(upcoming)
+            self.cond.notify_all()
+            return self.seq
+
+    def current(self):
+        """Returns a tuple of (sequence number, URL) for the latest change."""
+        with self.cond:
+            return self.seq, self.url
+
+    def message(self):
+        """Returns the latest change as a dict with its sequence number, URL and
+        the upcoming URLs, for the browser.
+        """
+        with self.cond:
+            return {"seq": self.seq, "url": self.url, "next": list(self.upcoming)}
+
+    def wait(self, cursor, timeout=None, stop_event=None):
+        """Waits until there is a change newer than `cursor`, `timeout` seconds
+        pass, or `stop_event` is set. Returns a tuple of (sequence number, URL)
+        for the latest change; the sequence number will equal `cursor` if
+        nothing changed. A cursor newer than the latest change is treated as
+        stale, since the sequence numbers start over when the frame restarts.
+        """
+        stopped = stop_event.is_set if stop_event else lambda: False
+        with self.cond:
+            if cursor > self.seq:
+                # The client saw changes from before a restart.
+                cursor = 0
+            self.cond.wait_for(lambda: self.seq > cursor or stopped(), timeout)
+            return self.seq, self.url
+
+    def wake(self):
+        """Wakes all waiting clients without a change, so that they can check
+        their stop_event.
+        """
+        with self.cond:
+            self.cond.notify_all()
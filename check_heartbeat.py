@@ -1,80 +1,83 @@
-import configparser
 import datetime
+import json
 import os
-from subprocess import Popen, PIPE
 import sys
-import time
+import urllib.error
+import urllib.request
+
+import proc
 
 HOMEDIR = os.path.expanduser("~")
 APPDIR = os.path.join(HOMEDIR, "projects/photoviewer")
-CONFIG_FILE = os.path.join(APPDIR, "photo.cfg")
-HEARTBEAT_FLAG_FILE = os.path.join(APPDIR, "HEARTBEAT")
-NO_FILE_FLAG = -1
-PARSER = configparser.ConfigParser()
+# Written by photo.py when it starts
+PID_FILE = os.path.join(APPDIR, "photo.pid")
+# Must match PORT in photo.py
+HEALTH_URL = "http://localhost:9001/health"
+# A server in single mode may be busy with a browser's /status request for up to
+# a minute before it gets to this one.
+HEALTH_TIMEOUT = 75
 if sys.platform == "darwin":
     RESTART_COMMAND = (
         f"cd {APPDIR}; kill -9 `cat photo.pid`; source {HOMEDIR}/venvs/viewer/bin/activate; "
-        f"python photo.py & ; rm -f {HEARTBEAT_FLAG_FILE}"
+        "python photo.py &"
     )
 else:
-    RESTART_COMMAND = "sudo systemctl restart photoviewer.service"
-
-
-def runproc(cmd, wait=True):
-    if wait:
-        kwargs = dict(stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    else:
-        kwargs = dict(stdin=None, stdout=None, stderr=None)
-    proc = Popen([cmd], shell=True, close_fds=True, **kwargs)
-    if wait:
-        stdout_text, stderr_text = proc.communicate()
-        return stdout_text.decode("utf-8"), stderr_text.decode("utf-8")
+    RESTART_COMMAND = ["sudo", "systemctl", "restart", "photoviewer.service"]
 
 
-def safe_get(section, option, default=None):
+def get_health():
+    """Asks the running photoviewer how it's doing. Returns a tuple of (health,
+    message), where health is True, False, or None if the photoviewer isn't
+    running.
+    """
     try:
-        return PARSER.get(section, option)
-    except (configparser.NoSectionError, configparser.NoOptionError):
-        return default
-
-
-def normalize_interval(time_, units):
-    unit_key = units[0].lower()
-    factor = {"s": 1, "m": 60, "h": 3600, "d": 86400}.get(unit_key, 1)
-    return time_ * factor
-
-
-def get_interval():
+        with urllib.request.urlopen(HEALTH_URL, timeout=HEALTH_TIMEOUT) as resp:
+            return True, resp.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        body = e.read().decode("utf-8")
+        try:
+            json.loads(body)
+        except ValueError:
+            # Not the health report, so the server is just too busy right now.
+            return True, f"Server busy ({e.code})"
+        return False, body
+    except ConnectionRefusedError:
+        return None, "Not running"
+    except urllib.error.URLError as e:
+        if isinstance(e.reason, ConnectionRefusedError):
+            return None, "Not running"
+        return False, str(e.reason)
+    except OSError as e:
+        # Timed out, so it's hung.
+        return False, str(e)
+
+
+def frame_running(pid_file=None, proc_root=None):
+    """Returns True if the process in the pid file is a photoviewer that is
+    still running. Without a /proc tree, any process with that pid counts.
+    """
     try:
-        PARSER.read(CONFIG_FILE)
-    except configparser.MissingSectionHeaderError as e:
-        # The file exists, but doesn't have the correct format.
-        raise Exception("Invalid Configuration File")
-    # How often the image is changed
-    interval_time = int(safe_get("frame", "interval_time", 60))
-    # Units of time for the image change interval
-    interval_units = safe_get("frame", "interval_units", "minutes")
-    interval = normalize_interval(interval_time, interval_units)
-    return interval
-
-
-def since_heartbeat():
-    if not os.path.exists(HEARTBEAT_FLAG_FILE):
-        return NO_FILE_FLAG
-    info = os.stat(HEARTBEAT_FLAG_FILE)
-    local_time = time.localtime(info.st_atime)
-    last_access = time.mktime(local_time)
-    return time.time() - last_access
-
-
-def clear_heartbeat_flag():
-    if os.path.exists(HEARTBEAT_FLAG_FILE):
-        os.unlink(HEARTBEAT_FLAG_FILE)
+        with open(pid_file or PID_FILE) as ff:
+            pid = int(ff.read().strip())
+    except (OSError, ValueError):
+        return False
+    proc_root = proc_root or proc.PROC_ROOT
+    if os.path.isdir(proc_root):
+        return any(
+            num == pid and any(arg.endswith("photo.py") for arg in cmdline)
+            for num, name, cmdline in proc.iter_processes(proc_root)
+        )
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
 
 
 def restart():
-    runproc(RESTART_COMMAND)
-    clear_heartbeat_flag()
+    proc.run(RESTART_COMMAND)
 
 
 def printit(txt):
@@ -84,16 +87,23 @@ def printit(txt):
 
 
 def main():
-    elapsed = since_heartbeat()
-    if elapsed == NO_FILE_FLAG:
-        printit("Cool")
-        return
-    interval = get_interval()
-    if elapsed > (1.5 * interval):
-        printit("RESTARTING!")
-        restart()
+    healthy, message = get_health()
+    if healthy is None:
+        if frame_running():
+            # The process is alive, but isn't listening any more.
+            printit("RESTARTING! photo.py is running, but refused the connection")
+            restart()
+        else:
+            # It has been stopped, so leave it that way.
+            printit(message)
+    elif healthy:
+        if sys.platform == "darwin" or proc.is_running("chromium"):
+            printit("Cool")
+        else:
+            printit("Cool, but the browser isn't running")
     else:
-        printit(f"Elapsed = {elapsed}, Interval = {interval}")
+        printit(f"RESTARTING! {message}")
+        restart()
 
 
 if __name__ == "__main__":
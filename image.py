@@ -1,43 +1,265 @@
 import gc
+import math
 import os
-from PIL import Image, ImageEnhance
+import struct
+from PIL import features, Image
 
 from utils import logit
 
+# Originals are reduced to fit within this, when the display size isn't known
 MINSIZE = 3600
+# Maps each rendition format to its PIL format, file extension and default
+# quality. At display size, these qualities are indistinguishable from the
+# original on the frame's monitor.
+FORMATS = {"jpeg": ("JPEG", ".jpg", 85), "webp": ("WEBP", ".webp", 80)}
+DEFAULT_FORMAT = "jpeg"
+EXIF_ORIENTATION = 0x0112
+# How to turn the stored pixels upright for each EXIF orientation. The last
+# four swap the width and height.
+EXIF_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# Upper limit on the memory used for an image's pixels while it's processed.
+# Images too big to decode within it are decoded at a reduced scale.
+MAX_IMAGE_MB = 256
+MB = 1024 * 1024
+# Scales that a JPEG can be decoded at
+JPEG_SCALES = (1, 2, 4, 8)
+# The memory limit above replaces PIL's decompression bomb check, which would
+# refuse large scans and panoramas outright.
+Image.MAX_IMAGE_PIXELS = None
+# Number of rows corrected at a time, so that only one full-size copy of the
+# image is ever held in memory.
+STRIP_ROWS = 256
+# Weights PIL uses when converting RGB to grayscale
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
 
 
-def adjust(img_file, bright, contrast, saturation):
+def _clip(val):
+    return max(0, min(255, int(val)))
+
+
+def _float32(val):
+    return struct.unpack("f", struct.pack("f", val))[0]
+
+
+def _blend_table(base, alpha):
+    """Returns what Image.blend makes of each value when blending it with
+    `base` by `alpha`, which is how ImageEnhance works. Image.blend does the
+    arithmetic in single precision and truncates, so this does too; otherwise
+    values that come out close to a whole number can round the other way.
+    """
+    alpha = _float32(alpha)
+    return [_clip(_float32(base + _float32(alpha * (val - base)))) for val in range(256)]
+
+
+def _mean_luma(img, brightened):
+    """Returns the mean grayscale value the image will have after its
+    brightness is adjusted by the `brightened` table. This is calculated from
+    the channel histograms, so no adjusted or grayscale copy of the image is
+    needed.
+    """
+    hist = img.histogram()
+    num_pixels = img.width * img.height
+    mean = 0.0
+    for band, weight in enumerate(LUMA_WEIGHTS):
+        counts = hist[band * 256 : (band + 1) * 256]
+        total = sum(count * brightened[val] for val, count in enumerate(counts))
+        mean += weight * total / num_pixels
+    return int(mean + 0.5)
+
+
+def _tone_table(img, bright, contrast):
+    """Brightness and contrast are both applied to each channel value
+    independently, so they can be combined into a single lookup table. The
+    values match those of ImageEnhance.Brightness followed by
+    ImageEnhance.Contrast.
+    """
+    brightened = _blend_table(0, bright)
+    contrasted = _blend_table(_mean_luma(img, brightened), contrast)
+    return [contrasted[val] for val in brightened] * len(img.getbands())
+
+
+def _correct(img, bright, contrast, saturation):
+    """Applies all three corrections to the image in place, one strip at a
+    time.
+    """
+    table = None
+    if bright != 1.0 or contrast != 1.0:
+        table = _tone_table(img, bright, contrast)
+    for top in range(0, img.height, STRIP_ROWS):
+        box = (0, top, img.width, min(top + STRIP_ROWS, img.height))
+        strip = img.crop(box)
+        if table:
+            strip = strip.point(table)
+        if saturation != 1.0:
+            # Same as ImageEnhance.Color, which works on each pixel separately
+            gray = strip.convert("L").convert(strip.mode)
+            strip = Image.blend(gray, strip, saturation)
+        img.paste(strip, box)
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def _pixel_bytes(size):
+    return size[0] * size[1] * 3
+
+
+def _open_reduced(img_file, box, max_bytes, upright=False):
+    """Opens the image, set up to decode at the smallest scale that still
+    covers the size it will be reduced to for `box`. With `upright`, `box` is
+    for the image once it's turned by its EXIF orientation.
+
+    The plan is made from the header, before any pixels are decoded: if the
+    decoded image and its resampled copy wouldn't fit in `max_bytes`, a JPEG is
+    decoded at a smaller scale instead, at the cost of some resolution. Other
+    formats can only be decoded at full size, so ImageTooLarge is raised if
+    they won't fit.
+    """
+    img = Image.open(img_file)
+    size = img.size
+    if upright and img.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+        box = box[::-1]
+    target = fit_size(size, box)
+    scales = JPEG_SCALES if img.format == "JPEG" else (1,)
+    chosen = None
+    for scale in scales:
+        # libjpeg rounds the scaled size up.
+        decoded = (math.ceil(size[0] / scale), math.ceil(size[1] / scale))
+        covers = decoded[0] >= target[0] and decoded[1] >= target[1]
+        if chosen and not covers:
+            # Going smaller would lose resolution that there's room for.
+            break
+        if _pixel_bytes(decoded) + _pixel_bytes(fit_size(decoded, target)) <= max_bytes:
+            chosen = scale
+            if not covers:
+                break
+    if not chosen:
+        raise ImageTooLarge(
+            "%s x %s %s needs more than %s MB" % (size[0], size[1], img.format, max_bytes // MB)
+        )
+    if chosen > 1:
+        # The decoder picks the largest scale that gives at least this size.
+        img.draft("RGB", (size[0] // chosen, size[1] // chosen))
+        logit("debug", "Decoding %s at %s x %s" % (img_file, img.width, img.height))
+    return img
+
+
+def adjust(
+    img_file, bright, contrast, saturation, size=None, out_file=None, max_bytes=MAX_IMAGE_MB * MB
+):
     """Uses the local profile to adjust the image to look good on the local
     monitor.
+
+    If `size` is given, the image is reduced to fit within it; otherwise it is
+    reduced to fit within MINSIZE. JPEGs are decoded at the smallest scale
+    that is still at least that size, or smaller still if needed to keep the
+    pixels within `max_bytes`.
+
+    The adjusted image is written to `out_file` if given; otherwise it replaces
+    the original.
     """
     img_name = os.path.basename(img_file)
     logit("info", "Adjusting image '%s'" % img_name)
-    img = Image.open(img_file)
-    if img.height < MINSIZE and img.width < MINSIZE:
-        img.thumbnail((MINSIZE, MINSIZE), Image.ANTIALIAS)
+    box = size or (MINSIZE, MINSIZE)
+    img = _open_reduced(img_file, box, max_bytes)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    target = fit_size(img.size, box)
+    if target != img.size:
+        img = img.resize(target, Image.LANCZOS)
     logit("debug", "Image %s size: %s x %s" % (img_name, img.width, img.height))
+    bright, contrast, saturation = float(bright), float(contrast), float(saturation)
+    if (bright, contrast, saturation) != (1.0, 1.0, 1.0):
+        logit("debug", "Correcting image '%s'" % img_name)
+        _correct(img, bright, contrast, saturation)
+        logit("debug", "Finished correcting image '%s'" % img_name)
     if img.height > img.width:
         # Rotate 90 degrees for display
-        img = img.rotate(90, expand=True)
+        img = img.transpose(Image.Transpose.ROTATE_90)
         logit("info", "Image '%s' has been rotated" % img_name)
-    if bright != 1.0:
-        enhancer = ImageEnhance.Brightness(img)
-        logit("debug", "Adjusting brightness for image '%s'" % img_name)
-        img = enhancer.enhance(float(bright))
-        logit("debug", "Finished adjusting brightness for image '%s'" % img_name)
-    if contrast != 1.0:
-        enhancer = ImageEnhance.Contrast(img)
-        logit("debug", "Adjusting contrast for image '%s'" % img_name)
-        img = enhancer.enhance(float(contrast))
-        logit("debug", "Finished adjusting contrast for image '%s'" % img_name)
-    if saturation != 1.0:
-        enhancer = ImageEnhance.Color(img)
-        logit("debug", "Adjusting saturation for image '%s'" % img_name)
-        img = enhancer.enhance(float(saturation))
-        logit("debug", "Finished adjusting saturation for image '%s'" % img_name)
     logit("debug", "Saving image '%s'" % img_name)
-    img.save(img_file, format="JPEG", subsampling=0, quality=95)
+    img.save(out_file or img_file, format="JPEG", subsampling=0, quality=95)
     gc.collect()
     logit("debug", "Finished saving image '%s'" % img_name)
     logit("info", "Finished corrections for image '%s'" % img_name)
+
+
+def supported_format(fmt):
+    """Returns the format if this PIL can write it, or else DEFAULT_FORMAT."""
+    fmt = (fmt or DEFAULT_FORMAT).lower()
+    if fmt not in FORMATS:
+        logit("error", "Unknown rendition format '%s'; using %s" % (fmt, DEFAULT_FORMAT))
+        return DEFAULT_FORMAT
+    if fmt == "webp" and not features.check("webp"):
+        logit("error", "This PIL can't write WebP; using %s" % DEFAULT_FORMAT)
+        return DEFAULT_FORMAT
+    return fmt
+
+
+def fit_size(size, box):
+    """Returns the largest size with the aspect ratio of `size` that fits in
+    `box`. Images are never enlarged.
+    """
+    scale = min(box[0] / size[0], box[1] / size[1], 1.0)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def render(
+    img_file,
+    out_file,
+    bright,
+    contrast,
+    saturation,
+    size,
+    orientation="H",
+    fmt=None,
+    quality=None,
+    max_bytes=MAX_IMAGE_MB * MB,
+):
+    """Makes a rendition of the image for a display of `size` (width, height)
+    pixels: upright, resampled once to the size it will be shown at, with the
+    local profile applied, and encoded as `fmt`.
+
+    With a vertical `orientation`, the monitor is mounted on its side, so the
+    image is fitted to the rotated screen and then turned to match.
+    """
+    img_name = os.path.basename(img_file)
+    logit("info", "Rendering image '%s' for %s x %s" % (img_name, size[0], size[1]))
+    fmt = supported_format(fmt)
+    pil_format, default_quality = FORMATS[fmt][0], FORMATS[fmt][2]
+    vertical = (orientation or "H")[0].upper() == "V"
+    box = (size[1], size[0]) if vertical else tuple(size)
+    img = _open_reduced(img_file, box, max_bytes, upright=True)
+    exif_orientation = img.getexif().get(EXIF_ORIENTATION)
+    if exif_orientation in TRANSPOSED_ORIENTATIONS:
+        box = box[::-1]
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    target = fit_size(img.size, box)
+    if target != img.size:
+        img = img.resize(target, Image.LANCZOS)
+    if exif_orientation in EXIF_TRANSPOSES:
+        # Turned upright after resampling, where the copy is small.
+        img = img.transpose(EXIF_TRANSPOSES[exif_orientation])
+    logit("debug", "Image %s size: %s x %s" % (img_name, img.width, img.height))
+    bright, contrast, saturation = float(bright), float(contrast), float(saturation)
+    if (bright, contrast, saturation) != (1.0, 1.0, 1.0):
+        _correct(img, bright, contrast, saturation)
+    if vertical:
+        img = img.transpose(Image.Transpose.ROTATE_90)
+    quality = int(quality or default_quality)
+    if pil_format == "JPEG":
+        img.save(out_file, format="JPEG", quality=quality, progressive=True, optimize=True)
+    else:
+        img.save(out_file, format=pil_format, quality=quality, method=4)
+    logit("info", "Finished rendering image '%s'" % img_name)
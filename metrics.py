@@ -0,0 +1,162 @@
+"""A small registry of counters, gauges and histograms, rendered in the
+Prometheus text format for /metrics.
+
+Recording a value takes an uncontended lock and a few additions; nothing is
+formatted until the metrics are scraped.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Seconds; covers everything from a local lookup to a slow network call.
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _format_value(val):
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return repr(val) if isinstance(val, float) else str(val)
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(object):
+    """A value that can go up and down. If `func` is given, it is called for
+    the value when the metrics are scraped.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, doc, func=None):
+        self.name = name
+        self.doc = doc
+        self.func = func
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def set(self, val):
+        self.value = val
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set_max(self, val):
+        """Sets the value if it's higher than the current one."""
+        with self.lock:
+            if val > self.value:
+                self.value = val
+
+    def samples(self):
+        val = self.value
+        if self.func:
+            try:
+                val = self.func()
+            except Exception:
+                return []
+        return [(self.name, val)]
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, buckets=TIME_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # The last count is for values above the highest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, val):
+        idx = bisect.bisect_left(self.buckets, val)
+        with self.lock:
+            self.counts[idx] += 1
+            self.total += val
+            self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        """Observes how long the block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.total, self.count
+        samples = []
+        cumulative = 0
+        for bound, num in zip(self.buckets, counts):
+            cumulative += num
+            samples.append((f'{self.name}_bucket{{le="{_format_value(bound)}"}}', cumulative))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', count))
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, doc, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, doc, **kwargs)
+            return metric
+
+    def counter(self, name, doc):
+        return self._get(Counter, name, doc)
+
+    def gauge(self, name, doc, func=None):
+        return self._get(Gauge, name, doc, func=func)
+
+    def histogram(self, name, doc, buckets=TIME_BUCKETS):
+        return self._get(Histogram, name, doc, buckets=buckets)
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, val in metric.samples():
+                lines.append(f"{name} {_format_value(val)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
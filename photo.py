@@ -2,36 +2,152 @@
 import configparser
 import datetime
 import http.server
+import json
+import math
+import mimetypes
 import os
 import random
 import signal
+import socket
 import socketserver
 import sys
-from threading import Thread, Timer
+from threading import BoundedSemaphore, Event, Lock, RLock, Thread
+import shutil
 import time
 import urllib.parse
 
 import requests
 
+from assets import AssetCache
+from cache import ImageCache, MB, MAX_CACHE_MB, PREFETCH_COUNT, RESERVE_MB
+from channel import PhotoChannel
+from image import MAX_IMAGE_MB
+import metrics
+import proc
+from render import display_size, output_spec, Renderer, WORKER_MB
+from renditions import RenditionStore
+from scheduler import Scheduler
+from settings import ConfigFile, Settings
+from snapshot import Snapshot
+from shuffle import Rotation
+from stats import CANDIDATES, DisplayStats, WeightedSelector
+from watchdog import Watchdog
 import utils
-from utils import debug, enc, error, info, runproc, BASE_KEY, CONFIG_FILE
+from utils import debug, enc, error, get_freespace, info, BASE_KEY
 
-MONITOR_CMD = "echo 'on 0' | /usr/bin/cec-client -s -d 1"
 BROWSER_CYCLE = 60
+# Settings that are also saved to photo.cfg, and the ones that are kept in its
+# [monitor] section
+SAVED_SETTINGS = (
+    "name",
+    "description",
+    "interval_time",
+    "interval_units",
+    "variance_pct",
+    "brightness",
+    "contrast",
+    "saturation",
+    "orientation",
+)
+PROFILE_SETTINGS = ("brightness", "contrast", "saturation")
+# Settings that change when photos are shown
+TIMER_SETTINGS = ("interval_time", "interval_units", "variance_pct", "use_halflife")
+# How long the browser should wait before reconnecting to /events
+EVENT_RETRY_MS = 10000
+# How many of the upcoming photos' URLs are sent with each change. The browser
+# loads and decodes the first of them while the current one is on screen.
+UPCOMING_URLS = 2
 # Used to weigh the odds of halflife expiring
 HALFLIFE_FACTOR = 0.67
+# How often the scheduler thread reports that it's alive, and how long it can
+# go without doing so before it is replaced
+SCHEDULER_BEAT = 30
+SCHEDULER_TIMEOUT = 180
+# How long after it's due the photo timer can go without firing
+TIMER_GRACE = 120
+# How long the etcd watch can go without any progress. etcd sends progress
+# notifications every 10 minutes by default.
+WATCH_TIMEOUT = 1800
 
 PORT = 9001
+# "shuffle" shows every image once per pass; "weighted" favors the images that
+# haven't been shown for the longest time.
+SELECTION_MODE = "shuffle"
+# How long to wait for the webserver to start listening
+SERVER_START_TIMEOUT = 10
+# Delays between webserver restarts grow from the first to the second after
+# each failure in a row.
+SERVER_RETRY_INTERVAL = 1
+MAX_SERVER_RETRY_INTERVAL = 60
+# A webserver that ran this long before failing starts the delays over
+SERVER_STABLE_SECS = 60
+# (connect, read) timeouts for registration requests
+REGISTER_TIMEOUT = (5, 30)
+# "threaded" handles each request in its own thread; "single" handles them one
+# at a time.
+SERVER_MODE = "threaded"
+# Maximum number of requests handled at once in threaded mode
+MAX_CONNECTIONS = 16
+LOCAL_URL = f"http://localhost:{PORT}"
+IMAGE_PATH = "/images/"
+RENDITION_PATH = "/renditions/"
+# Older Pythons don't know the type of WebP renditions.
+mimetypes.add_type("image/webp", ".webp")
+MAIN_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.html")
 
 
-def get_freespace():
-    stat = os.statvfs(".")
-    freespace = stat.f_frsize * stat.f_bavail
-    debug("Free disk space =", freespace)
-    return freespace
+# Size of the pieces that the log is sent to the browser in
+LOG_CHUNK_SIZE = 16 * 1024
+
+REGISTER_SECONDS = metrics.histogram(
+    "photoviewer_register_seconds", "Round trip time of registration requests"
+)
+REGISTER_BYTES = metrics.histogram(
+    "photoviewer_register_response_bytes",
+    "Size of registration responses",
+    buckets=metrics.SIZE_BUCKETS,
+)
+REGISTER_FAILURES = metrics.counter(
+    "photoviewer_register_failures_total", "Registration requests that failed"
+)
+STATUS_WAIT_SECONDS = metrics.histogram(
+    "photoviewer_status_wait_seconds",
+    "Time /status requests waited for a photo change",
+    buckets=(0.01, 0.1, 1, 5, 15, 30, 45, 60, 90),
+)
+TIMER_DRIFT_SECONDS = metrics.histogram(
+    "photoviewer_timer_drift_seconds",
+    "How late the photo timer fired compared to when it was scheduled",
+)
+PHOTO_CHANGES = metrics.counter("photoviewer_photo_changes_total", "Photos shown")
+HTTP_CONNECTIONS = metrics.counter(
+    "photoviewer_http_connections_total", "Connections accepted by the webserver"
+)
+HTTP_REQUESTS = metrics.counter("photoviewer_http_requests_total", "Requests to the webserver")
+
+# main.html and any other static files, held in memory
+ASSETS = AssetCache()
+
+
+def halflife_delay(interval, rand=random.random):
+    """Returns the seconds until the next photo change in halflife mode.
+
+    Halflife mode changes the photo at the end of any minute with probability
+    HALFLIFE_FACTOR / (interval in minutes), so the number of minutes until a
+    change is geometrically distributed. Drawing it directly gives the same
+    distribution as checking once a minute.
+    """
+    prob = HALFLIFE_FACTOR / (interval / 60)
+    if prob >= 1:
+        return 60
+    minutes = math.ceil(math.log(1.0 - rand()) / math.log(1.0 - prob))
+    return 60 * max(1, minutes)
 
 
 def get_log_content(path):
+    """Yields the HTML for the /log page in chunks, so the whole log never has
+    to be held in memory.
+    """
     parts = path.split("?")
     line_count = 1000
     term = ""
@@ -43,77 +159,522 @@ def get_log_content(path):
             if key == "size":
                 line_count = int(val)
             elif key == "filter":
-                term = val
-    return f"<pre>{utils.read_log(line_count, term)}</pre>"
+                term = urllib.parse.unquote_plus(val)
+    chunk = ["<pre>"]
+    chunk_size = 0
+    for line in utils.iter_log(line_count, term):
+        chunk.append(line)
+        chunk_size += len(line)
+        if chunk_size >= LOG_CHUNK_SIZE:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+            chunk_size = 0
+    yield "\n".join(chunk) + "</pre>"
+
+
+class SinglePhotoServer(socketserver.TCPServer):
+    """Handles one request at a time."""
+
+    allow_reuse_address = True
+    # A stream would tie up the only thread, so /events sends the latest change
+    # (if the browser hasn't seen it) without waiting, and the browser
+    # reconnects after the retry interval. For the same reason each connection
+    # is closed after one request.
+    streaming = False
+    keep_alive = False
+
+    def __init__(self, server_address, handler_class, max_connections=None):
+        self.stopping = Event()
+        super().__init__(server_address, handler_class)
+
+    def stop(self):
+        self.stopping.set()
+        self.shutdown()
+
+
+class PhotoServer(socketserver.ThreadingMixIn, SinglePhotoServer):
+    """Handles each connection in its own thread, so that a browser waiting on
+    /status doesn't hold up any other request. Connections beyond
+    `max_connections` are turned away with a 503.
+    """
+
+    # Let server_close() wait for the handler threads to finish.
+    daemon_threads = False
+    block_on_close = True
+    streaming = True
+    keep_alive = True
+
+    def __init__(self, server_address, handler_class, max_connections=MAX_CONNECTIONS):
+        self.connection_slots = BoundedSemaphore(max_connections)
+        self.connections = set()
+        self.connections_lock = Lock()
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        if not self.connection_slots.acquire(blocking=False):
+            error("Too many connections; rejecting request from", client_address[0])
+            try:
+                request.sendall(b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections.discard(request)
+            self.connection_slots.release()
 
+    def stop(self):
+        super().stop()
+        # Connections kept open between requests would otherwise hold up
+        # server_close() until they time out. Shutting down the reading side
+        # ends them at their next request, without cutting off a response.
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
 
-def run_webserver(mgr):
-    with socketserver.TCPServer(("0.0.0.0", PORT), PhotoHandler) as httpd:
-        httpd.mgr = mgr
-        info("Webserver running on port", PORT)
-        httpd.serve_forever()
+
+SERVER_CLASSES = {"threaded": PhotoServer, "single": SinglePhotoServer}
+
+
+class ServerSupervisor(object):
+    """Runs the webserver in a thread, and starts it again whenever it fails,
+    waiting a little longer after each failure in a row. `ready` is set while
+    the server is listening, and `restarts` counts how many times it has been
+    started again.
+    """
+
+    def __init__(self, mgr):
+        self.mgr = mgr
+        self.ready = Event()
+        self.stopping = Event()
+        self.restarts = 0
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        if self.alive():
+            return
+        self.stopping.clear()
+        self.thread = Thread(target=self._run, name="webserver", daemon=True)
+        self.thread.start()
+
+    def alive(self):
+        return bool(self.thread and self.thread.is_alive())
+
+    def _serve(self):
+        mgr = self.mgr
+        server_class = SERVER_CLASSES.get(mgr.server_mode, PhotoServer)
+        with server_class(("0.0.0.0", PORT), PhotoHandler, mgr.max_connections) as httpd:
+            httpd.mgr = mgr
+            self.httpd = httpd
+            self.ready.set()
+            info(f"Webserver running on port {PORT} in {mgr.server_mode} mode")
+            try:
+                httpd.serve_forever()
+            finally:
+                self.ready.clear()
+                self.httpd = None
+                # Release the handlers waiting on the channel, or closing the
+                # server would wait for their next photo change.
+                httpd.stop()
+                mgr.channel.wake()
+
+    def _run(self):
+        attempt = 0
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            try:
+                self._serve()
+            except Exception as e:
+                error(f"Webserver failed: {e}")
+            if self.stopping.is_set():
+                break
+            if time.monotonic() - started > SERVER_STABLE_SECS:
+                attempt = 0
+            delay = utils.backoff_delay(attempt, SERVER_RETRY_INTERVAL, MAX_SERVER_RETRY_INTERVAL)
+            attempt += 1
+            self.restarts += 1
+            info(f"Restarting webserver in {round(delay, 1)} seconds (restart #{self.restarts})")
+            self.stopping.wait(delay)
+
+    def stop(self):
+        """Stops accepting requests, releases any waiting /status requests, and
+        waits for the requests in progress to finish.
+        """
+        self.stopping.set()
+        httpd = self.httpd
+        if httpd:
+            httpd.stopping.set()
+            self.mgr.channel.wake()
+            httpd.stop()
+        if self.thread:
+            self.thread.join()
 
 
 class PhotoHandler(http.server.SimpleHTTPRequestHandler):
+    # Keep connections open between requests, so that the browser's polling
+    # doesn't set up a new connection every time. Every response must then
+    # have a Content-Length, be chunked, or close the connection.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without this, Nagle's algorithm
+    # holds the body back on a reused connection until the client's delayed
+    # ACK.
+    disable_nagle_algorithm = True
+    # Don't let an idle connection hold a handler thread forever.
+    timeout = 10
+
+    def setup(self):
+        super().setup()
+        HTTP_CONNECTIONS.inc()
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        if not self.server.keep_alive:
+            self.send_header("Connection", "close")
+
     def do_GET(self):
         debug(f"do_GET called; path={self.path}")
-        if self.path == "/status":
-            mgr = self.server.mgr
-            url = mgr.get_url()
-            start = time.time()
-            while not url:
-                if (time.time() - start) > BROWSER_CYCLE:
-                    url = mgr.get_last_url()
-                    break
-                time.sleep(1)
-                url = mgr.get_url()
-            mgr.clear_url()
-            self.send_response(200)
-            self.end_headers()
-            debug(f"Writing photo URL to browser: {url}")
-            self.wfile.write(enc(url))
+        HTTP_REQUESTS.inc()
+        if self.path.startswith("/status"):
+            self.send_status()
+        elif self.path.startswith("/events"):
+            self.send_events()
+        elif self.path.startswith("/health"):
+            self.send_health()
+        elif self.path.startswith("/metrics"):
+            self.send_metrics()
         elif self.path.startswith("/log"):
             debug("Log called!")
-            self.send_response(200)
-            self.end_headers()
-            content = get_log_content(self.path)
-            self.wfile.write(enc(content))
+            self.send_chunked(get_log_content(self.path), "text/html; charset=utf-8")
+        elif self.path.startswith(IMAGE_PATH):
+            self.send_image()
+        elif self.path.startswith(RENDITION_PATH):
+            self.send_rendition()
         else:
-            with open("main.html") as ff:
-                html = ff.read()
             debug("Writing HTML to browser")
+            self.send_asset(MAIN_PAGE)
+
+    def send_asset(self, pth):
+        """Sends a static file from memory, compressed if the browser accepts
+        it, or a 304 if the browser's copy is current.
+        """
+        asset = ASSETS.get(pth)
+        if not asset:
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match") == asset.etag:
+            self.send_response(304)
+            self.send_header("ETag", asset.etag)
+            self.end_headers()
+            return
+        body = asset.body
+        gzip_ok = "gzip" in self.headers.get("Accept-Encoding", "")
+        self.send_response(200)
+        self.send_header("Content-Type", asset.content_type)
+        if asset.gzipped and gzip_ok:
+            body = asset.gzipped
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", asset.etag)
+        self.send_header("Vary", "Accept-Encoding")
+        # Check back each time, since the page changes when the frame is
+        # updated; an unchanged page costs only a 304.
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunked(self, chunks, content_type):
+        """Sends the text from an iterator using chunked transfer encoding, so
+        the length doesn't have to be known up front and the connection can
+        still be reused.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            data = enc(chunk)
+            if data:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_health(self):
+        """Reports the watchdog's view of the frame, with a 503 status if any
+        component has stalled.
+        """
+        mgr = self.server.mgr
+        health = mgr.watchdog.status()
+        health["webserver"] = {
+            "ready": mgr.webserver.ready.is_set(),
+            "restarts": mgr.webserver.restarts,
+        }
+        body = enc(json.dumps(health))
+        self.send_response(200 if health["healthy"] else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self):
+        body = enc(metrics.render())
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def query_param(self, name):
+        query = urllib.parse.urlparse(self.path).query
+        return urllib.parse.parse_qs(query).get(name, [None])[0]
+
+    def get_cursor(self):
+        """Returns the sequence number of the last photo change the client has
+        seen, from either the 'since' query parameter or the Last-Event-ID
+        header that EventSource sends when it reconnects.
+        """
+        cursor = self.query_param("since") or self.headers.get("Last-Event-ID")
+        try:
+            return int(cursor)
+        except (TypeError, ValueError):
+            return 0
+
+    def send_status(self):
+        """Long-poll: waits for a photo change newer than the client's cursor, or
+        sends the current photo after BROWSER_CYCLE seconds. With 'format=json',
+        the body is the channel's message, with the upcoming URLs; otherwise it's
+        just the current URL.
+        """
+        channel = self.server.mgr.channel
+        with STATUS_WAIT_SECONDS.time():
+            channel.wait(self.get_cursor(), BROWSER_CYCLE, self.server.stopping)
+        message = channel.message()
+        if self.query_param("format") == "json":
+            ctype, body = "application/json", json.dumps(message)
+        else:
+            ctype, body = "text/plain", message["url"]
+        body = enc(body)
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("X-Photo-Seq", str(message["seq"]))
+        self.end_headers()
+        debug(f"Writing photo URL to browser: {message['url']}")
+        self.wfile.write(body)
+
+    def send_events(self):
+        """Server-Sent Events stream of photo changes. Each event's id is its
+        sequence number, so a reconnecting browser resumes where it left off, and
+        its data is the channel's message as JSON, so that the browser can load
+        the next photo ahead of time.
+
+        When the server can't stream, the latest change is sent right away
+        instead of waiting for one, so that the server's only thread is free
+        for other requests.
+        """
+        channel = self.server.mgr.channel
+        cursor = self.get_cursor()
+        stopping = self.server.stopping
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # The stream only ends when the connection does.
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            self.wfile.write(enc(f"retry: {EVENT_RETRY_MS}\n\n"))
+            if not self.server.streaming:
+                message = channel.message()
+                if message["seq"] != cursor:
+                    self.write_event(message)
+                return
+            if cursor > channel.current()[0]:
+                # The browser saw changes from before the frame restarted, so
+                # it is sent everything since.
+                cursor = 0
+            while not stopping.is_set():
+                seq, url = channel.wait(cursor, BROWSER_CYCLE, stopping)
+                if seq > cursor:
+                    message = channel.message()
+                    self.write_event(message)
+                    cursor = message["seq"]
+                else:
+                    # Keep the connection from looking idle
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            debug("Event stream closed by browser")
+
+    def write_event(self, message):
+        debug(f"Sending photo event {message['seq']} to browser: {message['url']}")
+        self.wfile.write(enc(f"id: {message['seq']}\ndata: {json.dumps(message)}\n\n"))
+        self.wfile.flush()
+
+    def send_image(self):
+        mgr = self.server.mgr
+        fname = urllib.parse.unquote(self.path[len(IMAGE_PATH) :].split("?")[0])
+        pth = mgr.cache.get(fname) if mgr.cache.is_valid_name(fname) else None
+        if not pth:
+            # Not (or no longer) cached, so send the browser to the CDN
+            debug(f"Image '{fname}' not cached; redirecting")
+            self.send_response(302)
+            self.send_header("Location", os.path.join(mgr.dl_url, fname))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_file(pth, "max-age=86400")
+
+    def send_rendition(self):
+        mgr = self.server.mgr
+        key = self.path[len(RENDITION_PATH) :].split("?")[0].split(".")[0]
+        if not key.isalnum() or not mgr.renditions.has(key):
+            self.send_error(404)
+            return
+        # A rendition's content never changes for its key.
+        self.send_file(mgr.renditions.path_for(key), "max-age=31536000, immutable")
+
+    def send_file(self, pth, cache_control):
+        try:
+            ff = open(pth, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with ff:
+            ctype = mimetypes.guess_type(pth)[0] or "application/octet-stream"
             self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(os.fstat(ff.fileno()).st_size))
+            self.send_header("Cache-Control", cache_control)
             self.end_headers()
-            self.wfile.write(enc(html))
+            shutil.copyfileobj(ff, self.wfile)
 
 
 class ImageManager(object):
-    def __init__(self):
+    """Runs a frame.
+
+    With `headless`, there is no webserver, monitor control or watchdog thread,
+    and nothing is saved to disk, so that many instances can run in one process
+    under the simulator. `scheduler` replaces the frame's own Scheduler; the
+    simulator passes one that runs on an accelerated clock.
+    """
+
+    def __init__(self, scheduler=None, headless=False):
+        self._init_time = time.monotonic()
+        self.first_photo_secs = None
         self._started = False
-        self._in_read_config = False
+        self.config_lock = RLock()
+        self.headless = headless
+        # The screen size from xrandr, once it's known
+        self.detected_size = None
+        self.scheduler = scheduler or Scheduler()
+        self.scheduler.start()
+        self.config_file = ConfigFile(self.scheduler)
+        self.snapshot = Snapshot(self.scheduler)
+        self.watchdog = Watchdog()
+        self.watchdog.register("scheduler", SCHEDULER_TIMEOUT, restart=self.scheduler.restart)
+        self.watchdog.register("photo_timer", TIMER_GRACE, restart=self.set_timer, active=False)
+        self.watchdog.register("watch", WATCH_TIMEOUT, active=False)
+        if not headless:
+            self.watchdog.start()
+        self.scheduler.schedule(SCHEDULER_BEAT, self._scheduler_beat)
         self.photo_timer = None
         self.timer_start = None
-        self.photo_url = ""
-        self.last_url = ""
+        self.channel = PhotoChannel()
         self._show_start = None
-        self._read_config()
+        self.cache = None
+        self.webserver = ServerSupervisor(self)
+        self.session = requests.Session()
+        self.session.headers["user-agent"] = "photoviewer"
+        # When there is a snapshot of the last known state, start from that, and
+        # catch up with etcd and the registration server in the background.
+        snapshot = {} if headless else self.snapshot.read()
+        self._read_config(settings=snapshot.get("settings"))
+        self.cache = ImageCache(
+            self.dl_url,
+            max_bytes=self.cache_max_bytes,
+            reserve_bytes=self.cache_reserve_bytes,
+            on_cached=self._image_cached,
+        )
+        self.renditions = RenditionStore()
+        self.renderer = Renderer(
+            self.renditions, self.render_workers, self.render_worker_mb, self.render_image_mb
+        )
         self.initial_interval = self._set_start()
-        self._set_power_on()
+        self.cec = proc.CecClient()
+        if not headless:
+            Thread(target=self._set_power_on, name="power_on", daemon=True).start()
         self.in_check_host = False
-        self.image_list = []
+        self.rotation = Rotation(state=snapshot.get("rotation"))
+        # Headless frames keep their stats in memory.
+        self.stats = DisplayStats(None, None) if headless else DisplayStats()
+        if self.selection_mode == "weighted":
+            self.selector = WeightedSelector(
+                self.rotation, self.stats, self.candidates, state=snapshot.get("selector")
+            )
+        else:
+            self.selector = self.rotation
+        # Identifies the version of the image list we have to the server
+        self.list_version = snapshot.get("list_version")
         self.displayed_name = ""
-        self.image_index = 0
-        self._register()
-        self.start_server()
+        if self.rotation:
+            info(f"Starting from snapshot with {len(self.rotation)} images")
+            Thread(target=self._reconcile, name="reconcile", daemon=True).start()
+        else:
+            self._register()
+            self.save_snapshot()
+        if not headless:
+            self.start_server()
+            self._add_metrics()
+
+    def _add_metrics(self):
+        """Adds the gauges that are read when the metrics are scraped."""
+        metrics.gauge(
+            "photoviewer_uptime_seconds",
+            "Seconds since the frame started",
+            lambda: time.monotonic() - self._init_time,
+        )
+        metrics.gauge("photoviewer_images", "Images in the rotation", lambda: len(self.rotation))
+        metrics.gauge(
+            "photoviewer_cache_bytes",
+            "Bytes used by the image cache",
+            lambda: self.cache.total_bytes,
+        )
+        metrics.gauge(
+            "photoviewer_webserver_restarts",
+            "Times the webserver was restarted",
+            lambda: self.webserver.restarts,
+        )
+        metrics.gauge(
+            "photoviewer_scheduled_jobs", "Jobs waiting in the scheduler", self.scheduler.pending
+        )
 
     def start(self):
         self._set_signals()
         self.set_timer()
         debug("In start(); checking webserver")
-        while not self.check_webserver():
-            debug("Port not listening; restarting webserver")
-            time.sleep(2)
+        while not self.webserver.ready.wait(SERVER_START_TIMEOUT):
+            info("Still waiting for the webserver to start listening")
+            self.check_webserver()
         self._started = True
+        self.render_images()
         self.show_photo()
         self.main_loop()
 
@@ -127,26 +688,55 @@ class ImageManager(object):
         debug("Power State:", power_state)
         self._set_power_state(power_state)
         callback = self.process_event
-        utils.watch(self.watch_key, callback)
+        self.watchdog.beat("watch")
+        utils.watch(self.watch_key, callback, heartbeat=lambda: self.watchdog.beat("watch"))
         # Shouldn't reach here.
         sys.exit(0)
 
     def start_server(self):
-        t = Thread(target=run_webserver, args=(self,))
-        t.start()
-        debug("Webserver started")
-        time.sleep(5)
-        self.check_webserver()
+        self.webserver.start()
+        if self.webserver.ready.wait(SERVER_START_TIMEOUT):
+            debug("Webserver started")
+        else:
+            error("Webserver did not start listening")
+
+    def _reconcile(self):
+        """Brings the state loaded from the snapshot up to date with etcd and
+        the registration server.
+        """
+        self._refresh_settings()
+        self._register()
+        self.save_snapshot()
+        info("Finished reconciling with the servers")
+
+    def save_snapshot(self):
+        """Saves the frame's state shortly; see Snapshot."""
+        if self.headless:
+            return
+        # Held so that the names, their version and the position in them all
+        # come from the same image list.
+        with self.rotation.lock:
+            state = {
+                "settings": self.settings.as_dict(),
+                "rotation": self.rotation.state(),
+                "selector": self.selector.state(),
+                "list_version": self.list_version,
+            }
+            self.snapshot.save(state, self.rotation.names, self.rotation.version)
 
     def _set_power_on(self):
         # Power on the monitor and HDMI output
         debug("Powering on the monitor")
-        out, err = runproc(MONITOR_CMD)
-        debug("Power result", out.strip(), err.strip())
+        try:
+            self.cec.power_on()
+        except proc.CecError as e:
+            error(f"Could not power on the monitor: {e}")
+            return
+        debug("Monitor powered on")
 
     def _set_start(self):
         now = datetime.datetime.now()
-        base_hour, base_minute = self.interval_base.split(":")
+        base_hour, base_minute = self.settings.interval_base.split(":")
         start_hour = now.hour if base_hour == "*" else int(base_hour)
         if base_minute == "*":
             start_minute = now.minute
@@ -178,60 +768,58 @@ class ImageManager(object):
         return offset_secs if offset_secs > 0 else 0
 
     def _calc_interval(self):
-        if self.use_halflife:
-            # Check every minute
-            debug(f"Halflife interval of {self.interval} seconds; setting check in 60 seconds")
-            return 60
+        if self.settings.use_halflife:
+            return halflife_delay(self.interval)
         else:
-            diff = self.interval * (self.variance_pct / 100)
+            diff = self.interval * (self.settings.variance_pct / 100)
             return round(random.uniform(self.interval - diff, self.interval + diff))
 
     def set_timer(self, start=True):
         interval = self._calc_interval()
         if self.photo_timer:
             self.photo_timer.cancel()
-        self.photo_timer = Timer(interval, self.on_timer_expired)
+            self.photo_timer = None
         debug(
-            f"{'Halflife' if self.use_halflife else 'Variance'} timer {id(self.photo_timer)} "
-            f"created with interval {interval}"
+            f"{'Halflife' if self.settings.use_halflife else 'Variance'} timer set with interval "
+            f"{interval}"
+        )
+        next_change = datetime.datetime.now() + datetime.timedelta(seconds=interval)
+        info(
+            f"New interval: {utils.human_time(interval)}. Next photo change scheduled for "
+            f"{next_change.strftime('%H:%M:%S')}"
         )
-        if not self.use_halflife:
-            next_change = datetime.datetime.now() + datetime.timedelta(seconds=interval)
-            info(
-                f"New interval: {utils.human_time(interval)}. Next photo change scheduled for "
-                f"{next_change.strftime('%H:%M:%S')}"
-            )
         if start:
-            self.photo_timer.start()
+            self.photo_timer = self.scheduler.schedule(
+                interval, self.on_timer_expired, name="photo_timer"
+            )
             self.timer_start = time.time()
-            log_mthd = debug if self.use_halflife else info
-            log_mthd("Timer started")
+            self.watchdog.beat("photo_timer", interval + TIMER_GRACE)
+            info("Timer started")
 
     def on_timer_expired(self):
-        log_mthd = debug if self.use_halflife else info
-        log_mthd("Timer Expired")
-        if self.use_halflife:
-            return self.check_halflife_expired()
+        info("Timer Expired")
+        if self.photo_timer:
+            TIMER_DRIFT_SECONDS.observe(self.scheduler.clock() - self.photo_timer.when)
+        self.photo_timer = None
         self.reset_timer()
 
     def reset_timer(self):
-        self._register(heartbeat=True)
-        self.check_webserver()
-        self.navigate()
+        try:
+            self._register()
+            self.check_webserver()
+            self.navigate()
+        finally:
+            if not self.photo_timer:
+                # navigate() didn't set a new timer, either because there are
+                # no images or because it failed.
+                self.set_timer()
 
-    def check_halflife_expired(self):
-        interval_minutes = self.interval / 60
-        threshold = HALFLIFE_FACTOR / interval_minutes
-        rand_num = random.random()
-        debug(f"Halflife threshold: {threshold}; val: {rand_num}")
-        if rand_num < threshold:
-            # Halflife triggered!
-            self.reset_timer()
-        else:
-            self.set_timer()
+    def _scheduler_beat(self):
+        self.watchdog.beat("scheduler")
+        self.scheduler.schedule(SCHEDULER_BEAT, self._scheduler_beat)
 
     def _set_signals(self):
-        signal.signal(signal.SIGHUP, self._read_config)
+        signal.signal(signal.SIGHUP, self._on_sighup)
         signal.signal(signal.SIGTSTP, self.pause)
         signal.signal(signal.SIGCONT, self.resume)
         signal.signal(signal.SIGTRAP, self.navigate)
@@ -254,17 +842,15 @@ class ImageManager(object):
         self._update_config(val)
 
     def _set_images(self, val):
-        self.image_list = val
+        self.rotation.set_images(val)
         self.navigate()
 
     def _reboot(self, val):
-        cmd = "/usr/bin/sudo reboot now"
         info("reboot called")
-        runproc(cmd, wait=False)
+        proc.spawn(["/usr/bin/sudo", "reboot", "now"])
 
     def process_event(self, key, val):
-        info("process_event called; clearing heartbeat flag")
-        utils.clear_heartbeat_flag()
+        info("process_event called")
         actions = {
             "power_state": self._set_power_state,
             "change_photo": self._change_photo,
@@ -280,63 +866,50 @@ class ImageManager(object):
         mthd(val)
 
     def pause(self, signum=None, frame=None):
-        self.photo_timer.cancel()
+        if self.photo_timer:
+            self.photo_timer.cancel()
+            self.photo_timer = None
+        self.watchdog.suspend("photo_timer")
         info("Photo timer stopped")
 
     def resume(self, signum=None, frame=None):
         self.set_timer()
         info("Photo timer started")
 
-    def _read_config(self, signum=None, frame=None):
-        if self._in_read_config:
-            # Another process already called this
-            return
-        self._in_read_config = True
+    def _on_sighup(self, signum=None, frame=None):
+        """Re-reads photo.cfg right away, and the settings from etcd in the
+        background, so that the signal handler never waits on the network.
+        """
+        self._read_config(settings=self.settings.as_dict())
+        Thread(target=self._refresh_settings, name="refresh_settings", daemon=True).start()
+
+    def _refresh_settings(self):
+        """Reads the frame's settings from etcd, and applies them if they have
+        changed.
+        """
+        data = utils.read_key(f"{self.watch_key}settings")
+        if data and Settings(data) != self.settings:
+            info("Settings in etcd have changed; updating")
+            self._read_config(settings=data)
+
+    def _read_config(self, signum=None, frame=None, settings=None):
+        """Reads photo.cfg, and the frame's settings from etcd unless `settings`
+        is passed.
+        """
+        with self.config_lock:
+            self._apply_config(settings)
+
+    def _apply_config(self, settings):
         info("_read_config called!")
-        parser = utils.parse_config_file()
+        parser = self._parse_config()
 
         self.pkid = utils.safe_get(parser, "frame", "pkid")
         self.watch_key = BASE_KEY.format(pkid=self.pkid)
-        settings_key = f"{self.watch_key}settings"
-        settings = utils.read_key(settings_key)
-        if settings:
-            self.log_level = settings.get("log_level", "INFO")
-            self.name = settings.get("name", "undefined")
-            self.description = settings.get("description", "")
-            self.orientation = settings.get("orientation", "H")
-            # When to start the image rotation
-            self.interval_base = settings.get("interval_base", "*:*")
-            # How often to change image
-            self.interval_time = int(settings.get("interval_time", 10))
-            # Units of time for the image change interval
-            self.interval_units = settings.get("interval_units", "minutes")
-            # Percentage to vary the display time from photo to photo
-            self.variance_pct = int(settings.get("variance_pct", 0))
-            # Do we use halflife decay pattern for the interval?
-            self.use_halflife = bool(settings.get("use_halflife", False))
-            self.brightness = settings.get("brightness", 1.0)
-            self.contrast = settings.get("contrast", 1.0)
-            self.saturation = settings.get("saturation", 1.0)
-        else:
-            self.log_level = "INFO"
-            self.name = "undefined"
-            self.description = ""
-            self.orientation = "H"
-            # When to start the image rotation
-            self.interval_base = "*:*"
-            # How often to change image
-            self.interval_time = 10
-            # Units of time for the image change interval
-            self.interval_units = "minutes"
-            # Percentage to vary the display time from photo to photo
-            self.variance_pct = 0
-            # Do we use halflife decay pattern for the interval?
-            self.use_halflife = False
-            self.brightness = 1.0
-            self.contrast = 1.0
-            self.saturation = 1.0
-
-        utils.set_log_level(self.log_level)
+        if settings is None:
+            settings_key = f"{self.watch_key}settings"
+            settings = utils.read_key(settings_key)
+        self.settings = Settings(settings)
+        utils.set_log_level(self.settings.log_level)
         self.reg_url = utils.safe_get(parser, "host", "reg_url")
         if not self.reg_url:
             error("No registration URL in photo.cfg; exiting")
@@ -345,9 +918,42 @@ class ImageManager(object):
         if not self.dl_url:
             error("No download URL configured in photo.cfg; exiting")
             sys.exit()
-        self.interval = utils.normalize_interval(self.interval_time, self.interval_units)
+        self.cache_max_bytes = int(utils.safe_get(parser, "cache", "max_mb", MAX_CACHE_MB)) * MB
+        self.cache_reserve_bytes = (
+            int(utils.safe_get(parser, "cache", "reserve_mb", RESERVE_MB)) * MB
+        )
+        self.prefetch_count = int(utils.safe_get(parser, "cache", "prefetch", PREFETCH_COUNT))
+        self.server_mode = utils.safe_get(parser, "server", "mode", SERVER_MODE)
+        self.max_connections = int(
+            utils.safe_get(parser, "server", "max_connections", MAX_CONNECTIONS)
+        )
+        workers = utils.safe_get(parser, "render", "workers")
+        self.render_workers = int(workers) if workers else None
+        self.render_worker_mb = int(utils.safe_get(parser, "render", "worker_mb", WORKER_MB))
+        self.render_image_mb = int(utils.safe_get(parser, "render", "max_image_mb", MAX_IMAGE_MB))
+        size = display_size(parser, detect=False)
+        if not size and not self.headless:
+            self.detected_size = self.detected_size or display_size(parser)
+            size = self.detected_size
+        self.render_output = output_spec(
+            size,
+            utils.safe_get(parser, "render", "format"),
+            utils.safe_get(parser, "render", "quality"),
+        )
+        self.selection_mode = utils.safe_get(parser, "selection", "mode", SELECTION_MODE)
+        self.candidates = int(utils.safe_get(parser, "selection", "candidates", CANDIDATES))
+        if self.cache:
+            self.cache.set_limits(self.cache_max_bytes, self.cache_reserve_bytes)
+        self.interval = self.settings.interval
         self.set_image_interval()
-        self._in_read_config = False
+
+    def _parse_config(self):
+        return self.config_file.read()
+
+    def _save_config(self, parser):
+        if self.headless:
+            return
+        self.config_file.save(parser)
 
     def set_image_interval(self):
         if not self.photo_timer:
@@ -355,94 +961,96 @@ class ImageManager(object):
             return
         self.set_timer()
 
-    def _register(self, heartbeat=False):
-        if heartbeat:
-            # Set the heartbeat flag
-            info("Setting heartbeat file...")
-            utils.set_heartbeat_flag()
-        headers = {"user-agent": "photoviewer"}
+    def _register(self):
+        headers = {}
         # Get free disk space
         freespace = get_freespace()
         data = {
             "pkid": self.pkid,
             "freespace": freespace,
         }
-        resp = requests.post(self.reg_url, data=data, headers=headers)
+        if self.list_version and self.rotation:
+            # Let the server tell us that nothing has changed, or send only the
+            # changes.
+            data["version"] = self.list_version
+            headers["If-None-Match"] = self.list_version
+        try:
+            with REGISTER_SECONDS.time():
+                resp = self.session.post(
+                    self.reg_url, data=data, headers=headers, timeout=REGISTER_TIMEOUT
+                )
+        except requests.RequestException as e:
+            REGISTER_FAILURES.inc()
+            error(f"Registration failed: {e}")
+            return
+        REGISTER_BYTES.observe(len(resp.content))
+        if resp.status_code == 304:
+            debug("Image list not modified")
+            return
         if 200 <= resp.status_code <= 299:
             # Success!
-            pkid, images = resp.json()
-            if pkid != self.pkid:
-                parser = utils.parse_config_file()
-                parser.set("frame", "pkid", pkid)
-                with open(CONFIG_FILE, "w") as ff:
-                    parser.write(ff)
-            self.image_list = images
-            random.shuffle(self.image_list)
+            self._process_registration(resp)
         else:
             error(resp.status_code, resp.text)
             sys.exit()
 
+    def _process_registration(self, resp):
+        """The server responds with either the original [pkid, images] list, or a
+        dict with 'pkid' and 'version', along with either the full 'images' list
+        or the 'added' and 'removed' images since the version we sent.
+        """
+        payload = resp.json()
+        if isinstance(payload, list):
+            pkid, images = payload
+            payload = {"pkid": pkid, "images": images}
+        pkid = payload.get("pkid")
+        if pkid and pkid != self.pkid:
+            parser = self._parse_config()
+            parser.set("frame", "pkid", pkid)
+            self._save_config(parser)
+        if "images" in payload:
+            self.rotation.set_images(payload["images"])
+        else:
+            added, removed = payload.get("added", []), payload.get("removed", [])
+            if added or removed:
+                info(f"Image list changed: {len(added)} added, {len(removed)} removed")
+                self.rotation.update(added, removed)
+        self.list_version = resp.headers.get("ETag") or payload.get("version")
+
     @staticmethod
     def check_webbrowser():
         if not utils.check_browser():
             info("Web browser not running; restarting")
-            utils.start_browser()
+            utils.start_browser(LOCAL_URL)
 
     def check_webserver(self):
-        if not utils.check_port(PORT):
-            debug("AAAAHHHHHHH!!!!!!!!")
-            info("Webserver port not listening; restarting")
-            time.sleep(3)
-            self.start_server()
+        """The supervisor restarts the webserver itself; this only has to make
+        sure that the supervisor is still running.
+        """
+        if self.headless:
+            return True
+        if not self.webserver.alive():
+            info("Webserver supervisor not running; restarting it")
+            self.webserver.start()
             return False
         return True
 
     def navigate(self, signum=None, forward=True, frame=None):
         """Moves to the next image."""
-        debug("navigate called; current index", self.image_index)
-
-        num_images = len(self.image_list)
-        if not num_images:
+        if not self.rotation:
             # Currently no images specified for this display, so just return.
             return
-        delta = 1 if forward else -1
-        new_index = self.image_index + delta
-        # Boundaries
-        max_index = len(self.image_list) - 1
-        min_index = 0
-        if new_index > max_index:
-            new_index = 0
-            # Shuffle the images
-            info("All images shown; shuffling order.")
-            random.shuffle(self.image_list)
-        elif new_index < min_index:
-            new_index = max_index
-        else:
-            new_index = max(0, min(max_index, new_index))
-        debug("image index", self.image_index)
-        debug("new index", new_index)
-        if new_index != self.image_index:
-            self.image_index = new_index
-            self.show_photo()
-        elif new_index == 0:
-            self.show_photo()
+        fname = self.selector.step(forward)
+        debug("navigate called; new image", fname)
+        self.show_photo()
         self.set_timer()
 
     def show_photo(self):
         if not self._started:
             return
-        if not self.image_list:
+        fname = self.selector.current()
+        if not fname:
             return
-        try:
-            fname = self.image_list[self.image_index]
-        except IndexError as e:
-            error("BAD INDEX", e)
-            if self.image_list:
-                fname = self.image_list[-1]
-            else:
-                # Something's screwy
-                error("No images!")
-                return
 
         if fname == self.displayed_name:
             return
@@ -457,65 +1065,120 @@ class ImageManager(object):
                 f"Halflife: changing photo after {utils.human_time(elapsed.seconds)} seconds; "
                 f"halflife={utils.human_time(self.interval)}"
             )
+        self._record_stats(fname)
         self._show_start = datetime.datetime.now()
-        self.photo_url = self.last_url = os.path.join(self.dl_url, fname)
+        self.displayed_name = fname
+        self.channel.publish(self.image_url(fname), self.upcoming_urls())
+        PHOTO_CHANGES.inc()
+        if self.first_photo_secs is None:
+            self.first_photo_secs = time.monotonic() - self._init_time
+            info(f"Time to first photo: {utils.human_time(self.first_photo_secs)}")
+        self.prefetch()
+        self.save_snapshot()
+
+    def _record_stats(self, fname):
+        """Adds the time on screen of the photo being replaced, and counts the
+        new one as shown.
+        """
+        if self.displayed_name and self._show_start:
+            on_screen = datetime.datetime.now() - self._show_start
+            self.stats.add_seconds(self.displayed_name, on_screen.total_seconds())
+        self.stats.record_shown(fname, time.time())
+
+    def image_url(self, fname):
+        """Returns the URL for the image. This is its rendition for the current
+        monitor profile if one exists, or else the original if it has already
+        been downloaded; both are served locally.
+        """
+        url = self.rendition_url(fname)
+        if url:
+            return url
+        if self.cache.get(fname):
+            return f"{LOCAL_URL}{IMAGE_PATH}{urllib.parse.quote(fname)}"
+        # Make sure that it's available the next time it comes around.
+        self.cache.prefetch([fname])
+        return os.path.join(self.dl_url, fname)
+
+    def rendition_url(self, fname):
+        key = self.renditions.lookup(
+            fname, self.profile, self.settings.orientation, self.render_output
+        )
+        return f"{LOCAL_URL}{RENDITION_PATH}{self.renditions.filename(key)}" if key else None
 
-    def get_url(self):
-        return self.photo_url
+    def upcoming_urls(self):
+        """Returns the local URLs of the next few images, for the browser to load
+        ahead of time. An image that isn't cached yet is redirected to the
+        download host when the browser asks for it.
+        """
+        return [
+            self.rendition_url(fname) or f"{LOCAL_URL}{IMAGE_PATH}{urllib.parse.quote(fname)}"
+            for fname in self.selector.upcoming(UPCOMING_URLS)
+        ]
+
+    def render_images(self):
+        """Renders the cached images with the current monitor profile in the
+        background.
+        """
+        self.renderer.start(*self.settings.profile, self.settings.orientation, self.render_output)
+
+    def _image_cached(self, fname):
+        """Renders a newly downloaded image, so that it isn't shown without the
+        monitor profile until the next full run.
+        """
+        self.renderer.add(fname)
 
-    def get_last_url(self):
-        return self.last_url
+    @property
+    def profile(self):
+        return self.settings.profile
 
-    def clear_url(self):
-        self.photo_url = ""
+    def prefetch(self):
+        """Starts downloading the next few images in the rotation."""
+        upcoming = self.selector.upcoming(self.prefetch_count)
+        if upcoming:
+            self.cache.prefetch(upcoming)
 
     def _update_config(self, data):
-        changed = False
-        new_interval = False
-        parser = utils.parse_config_file()
-        if "log_level" in data:
-            self.log_level = data["log_level"]
-            utils.set_log_level(self.log_level)
-        for key in (
-            "name",
-            "description",
-            "interval_time",
-            "interval_units",
-            "variance_pct",
-            "brightness",
-            "contrast",
-            "saturation",
-        ):
-            val = data.get(key, None)
-            debug("key:", key, "; val:", val)
-            if val is None:
-                continue
-            local_val = getattr(self, key)
-            if local_val != val:
-                try:
-                    typ = type(local_val)
-                    converted = typ(val)
-                except Exception:
-                    pass
-                setattr(self, key, converted)
-                monitor_keys = ("brightness", "contrast", "saturation")
-                section = "monitor" if key in monitor_keys else "frame"
-                parser.set(section, key, str(val))
-                changed = True
-                new_interval = new_interval or "interval" in key
-        if changed:
-            with open(CONFIG_FILE, "w") as ff:
-                parser.write(ff)
-        if new_interval:
-            self.interval = utils.normalize_interval(self.interval_time, self.interval_units)
+        with self.config_lock:
+            changed = self.settings.update(data)
+        if not changed:
+            return
+        if "log_level" in changed:
+            utils.set_log_level(self.settings.log_level)
+        saved = [key for key in changed if key in SAVED_SETTINGS]
+        if saved:
+            parser = self._parse_config()
+            for key in saved:
+                section = "monitor" if key in PROFILE_SETTINGS else "frame"
+                if not parser.has_section(section):
+                    parser.add_section(section)
+                parser.set(section, key, str(getattr(self.settings, key)))
+            self._save_config(parser)
+        self.save_snapshot()
+        if any(key in TIMER_SETTINGS for key in changed):
+            self.interval = self.settings.interval
             info("Setting timer to", self.interval)
             self.set_image_interval()
+        # Renditions are made for the orientation, too.
+        if any(key in PROFILE_SETTINGS or key == "orientation" for key in changed):
+            info("Monitor profile changed; rendering images")
+            self.render_images()
 
     def kill_timer(self):
         """Kills the photo timer on receiving a Ctrl-C."""
         info("Killing timer")
-        self.photo_timer.cancel()
+        if self.photo_timer:
+            self.photo_timer.cancel()
+        self.watchdog.stop()
+        self.scheduler.stop()
         info("Timer canceled")
+        self.stats.flush()
+        self.config_file.flush()
+        self.snapshot.flush()
+
+    def stop_webserver(self):
+        info("Stopping webserver")
+        self.webserver.stop()
+        info("Webserver stopped")
 
 
 if __name__ == "__main__":
@@ -527,3 +1190,5 @@ if __name__ == "__main__":
         img_mgr.start()
     except KeyboardInterrupt:
         img_mgr.kill_timer()
+        img_mgr.stop_webserver()
+        img_mgr.cec.close()
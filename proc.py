@@ -0,0 +1,216 @@
+"""Process and display control without going through a shell.
+
+This only uses the standard library, so that check_heartbeat.py can import it
+without paying for the photoviewer's dependencies.
+"""
+
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+
+PROC_ROOT = "/proc"
+CEC_CLIENT = "/usr/bin/cec-client"
+# How long to wait for cec-client to open the adapter
+CEC_START_TIMEOUT = 15
+# How long to wait for the response to a CEC command
+CEC_TIMEOUT = 5
+CEC_READY = "waiting for input"
+POWER_STATUS_PAT = re.compile(r"power status:\s*(\S+)")
+XRANDR = "xrandr"
+# xrandr's screen line gives the current size, after any rotation.
+SCREEN_SIZE_PAT = re.compile(r"current (\d+) x (\d+)")
+
+
+class CecError(Exception):
+    pass
+
+
+def iter_processes(proc_root=PROC_ROOT):
+    """Yields (pid, name, command line) for each running process, read from
+    the /proc tree. Processes that exit while being read are skipped.
+    """
+    for entry in os.scandir(proc_root):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "comm")) as ff:
+                name = ff.read().strip()
+            with open(os.path.join(entry.path, "cmdline"), "rb") as ff:
+                cmdline = [arg.decode("utf-8", "replace") for arg in ff.read().split(b"\0") if arg]
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+        yield int(entry.name), name, cmdline
+
+
+def find_processes(name, proc_root=PROC_ROOT):
+    """Returns the pids of the processes whose name contains `name`, like
+    `pgrep name` does.
+    """
+    return [pid for pid, comm, cmdline in iter_processes(proc_root) if name in comm]
+
+
+def is_running(name, proc_root=PROC_ROOT):
+    return bool(find_processes(name, proc_root))
+
+
+def run(args, timeout=None, env=None):
+    """Runs the command and returns its (stdout, stderr). `args` is a list, so
+    no shell is involved; a string is only run through the shell for
+    commands that need one.
+    """
+    result = subprocess.run(
+        args,
+        shell=isinstance(args, str),
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        timeout=timeout,
+        env=env,
+    )
+    return result.stdout.decode("utf-8"), result.stderr.decode("utf-8")
+
+
+def spawn(args):
+    """Starts the command in its own session without waiting for it, and
+    returns the Popen object.
+    """
+    return subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def display_size(display=":0", timeout=5):
+    """Returns the (width, height) of the X screen from xrandr, or None if it
+    can't be found. `display` is used if DISPLAY isn't set, as it isn't for
+    the service.
+    """
+    env = dict(os.environ)
+    env.setdefault("DISPLAY", display)
+    try:
+        out, err = run([XRANDR, "--current"], timeout=timeout, env=env)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    mtch = SCREEN_SIZE_PAT.search(out)
+    if not mtch:
+        return None
+    return int(mtch.group(1)), int(mtch.group(2))
+
+
+class CecClient(object):
+    """A single long-running cec-client, so that each HDMI-CEC command is just
+    a line written to its stdin instead of a new shell and a new cec-client
+    that has to open the adapter all over again.
+
+    Its output is read by a thread into a queue, and commands that expect a
+    response wait for a matching line. If the process dies, it is started
+    again for the next command.
+    """
+
+    def __init__(self, binary=CEC_CLIENT, timeout=CEC_TIMEOUT, start_timeout=CEC_START_TIMEOUT):
+        self.binary = binary
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.lock = threading.Lock()
+        self.proc = None
+        self.lines = None
+
+    def _start(self):
+        self.lines = queue.Queue()
+        try:
+            self.proc = subprocess.Popen(
+                [self.binary, "-d", "1"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                bufsize=1,
+                universal_newlines=True,
+            )
+        except OSError as e:
+            self.proc = None
+            raise CecError(f"Could not start {self.binary}: {e}")
+        threading.Thread(
+            target=self._read_output, args=(self.proc, self.lines), name="cec", daemon=True
+        ).start()
+        try:
+            self._wait_for(lambda line: CEC_READY in line, self.start_timeout)
+        except CecError:
+            # Don't send commands to a cec-client that never became ready.
+            self.close()
+            raise
+
+    @staticmethod
+    def _read_output(proc, lines):
+        for line in proc.stdout:
+            lines.put(line.rstrip("\n"))
+        # None marks the end of the output.
+        lines.put(None)
+
+    def _wait_for(self, matcher, timeout):
+        """Returns the result of `matcher` for the first output line it is truthy
+        for.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CecError("Timed out waiting for cec-client")
+            try:
+                line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if line is None:
+                self.close()
+                raise CecError("cec-client exited")
+            result = matcher(line)
+            if result:
+                return result
+
+    def send(self, command, expect=None, timeout=None):
+        """Sends a command, such as 'on 0'. If `expect` is a compiled pattern,
+        waits for an output line that matches it, and returns the match.
+        """
+        with self.lock:
+            if not self.proc or self.proc.poll() is not None:
+                self._start()
+            # Drop any output left over from earlier commands.
+            while not self.lines.empty():
+                if self.lines.get_nowait() is None:
+                    self.close()
+                    self._start()
+            try:
+                self.proc.stdin.write(f"{command}\n")
+                self.proc.stdin.flush()
+            except OSError as e:
+                self.close()
+                raise CecError(f"Could not send '{command}': {e}")
+            if expect is None:
+                return None
+            return self._wait_for(expect.search, timeout or self.timeout)
+
+    def power_on(self, address=0):
+        self.send(f"on {address}")
+
+    def standby(self, address=0):
+        self.send(f"standby {address}")
+
+    def power_status(self, address=0):
+        """Returns the device's power status, such as 'on' or 'standby'."""
+        return self.send(f"pow {address}", expect=POWER_STATUS_PAT).group(1)
+
+    def close(self):
+        proc, self.proc = self.proc, None
+        if not proc:
+            return
+        try:
+            proc.stdin.write("q\n")
+            proc.stdin.flush()
+            proc.wait(timeout=self.timeout)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            proc.kill()
+            proc.wait()
@@ -0,0 +1,429 @@
+"""Pre-renders the cached images with the monitor profile applied, so that the
+corrections don't have to be made when a photo is shown. The results are kept
+in the RenditionStore.
+
+Run directly to render the whole images directory:
+
+    python render.py [--workers N] [--force]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import resource
+import sys
+import threading
+import time
+
+import image
+import metrics
+import proc
+from renditions import make_key, RenditionStore
+import utils
+from utils import debug, error, info
+
+# Default limit on the address space of each worker process
+WORKER_MB = 768
+MB = 1024 * 1024
+MEMINFO = "/proc/meminfo"
+# Save the index after this many renditions, so a crash loses little work
+SAVE_EVERY = 20
+ADJUST_SECONDS = metrics.histogram(
+    "photoviewer_adjust_seconds", "Time taken to adjust and save one image"
+)
+WORKER_PEAK_RSS = metrics.gauge(
+    "photoviewer_render_worker_peak_rss_bytes", "Highest peak RSS of any render worker"
+)
+RENDER_FAILURES = metrics.counter(
+    "photoviewer_render_failures_total", "Images that failed to render"
+)
+
+
+def _source_files(image_dir):
+    with os.scandir(image_dir) as entries:
+        return sorted(
+            entry.name
+            for entry in entries
+            if entry.is_file()
+            and not entry.name.startswith(".")
+            and not entry.name.endswith(".part")
+        )
+
+
+def _init_worker(max_bytes):
+    utils.setup_worker_logging()
+    if max_bytes:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            max_bytes = min(max_bytes, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+
+def display_size(parser, detect=True):
+    """Returns the (width, height) to make renditions for: the [monitor] width
+    and height from photo.cfg if they're set, or else the screen size from
+    xrandr if `detect` is True. Returns None if neither is known.
+    """
+    width = utils.safe_get(parser, "monitor", "width")
+    height = utils.safe_get(parser, "monitor", "height")
+    if width and height:
+        return int(width), int(height)
+    if detect:
+        size = proc.display_size()
+        if size:
+            info(f"Display size from xrandr: {size[0]} x {size[1]}")
+        return size
+    return None
+
+
+def output_spec(size, fmt=None, quality=None):
+    """Returns the [width, height, format, quality] of renditions made for a
+    display of `size`, or None when the size isn't known and renditions are
+    only reduced to fit within image.MINSIZE.
+    """
+    if not size:
+        return None
+    fmt = image.supported_format(fmt)
+    return [size[0], size[1], fmt, int(quality or image.FORMATS[fmt][2])]
+
+
+def extension(output):
+    return image.FORMATS[output[2]][1] if output else None
+
+
+def available_mb(meminfo=None):
+    """Returns the memory available for new processes in MB, or None if it
+    can't be found. Where there's no /proc/meminfo, half of the physical
+    memory is assumed to be free.
+    """
+    try:
+        with open(meminfo or MEMINFO) as ff:
+            for line in ff:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // MB // 2
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def default_workers(worker_mb=WORKER_MB, memory_mb=None):
+    """Returns how many workers to run when it isn't configured: one per CPU,
+    but no more than fit in the available memory with `worker_mb` each, so
+    that together they can't exhaust it. At least one always runs.
+    """
+    workers = os.cpu_count() or 1
+    memory_mb = available_mb() if memory_mb is None else memory_mb
+    if worker_mb and memory_mb is not None:
+        workers = min(workers, memory_mb // worker_mb)
+    elif not worker_mb:
+        # Workers without a limit could each use any amount.
+        workers = 1
+    return max(1, workers)
+
+
+def image_budget(worker_mb, max_image_mb=image.MAX_IMAGE_MB):
+    """Returns the bytes that an image's pixels may use in a worker. Half of the
+    worker's limit is left for Python, PIL and the encoder.
+    """
+    if worker_mb:
+        max_image_mb = min(max_image_mb, worker_mb // 2)
+    return max_image_mb * MB
+
+
+def _render_one(src, tmp, profile, orientation="H", output=None, max_bytes=image.MAX_IMAGE_MB * MB):
+    """Runs in a worker process. Returns a tuple of (error message or None,
+    seconds taken, peak RSS of the worker in bytes).
+    """
+    start = time.perf_counter()
+    err = None
+    try:
+        if output:
+            width, height, fmt, quality = output
+            image.render(src, tmp, *profile, (width, height), orientation, fmt, quality, max_bytes)
+        else:
+            image.adjust(src, *profile, out_file=tmp, max_bytes=max_bytes)
+    except MemoryError:
+        err = "not enough memory"
+    except Exception as e:
+        err = str(e)
+    # ru_maxrss is in kilobytes on Linux.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return err, time.perf_counter() - start, peak_rss
+
+
+def render_all(
+    bright,
+    contrast,
+    saturation,
+    orientation="H",
+    image_dir=utils.IMAGE_DIR,
+    store=None,
+    workers=None,
+    worker_mb=WORKER_MB,
+    force=False,
+    progress=None,
+    output=None,
+    max_image_mb=image.MAX_IMAGE_MB,
+    fnames=None,
+):
+    """Renders every image in `image_dir` into the rendition store using a pool
+    of worker processes. With `fnames`, only those images are rendered, and the
+    renditions of the others are left alone. Images that already have a
+    rendition for these settings are skipped, unless `force` is True, and
+    images with identical content are only rendered once.
+
+    `output`, from output_spec(), makes the renditions for the display;
+    without it, they are only reduced to fit within image.MINSIZE, as JPEGs.
+    Images whose pixels wouldn't fit in `max_image_mb` (or half of
+    `worker_mb`) are decoded at a reduced scale.
+
+    `progress`, if given, is called with (number done, number to do, file
+    name, error message) as each image finishes.
+
+    The store is locked for the whole run, so a run started by hand while the
+    frame is rendering waits for it to finish, and vice versa.
+
+    Returns a tuple of (number rendered, number skipped, number failed).
+    """
+    store = store or RenditionStore()
+    with store.locked():
+        profile = [float(bright), float(contrast), float(saturation)]
+        if fnames is None:
+            sources = _source_files(image_dir)
+            store.prune(sources)
+        else:
+            sources = [fname for fname in fnames if os.path.isfile(os.path.join(image_dir, fname))]
+        # Maps each rendition key that's needed to its source hash and file name
+        todo = {}
+        for fname in sources:
+            src_hash = store.source_hash(fname, os.path.join(image_dir, fname))
+            key = make_key(src_hash, profile, orientation, output)
+            if key in todo:
+                continue
+            if force or not store.has(key):
+                todo[key] = (src_hash, fname)
+        skipped = len(sources) - len(todo)
+        info(f"Rendering {len(todo)} images; {skipped} are up to date")
+        rendered = failed = 0
+        ext = extension(output)
+        max_bytes = image_budget(worker_mb, max_image_mb)
+        if todo:
+            workers = workers or default_workers(worker_mb)
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(workers, len(todo)),
+                initializer=_init_worker,
+                initargs=(worker_mb * MB,),
+            ) as pool:
+                futures = {
+                    pool.submit(
+                        _render_one,
+                        os.path.join(image_dir, fname),
+                        store.temp_path_for(key, ext),
+                        profile,
+                        orientation,
+                        output,
+                        max_bytes,
+                    ): key
+                    for key, (src_hash, fname) in todo.items()
+                }
+                for num, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                    key = futures[future]
+                    src_hash, fname = todo[key]
+                    tmp = store.temp_path_for(key, ext)
+                    try:
+                        err, seconds, peak_rss = future.result()
+                        ADJUST_SECONDS.observe(seconds)
+                        WORKER_PEAK_RSS.set_max(peak_rss)
+                    except concurrent.futures.process.BrokenProcessPool as e:
+                        err = f"worker died: {e}"
+                    if err:
+                        failed += 1
+                        RENDER_FAILURES.inc()
+                        error(f"Could not render '{fname}': {err}")
+                        if os.path.exists(tmp):
+                            os.unlink(tmp)
+                    else:
+                        rendered += 1
+                        store.add(key, src_hash, tmp, ext)
+                        if rendered % SAVE_EVERY == 0:
+                            store.save()
+                    debug(f"Rendered {num} of {len(todo)} images")
+                    if progress:
+                        progress(num, len(todo), fname, err)
+        store.save()
+        info(f"Rendering finished: {rendered} rendered, {skipped} skipped, {failed} failed")
+        return rendered, skipped, failed
+
+
+class Renderer(object):
+    """Runs render_all() in a background thread for the ImageManager. A request
+    that arrives while a run is in progress starts another run once it
+    finishes, using the latest settings.
+
+    Images downloaded after a full run are queued with add(), and rendered in
+    small runs of their own.
+    """
+
+    def __init__(
+        self,
+        store,
+        workers=None,
+        worker_mb=WORKER_MB,
+        max_image_mb=image.MAX_IMAGE_MB,
+        image_dir=utils.IMAGE_DIR,
+    ):
+        self.store = store
+        self.image_dir = image_dir
+        self.workers = workers
+        self.worker_mb = worker_mb
+        self.max_image_mb = max_image_mb
+        self.lock = threading.Lock()
+        # The settings of the latest start(); None until it's first called
+        self.profile = None
+        self.full_run = False
+        # Names of images waiting to be rendered
+        self.pending = set()
+        self.thread = None
+
+    def start(self, bright, contrast, saturation, orientation, output=None):
+        """Renders all the images with these settings."""
+        with self.lock:
+            self.profile = (bright, contrast, saturation, orientation, output)
+            self.full_run = True
+            self._start_thread()
+
+    def add(self, fname):
+        """Renders one image with the latest settings. Until start() is first
+        called, the image waits for that full run.
+        """
+        with self.lock:
+            self.pending.add(fname)
+            if self.profile:
+                self._start_thread()
+
+    def wait(self, timeout=None):
+        """Waits for the runs in progress or queued to finish. Returns True if
+        they have.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                thread = self.thread
+            if thread is None:
+                return True
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            thread.join(remaining)
+
+    def _start_thread(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="render", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.full_run:
+                    fnames = None
+                elif self.pending:
+                    fnames = sorted(self.pending)
+                else:
+                    self.thread = None
+                    return
+                # A full run renders the waiting images too.
+                self.full_run = False
+                self.pending = set()
+                profile = self.profile
+            bright, contrast, saturation, orientation, output = profile
+            try:
+                render_all(
+                    bright,
+                    contrast,
+                    saturation,
+                    orientation,
+                    image_dir=self.image_dir,
+                    store=self.store,
+                    workers=self.workers,
+                    worker_mb=self.worker_mb,
+                    output=output,
+                    max_image_mb=self.max_image_mb,
+                    fnames=fnames,
+                )
+            except Exception as e:
+                error(f"Rendering failed: {e}")
+
+
+def main():
+    parser = utils.parse_config_file()
+    aparser = argparse.ArgumentParser(description="Render images for the local monitor")
+    aparser.add_argument(
+        "--brightness", type=float, default=utils.safe_get(parser, "monitor", "brightness", 1.0)
+    )
+    aparser.add_argument(
+        "--contrast", type=float, default=utils.safe_get(parser, "monitor", "contrast", 1.0)
+    )
+    aparser.add_argument(
+        "--saturation", type=float, default=utils.safe_get(parser, "monitor", "saturation", 1.0)
+    )
+    aparser.add_argument(
+        "--orientation", default=utils.safe_get(parser, "frame", "orientation", "H")
+    )
+    aparser.add_argument(
+        "--workers", type=int, default=utils.safe_get(parser, "render", "workers", None)
+    )
+    aparser.add_argument(
+        "--worker-mb", type=int, default=utils.safe_get(parser, "render", "worker_mb", WORKER_MB)
+    )
+    aparser.add_argument(
+        "--max-image-mb",
+        type=int,
+        default=utils.safe_get(parser, "render", "max_image_mb", image.MAX_IMAGE_MB),
+    )
+    aparser.add_argument("--width", type=int, help="Display width; from xrandr if not given")
+    aparser.add_argument("--height", type=int, help="Display height; from xrandr if not given")
+    aparser.add_argument(
+        "--original-size",
+        action="store_true",
+        help=f"Don't resize for the display; only reduce to fit within {image.MINSIZE} pixels",
+    )
+    aparser.add_argument(
+        "--format",
+        choices=sorted(image.FORMATS),
+        default=utils.safe_get(parser, "render", "format", image.DEFAULT_FORMAT),
+    )
+    aparser.add_argument("--quality", type=int, default=utils.safe_get(parser, "render", "quality"))
+    aparser.add_argument("--force", action="store_true", help="Render even up-to-date images")
+    args = aparser.parse_args()
+    size = None
+    if not args.original_size:
+        if args.width and args.height:
+            size = (args.width, args.height)
+        else:
+            size = display_size(parser)
+
+    def progress(num, total, fname, err):
+        status = f"FAILED: {err}" if err else "done"
+        print(f"[{num}/{total}] {fname} {status}")
+
+    rendered, skipped, failed = render_all(
+        args.brightness,
+        args.contrast,
+        args.saturation,
+        orientation=args.orientation,
+        workers=args.workers,
+        worker_mb=args.worker_mb,
+        force=args.force,
+        progress=progress,
+        output=output_spec(size, args.format, args.quality),
+        max_image_mb=args.max_image_mb,
+    )
+    print(f"{rendered} rendered, {skipped} up to date, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
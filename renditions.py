@@ -0,0 +1,191 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+import utils
+from utils import debug, info
+
+INDEX_NAME = "index.json"
+# Held by the process that is changing the store
+LOCK_NAME = ".lock"
+HASH_CHUNK_SIZE = 1024 * 1024
+EXTENSION = ".jpg"
+
+
+def make_key(src_hash, profile, orientation, output=None):
+    """Returns the key for the rendition of the source content with the given
+    correction profile and orientation. `output` is the [width, height,
+    format, quality] of a rendition made for the display, or None for one at
+    the original size.
+    """
+    # "H" and "horizontal" are the same orientation.
+    orientation = (orientation or "H")[0].upper()
+    ident = [src_hash, [float(val) for val in profile], orientation]
+    if output:
+        ident.append(list(output))
+    ident = json.dumps(ident)
+    return hashlib.sha256(ident.encode("utf-8")).hexdigest()[:32]
+
+
+def hash_file(pth):
+    digest = hashlib.sha256()
+    with open(pth, "rb") as ff:
+        for chunk in iter(lambda: ff.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RenditionStore(object):
+    """Stores adjusted images under a key made from the hash of the source
+    image's content, the correction profile, and the orientation. Identical
+    sources share their renditions, and the renditions for earlier profiles
+    are kept, so switching back to one costs nothing.
+
+    The index maps each source file name to its content hash, along with the
+    mtime and size that the hash was computed for, and maps each rendition key
+    to the hash of its source. Renditions that aren't JPEGs also have their
+    file extension recorded. All of it is held in memory, so lookups never
+    touch the disk.
+
+    The frame and render.py run by hand can share a store. Changes are only
+    made inside locked(), which keeps the other process out and starts from
+    the index it saved last.
+    """
+
+    def __init__(self, root=utils.RENDITION_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.sources = {}
+        self.renditions = {}
+        self.extensions = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.root, INDEX_NAME)) as ff:
+                index = json.load(ff)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        with self.lock:
+            self.sources = index.get("sources", {})
+            self.renditions = index.get("renditions", {})
+            self.extensions = index.get("extensions", {})
+        debug(
+            f"Rendition store has {len(self.renditions)} renditions of "
+            f"{len(self.sources)} images"
+        )
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds the store's lock file while the store is changed with
+        prune(), add() and save(), and reloads the index first, so that the
+        renditions another process has saved aren't pruned or overwritten.
+        """
+        with open(os.path.join(self.root, LOCK_NAME), "a") as ff:
+            try:
+                fcntl.flock(ff, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                info("Waiting for another process to finish with the rendition store")
+                fcntl.flock(ff, fcntl.LOCK_EX)
+            # Closing the file releases the lock.
+            self._load()
+            yield self
+
+    def save(self):
+        """Writes the index atomically, so a crash never leaves it half
+        written.
+        """
+        with self.lock:
+            index = {
+                "sources": dict(self.sources),
+                "renditions": dict(self.renditions),
+                "extensions": dict(self.extensions),
+            }
+        utils.atomic_write(os.path.join(self.root, INDEX_NAME), json.dumps(index))
+
+    def filename(self, key, ext=None):
+        with self.lock:
+            ext = ext or self.extensions.get(key, EXTENSION)
+        return f"{key}{ext}"
+
+    def path_for(self, key, ext=None):
+        return os.path.join(self.root, key[:2], self.filename(key, ext))
+
+    def temp_path_for(self, key, ext=None):
+        """Returns the path to render into before calling add()."""
+        pth = self.path_for(key, ext)
+        os.makedirs(os.path.dirname(pth), exist_ok=True)
+        return f"{pth}.{os.getpid()}.tmp"
+
+    def source_hash(self, fname, pth):
+        """Returns the content hash of the source file, only re-reading the file
+        if its mtime or size has changed since it was last hashed.
+        """
+        stat = os.stat(pth)
+        with self.lock:
+            entry = self.sources.get(fname)
+        if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return entry[2]
+        src_hash = hash_file(pth)
+        with self.lock:
+            self.sources[fname] = [stat.st_mtime_ns, stat.st_size, src_hash]
+        return src_hash
+
+    def has(self, key):
+        with self.lock:
+            return key in self.renditions
+
+    def add(self, key, src_hash, tmp_path, ext=None):
+        """Moves a finished rendition of the source with `src_hash` from
+        `tmp_path` into place.
+        """
+        os.replace(tmp_path, self.path_for(key, ext))
+        with self.lock:
+            self.renditions[key] = src_hash
+            if ext and ext != EXTENSION:
+                self.extensions[key] = ext
+            else:
+                self.extensions.pop(key, None)
+
+    def lookup(self, fname, profile, orientation, output=None):
+        """Returns the rendition key for the named source image, or None if its
+        rendition doesn't exist yet.
+        """
+        with self.lock:
+            entry = self.sources.get(fname)
+            if not entry:
+                return None
+            key = make_key(entry[2], profile, orientation, output)
+            return key if key in self.renditions else None
+
+    def prune(self, fnames):
+        """Forgets the sources that aren't in `fnames`, and deletes renditions
+        whose source content is no longer present.
+        """
+        fnames = set(fnames)
+        with self.lock:
+            for fname in set(self.sources) - fnames:
+                del self.sources[fname]
+            hashes = {entry[2] for entry in self.sources.values()}
+            dead = {key for key, src_hash in self.renditions.items() if src_hash not in hashes}
+            for key in dead:
+                del self.renditions[key]
+                self.extensions.pop(key, None)
+            live = set(self.renditions)
+        removed = 0
+        with os.scandir(self.root) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    for entry in entries:
+                        # Anything not in the index is left over from a crash.
+                        if entry.name.split(".")[0] not in live or entry.name.endswith(".tmp"):
+                            os.unlink(entry.path)
+                            removed += 1
+        if removed:
+            debug(f"Pruned {removed} renditions")
+        return removed
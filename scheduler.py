@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import threading
+import time
+
+from utils import error
+
+
+class Job(object):
+    """A call scheduled to run at a given time. Cancelling it just marks it;
+    the scheduler discards cancelled jobs when they reach the top of the heap.
+    """
+
+    __slots__ = ("when", "func", "args", "name", "cancelled")
+
+    def __init__(self, when, func, args, name):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.name = name
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """Runs all the frame's timed work from a single thread, in order of when
+    each job is due. Jobs run one at a time, so a job should not block for
+    long.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        # Reentrant, so that signal handlers can schedule and cancel jobs.
+        self.cond = threading.Condition(threading.RLock())
+        self.heap = []
+        self.counter = itertools.count()
+        self.thread = None
+        self.running = False
+        # Bumped when a stalled thread is replaced, so that it exits once its
+        # job returns.
+        self.generation = 0
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+            self._start_thread()
+
+    def _start_thread(self):
+        self.thread = threading.Thread(
+            target=self._run, args=(self.generation,), name="scheduler", daemon=True
+        )
+        self.thread.start()
+
+    def restart(self):
+        """Replaces the thread running the jobs, in case it has died or is stuck
+        in a job. A stuck thread exits when its job finally returns.
+        """
+        with self.cond:
+            if not self.running:
+                return
+            self.generation += 1
+            self._start_thread()
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def schedule(self, delay, func, *args, name=None):
+        """Runs func(*args) after `delay` seconds. Returns the Job, which can be
+        cancelled.
+        """
+        job = Job(self.clock() + delay, func, args, name or func.__name__)
+        with self.cond:
+            heapq.heappush(self.heap, (job.when, next(self.counter), job))
+            if self.heap[0][2] is job:
+                # It's due before anything else, so the thread must wake sooner.
+                self.cond.notify()
+        return job
+
+    def pending(self):
+        """Returns the number of jobs waiting to run."""
+        with self.cond:
+            return sum(1 for when, num, job in self.heap if not job.cancelled)
+
+    def _next_job(self, generation):
+        with self.cond:
+            while self.running and generation == self.generation:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0][0] - self.clock()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                return heapq.heappop(self.heap)[2]
+        return None
+
+    def _run(self, generation):
+        while True:
+            job = self._next_job(generation)
+            if job is None:
+                return
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                error(f"Scheduled job '{job.name}' failed: {e}")
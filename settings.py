@@ -0,0 +1,222 @@
+import configparser
+import io
+import re
+import threading
+
+import utils
+from utils import debug, error
+
+# How long to wait for more changes before writing photo.cfg, in seconds
+SAVE_DELAY = 5
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+INTERVAL_UNITS = ("seconds", "minutes", "hours", "days")
+INTERVAL_BASE_PAT = re.compile(r"^(\*|\d{1,2}):(\*|\d{1,2})$")
+TRUE_STRINGS = ("1", "true", "yes", "on")
+FALSE_STRINGS = ("", "0", "false", "no", "off", "none")
+
+
+def parse_bool(val):
+    """Returns the boolean for a setting, which may have come from JSON or from
+    a config file, so that the string "False" is false.
+    """
+    if isinstance(val, bool):
+        return val
+    if val is None:
+        return False
+    if isinstance(val, (int, float)):
+        return bool(val)
+    text = str(val).strip().lower()
+    if text in TRUE_STRINGS:
+        return True
+    if text in FALSE_STRINGS:
+        return False
+    raise ValueError(f"'{val}' is not a boolean")
+
+
+def _log_level(val):
+    level = str(val).upper()
+    if level not in LOG_LEVELS:
+        raise ValueError(f"'{val}' is not a log level")
+    return level
+
+
+def _orientation(val):
+    # The web app sends "H" or "V"; photo.cfg has "horizontal" or "vertical".
+    orientation = str(val).strip()[:1].upper()
+    if orientation not in ("H", "V"):
+        raise ValueError(f"'{val}' is not an orientation")
+    return orientation
+
+
+def _interval_base(val):
+    mtch = INTERVAL_BASE_PAT.match(str(val).strip())
+    if not mtch:
+        raise ValueError(f"'{val}' is not an hour:minute pattern")
+    hour, minute = mtch.groups()
+    if (hour != "*" and int(hour) > 23) or (minute != "*" and int(minute) > 59):
+        raise ValueError(f"'{val}' is not a valid time")
+    return f"{hour}:{minute}"
+
+
+def _interval_units(val):
+    units = str(val).strip().lower()
+    for name in INTERVAL_UNITS:
+        # Accept "m", "min", "minute", etc.
+        if units and name.startswith(units.rstrip("s") or units):
+            return name
+    raise ValueError(f"'{val}' is not a unit of time")
+
+
+def _bounded(typ, low, high=None):
+    def convert(val):
+        num = typ(val)
+        if num < low or (high is not None and num > high):
+            limits = f"between {low} and {high}" if high is not None else f"at least {low}"
+            raise ValueError(f"{num} is not {limits}")
+        return num
+
+    return convert
+
+
+class Settings(object):
+    """The frame's settings from etcd, each converted to its type and checked.
+
+    A value that can't be converted is logged and ignored, so a bad setting
+    from the web app leaves the previous value in place instead of stopping
+    the frame.
+    """
+
+    # Maps each setting to the function that converts and checks it, and its
+    # default.
+    FIELDS = {
+        "log_level": (_log_level, "INFO"),
+        "name": (str, "undefined"),
+        "description": (str, ""),
+        "orientation": (_orientation, "H"),
+        # When to start the image rotation
+        "interval_base": (_interval_base, "*:*"),
+        # How often to change image
+        "interval_time": (_bounded(int, 1), 10),
+        "interval_units": (_interval_units, "minutes"),
+        # Percentage to vary the display time from photo to photo
+        "variance_pct": (_bounded(int, 0, 100), 0),
+        # Do we use halflife decay pattern for the interval?
+        "use_halflife": (parse_bool, False),
+        "brightness": (_bounded(float, 0.0), 1.0),
+        "contrast": (_bounded(float, 0.0), 1.0),
+        "saturation": (_bounded(float, 0.0), 1.0),
+    }
+    __slots__ = tuple(FIELDS)
+
+    def __init__(self, data=None):
+        for name, (convert, default) in self.FIELDS.items():
+            setattr(self, name, default)
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        """Applies the known settings in `data`, and returns the names of the
+        ones that changed.
+        """
+        changed = []
+        for name, val in data.items():
+            field = self.FIELDS.get(name)
+            if field is None or val is None:
+                continue
+            try:
+                val = field[0](val)
+            except (TypeError, ValueError) as e:
+                error(f"Ignoring invalid setting {name}={val!r}: {e}")
+                continue
+            if val != getattr(self, name):
+                setattr(self, name, val)
+                changed.append(name)
+        return changed
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return f"Settings({self.as_dict()})"
+
+    @property
+    def interval(self):
+        """The interval between photos in seconds."""
+        return utils.normalize_interval(self.interval_time, self.interval_units)
+
+    @property
+    def profile(self):
+        return (self.brightness, self.contrast, self.saturation)
+
+
+class ConfigFile(object):
+    """Reads and saves photo.cfg.
+
+    Saves are held for `delay` seconds on the `scheduler`, so a burst of
+    changes is written once. The file is replaced atomically, and isn't
+    written at all if its contents wouldn't change, to spare the SD card.
+    Reads include any save that hasn't been written yet.
+    """
+
+    def __init__(self, scheduler, pth=None, delay=SAVE_DELAY):
+        self.scheduler = scheduler
+        self.pth = pth or utils.CONFIG_FILE
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = None
+        self.job = None
+        self.written = self._read_text()
+
+    def _read_text(self):
+        try:
+            with open(self.pth) as ff:
+                return ff.read()
+        except OSError:
+            return None
+
+    def read(self):
+        with self.lock:
+            text = self.pending
+        parser = configparser.ConfigParser()
+        try:
+            if text is None:
+                parser.read(self.pth)
+            else:
+                parser.read_string(text)
+        except configparser.MissingSectionHeaderError:
+            # The file exists, but doesn't have the correct format.
+            raise Exception("Invalid Configuration File")
+        return parser
+
+    def save(self, parser):
+        buf = io.StringIO()
+        parser.write(buf)
+        with self.lock:
+            self.pending = buf.getvalue()
+            if self.job is None:
+                self.job = self.scheduler.schedule(self.delay, self.flush, name="save_config")
+
+    def flush(self):
+        """Writes any pending save now. Returns True if the file was written."""
+        with self.lock:
+            text, self.pending = self.pending, None
+            job, self.job = self.job, None
+            if job:
+                job.cancel()
+            if text is None or text == self.written:
+                if text is not None:
+                    debug("Config unchanged; not writing it")
+                return False
+            try:
+                utils.atomic_write(self.pth, text)
+            except OSError as e:
+                error(f"Could not save the config: {e}")
+                # Try again with the next save.
+                self.pending = text
+                return False
+            self.written = text
+        debug("Config saved")
+        return True
@@ -0,0 +1,337 @@
+import bisect
+import random
+import threading
+import time
+
+MASK64 = (1 << 64) - 1
+FEISTEL_ROUNDS = 4
+# Number of per-pass permutations to keep around
+PERM_CACHE_SIZE = 3
+
+
+def _mix(val):
+    """The splitmix64 finalizer: scrambles a 64-bit value."""
+    val = ((val ^ (val >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    val = ((val ^ (val >> 27)) * 0x94D049BB133111EB) & MASK64
+    return val ^ (val >> 31)
+
+
+class Permutation(object):
+    """A keyed, random-looking bijection on range(size) that is computed one
+    position at a time, so nothing of size `size` is ever stored.
+
+    It is a Feistel network over the smallest even number of bits that covers
+    `size`; results outside the range are fed back through the network
+    ("cycle walking") until they land inside it.
+    """
+
+    def __init__(self, size, key):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [_mix((key + rnd) & MASK64) for rnd in range(FEISTEL_ROUNDS)]
+
+    def _encrypt(self, val):
+        left = val >> self.half_bits
+        right = val & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right ^ key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, position):
+        val = self._encrypt(position)
+        while val >= self.size:
+            val = self._encrypt(val)
+        return val
+
+
+class Shuffle(object):
+    """A never-ending sequence of passes through range(size), each pass in a
+    different random order. The order is computed from the seed and the pass
+    number (the epoch), so moving forwards or backwards, even across passes,
+    takes constant time and memory.
+
+    The last item of one pass is never the first item of the next. A new size
+    takes effect at the start of the next pass.
+    """
+
+    def __init__(self, size, seed=None, epoch=0, position=0, sizes=None):
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.epoch = epoch
+        self.position = position
+        # [first epoch, size] pairs, in order of epoch
+        self.sizes = sizes or [[epoch, size]]
+        self._perms = {}
+
+    @property
+    def size(self):
+        return self.size_for(self.epoch)
+
+    def size_for(self, epoch):
+        idx = bisect.bisect_right([start for start, size in self.sizes], epoch) - 1
+        return self.sizes[max(idx, 0)][1]
+
+    def resize(self, size):
+        """Sets the size for passes after the current one."""
+        next_epoch = self.epoch + 1
+        self.sizes = [entry for entry in self.sizes if entry[0] < next_epoch]
+        if self.sizes[-1][1] != size:
+            self.sizes.append([next_epoch, size])
+
+    def _perm(self, epoch):
+        perm = self._perms.get(epoch)
+        if perm is None:
+            if len(self._perms) >= PERM_CACHE_SIZE:
+                self._perms.pop(next(iter(self._perms)))
+            key = _mix((self.seed ^ _mix(epoch & MASK64)) & MASK64)
+            perm = self._perms[epoch] = Permutation(self.size_for(epoch), key)
+        return perm
+
+    def item(self, epoch, position):
+        """Returns the item at `position` in pass `epoch`."""
+        size = self.size_for(epoch)
+        if size <= 2:
+            # There's no way to avoid repeats, so keep it simple.
+            return position
+        perm = self._perm(epoch)
+        if position < 2:
+            prev_size = self.size_for(epoch - 1)
+            if prev_size > 2 and perm[0] == self._perm(epoch - 1)[prev_size - 1]:
+                # Swap the first two so that the previous pass's last item isn't
+                # shown twice in a row.
+                position = 1 - position
+        return perm[position]
+
+    def _moved(self, epoch, position, delta):
+        position += delta
+        while position >= self.size_for(epoch):
+            position -= self.size_for(epoch)
+            epoch += 1
+        while position < 0:
+            epoch -= 1
+            position += self.size_for(epoch)
+        return epoch, position
+
+    def current(self):
+        return self.item(self.epoch, self.position)
+
+    def step(self, delta=1):
+        """Moves `delta` positions (negative to go back), and returns the item
+        there.
+        """
+        self.epoch, self.position = self._moved(self.epoch, self.position, delta)
+        return self.current()
+
+    def peek(self, delta):
+        """Returns the item `delta` positions away without moving."""
+        return self.item(*self._moved(self.epoch, self.position, delta))
+
+    def state(self):
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "position": self.position,
+            "sizes": self.sizes,
+        }
+
+
+class Rotation(object):
+    """The frame's images, and the random order they are shown in.
+
+    The list of names keeps the order the server sent; the shuffled order is
+    computed by a Shuffle. When images are removed their slots are left empty
+    and skipped, and new images fill empty slots before being added at the end,
+    so the rest of the rotation keeps its order. Images added at the end join
+    the rotation at the start of the next pass.
+
+    The image list is changed from the threads that hear from the servers while
+    the scheduler moves through it, so every method holds `lock`.
+    """
+
+    def __init__(self, images=(), state=None):
+        state = state or {}
+        self.lock = threading.RLock()
+        # Counts the changes to the list of names, so that it only needs to be
+        # saved when it has changed.
+        self.version = 0
+        self._load(list(state.get("names", images)), state.get("shuffle", {}))
+
+    def _load(self, names, shuffle_state=None):
+        self.names = names
+        self.positions = {fname: idx for idx, fname in enumerate(self.names) if fname}
+        self.free = [idx for idx, fname in enumerate(self.names) if not fname]
+        self.shuffle = Shuffle(len(self.names), **(shuffle_state or {}))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, fname):
+        return fname in self.positions
+
+    def random_name(self):
+        """Returns a random image name, or None if there are no images."""
+        with self.lock:
+            if not self.positions:
+                return None
+            while True:
+                fname = self.names[random.randrange(len(self.names))]
+                if fname:
+                    return fname
+
+    def names_in_order(self):
+        with self.lock:
+            return [fname for fname in self.names if fname]
+
+    def current(self):
+        """Returns the current image name, or None if there are no images."""
+        with self.lock:
+            if not self.positions:
+                return None
+            fname = self.names[self.shuffle.current()]
+            if not fname:
+                # The current image was removed; move on to the next one.
+                return self.step()
+            return fname
+
+    def step(self, forward=True):
+        """Moves to the next (or previous) image and returns its name."""
+        with self.lock:
+            if not self.positions:
+                return None
+            delta = 1 if forward else -1
+            while True:
+                fname = self.names[self.shuffle.step(delta)]
+                if fname:
+                    return fname
+
+    def upcoming(self, count):
+        """Returns the names of the next `count` images without moving."""
+        with self.lock:
+            names = []
+            delta = 1
+            count = min(count, len(self) - 1)
+            while len(names) < count and delta <= len(self.names) * 2:
+                fname = self.names[self.shuffle.peek(delta)]
+                if fname:
+                    names.append(fname)
+                delta += 1
+            return names
+
+    def set_images(self, images):
+        """Replaces the image list, applying only the differences."""
+        with self.lock:
+            if not self.positions:
+                self._load(list(images))
+                self.version += 1
+                return
+            new_names = set(images)
+            added = [fname for fname in images if fname not in self.positions]
+            removed = [fname for fname in self.positions if fname not in new_names]
+            self.update(added, removed)
+
+    def update(self, added, removed):
+        with self.lock:
+            if not added and not removed:
+                return
+            self.version += 1
+            shown = self.names[self.shuffle.current()] if self.names else None
+            for fname in removed:
+                idx = self.positions.pop(fname, None)
+                if idx is not None:
+                    self.names[idx] = None
+                    self.free.append(idx)
+            for fname in added:
+                if fname in self.positions:
+                    continue
+                if self.free:
+                    idx = self.free.pop()
+                    self.names[idx] = fname
+                else:
+                    idx = len(self.names)
+                    self.names.append(fname)
+                self.positions[fname] = idx
+            if self.free and len(self.free) > len(self.names) // 2:
+                # Mostly empty, so start over with a compact list.
+                self._compact(shown)
+                return
+            self.shuffle.resize(len(self.names))
+
+    def _compact(self, shown):
+        """Drops the empty slots, and starts a new shuffle of what's left. The
+        image that was `shown` is moved to the new shuffle's first position, so
+        that it stays the current image.
+        """
+        self._load(self.names_in_order())
+        idx = self.positions.get(shown)
+        if idx is None:
+            return
+        first = self.shuffle.current()
+        other = self.names[first]
+        self.names[first], self.names[idx] = shown, other
+        self.positions[shown], self.positions[other] = first, idx
+
+    def state(self):
+        """Returns the position in the rotation. The names are saved separately,
+        when `version` shows they have changed.
+        """
+        with self.lock:
+            return {"shuffle": self.shuffle.state()}
+
+
+def benchmark(sizes=(100000, 1000000), steps=10000):
+    """Compares stepping through a materialized, reshuffled list with computing
+    the order with a Shuffle. Returns a dict of results keyed by size.
+    """
+    import tracemalloc
+
+    results = {}
+    for size in sizes:
+        tracemalloc.start()
+        start = time.perf_counter()
+        order = list(range(size))
+        random.shuffle(order)
+        list_setup = time.perf_counter() - start
+        list_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        idx = 0
+        for num in range(steps):
+            idx += 1
+            if idx >= size:
+                idx = 0
+                random.shuffle(order)
+            order[idx]
+        list_step = (time.perf_counter() - start) / steps
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        shuffle = Shuffle(size)
+        shuffle.current()
+        shuffle_setup = time.perf_counter() - start
+        shuffle_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for num in range(steps):
+            shuffle.step()
+        shuffle_step = (time.perf_counter() - start) / steps
+
+        results[size] = {
+            "list_setup_secs": list_setup,
+            "list_step_secs": list_step,
+            "list_peak_bytes": list_memory,
+            # A full reshuffle happens every `size` steps with the list.
+            "list_reshuffle_secs": list_setup,
+            "shuffle_setup_secs": shuffle_setup,
+            "shuffle_step_secs": shuffle_step,
+            "shuffle_peak_bytes": shuffle_memory,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    for size, result in benchmark().items():
+        print(f"{size} images:")
+        for key, val in result.items():
+            print(f"    {key}: {val:.3g}")
@@ -0,0 +1,416 @@
+"""Simulates a fleet of frames, to see the load they put on etcd and the
+registration server, and to measure client-side changes before they are
+rolled out.
+
+Each frame is a headless ImageManager: no browser, webserver, monitor control
+or saved state. They all run on one simulated clock, so a day of frame time
+takes seconds. The registration requests are real HTTP requests to a local
+RegistrationServer; etcd is a FakeEtcd, and each frame's watch stream is
+modelled with the same reconnect backoff as utils.watch().
+
+    python simulate.py --frames 300 --hours 24 --outage 120:10 --output sim.json
+
+--outage START:MINUTES takes etcd down for MINUTES starting START minutes in,
+dropping every watch, and can be given more than once. With --processes, the
+frames are split between worker processes, each with its own clock and
+FakeEtcd, all registering with the same server.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import configparser
+import heapq
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from scheduler import Job
+
+# Width of the windows that request rates are measured over, in seconds
+RATE_WINDOW = 60
+# How long after an outage to look at the reconnect storm, in seconds
+STORM_WINDOW = 600
+
+
+class SimScheduler(object):
+    """Has the same methods as scheduler.Scheduler, but runs the jobs on a
+    simulated clock: run_until() runs every job that's due in order, moving the
+    clock straight to each one.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self.heap = []
+        self.counter = itertools.count()
+
+    def clock(self):
+        return self.now
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def restart(self):
+        pass
+
+    def schedule(self, delay, func, *args, name=None):
+        job = Job(self.now + delay, func, args, name or func.__name__)
+        heapq.heappush(self.heap, (job.when, next(self.counter), job))
+        return job
+
+    def pending(self):
+        return sum(1 for when, num, job in self.heap if not job.cancelled)
+
+    def run_until(self, end):
+        import utils
+
+        while self.heap and self.heap[0][0] <= end:
+            when, num, job = heapq.heappop(self.heap)
+            if job.cancelled:
+                continue
+            self.now = when
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                utils.error(f"Simulated job '{job.name}' failed: {e}")
+        self.now = end
+
+
+class SimWatch(object):
+    """A frame's etcd watch stream. It is dropped when etcd goes down, and is
+    reopened with the same backoff as utils.watch().
+    """
+
+    def __init__(self, frame, fleet):
+        self.frame = frame
+        self.fleet = fleet
+        self.attempt = 0
+        self.connected = False
+
+    def connect(self):
+        import utils
+
+        self.fleet.record(self.frame.num, "watch_connect")
+        if not self.fleet.etcd_up:
+            self.fleet.scheduler.schedule(utils.backoff_delay(self.attempt), self.connect)
+            self.attempt += 1
+            return
+        self.attempt = 0
+        self.connected = True
+
+    def drop(self):
+        import utils
+
+        if not self.connected:
+            return
+        self.connected = False
+        self.fleet.scheduler.schedule(utils.backoff_delay(self.attempt), self.connect)
+        self.attempt += 1
+
+
+def _frame_class():
+    """SimFrame subclasses ImageManager, which can only be imported once HOME
+    points at the scratch directory.
+    """
+    import photo
+
+    class SimFrame(photo.ImageManager):
+        def __init__(self, num, fleet):
+            self.num = num
+            self.fleet = fleet
+            self.pkid = f"sim{num:05d}"
+            self.fetched = set()
+            super().__init__(scheduler=fleet.scheduler, headless=True)
+            self.watch = SimWatch(self, fleet)
+
+        def _parse_config(self):
+            parser = configparser.ConfigParser()
+            parser.read_dict(
+                {
+                    "frame": {"pkid": self.pkid},
+                    "host": {"reg_url": self.fleet.reg_url, "dl_url": self.fleet.dl_url},
+                }
+            )
+            return parser
+
+        def _register(self):
+            start = time.perf_counter()
+            super()._register()
+            self.fleet.record(self.num, "register", time.perf_counter() - start)
+
+        def image_url(self, fname):
+            self._download(fname)
+            return os.path.join(self.dl_url, fname)
+
+        def prefetch(self):
+            for fname in self.selector.upcoming(self.prefetch_count):
+                self._download(fname)
+
+        def _download(self, fname):
+            # Each frame downloads an image once, and keeps it.
+            if fname not in self.fetched:
+                self.fetched.add(fname)
+                self.fleet.record(self.num, "download")
+
+    return SimFrame
+
+
+class Fleet(object):
+    def __init__(self, nums, opts):
+        import standins
+        import utils
+
+        self.opts = opts
+        self.reg_url = opts["reg_url"]
+        self.dl_url = opts["dl_url"]
+        self.scheduler = SimScheduler()
+        self.records = []
+        self.etcd_up = True
+        self.etcd = standins.FakeEtcd(listener=self._etcd_request)
+        utils.etcd_client = self.etcd
+        utils.etcd_checked_at = None
+        self.frame_nums = {}
+        for num in nums:
+            pkid = f"sim{num:05d}"
+            self.frame_nums[utils.BASE_KEY.format(pkid=pkid)] = num
+            self.etcd.put(
+                f"{utils.BASE_KEY.format(pkid=pkid)}settings",
+                {
+                    "log_level": "ERROR",
+                    "interval_time": opts["interval"],
+                    "interval_units": "minutes",
+                    "variance_pct": opts["variance"],
+                    "use_halflife": opts["halflife"],
+                },
+            )
+        SimFrame = _frame_class()
+        self.frames = []
+        for num in nums:
+            delay = random.uniform(0, opts["stagger"])
+            self.scheduler.schedule(delay, self._boot, SimFrame, num)
+        for start, minutes in opts["outages"]:
+            self.scheduler.schedule(start * 60, self._etcd_down)
+            self.scheduler.schedule((start + minutes) * 60, self._etcd_restored)
+        if opts["events_per_hour"]:
+            self._schedule_event()
+
+    def record(self, frame_num, kind, latency=0.0):
+        self.records.append((self.scheduler.now, frame_num, kind, latency))
+
+    def _etcd_request(self, name, key):
+        if name == "put":
+            # Puts come from the simulation, not the frames.
+            return
+        num = None
+        for prefix, frame_num in self.frame_nums.items():
+            if key and key.startswith(prefix):
+                num = frame_num
+                break
+        self.record(num, f"etcd_{name}")
+
+    def _boot(self, frame_class, num):
+        frame = frame_class(num, self)
+        self.frames.append(frame)
+        frame._started = True
+        frame.show_photo()
+        frame.set_timer()
+        frame.watch.connect()
+
+    def _etcd_down(self):
+        self.etcd_up = False
+        for frame in self.frames:
+            frame.watch.drop()
+
+    def _etcd_restored(self):
+        self.etcd_up = True
+
+    def _schedule_event(self):
+        delay = random.expovariate(self.opts["events_per_hour"] / 3600)
+        self.scheduler.schedule(delay, self._send_event)
+
+    def _send_event(self):
+        """Sends a change_photo event to a random frame, as the web app does."""
+        import utils
+
+        if self.frames:
+            frame = random.choice(self.frames)
+            key = f"{utils.BASE_KEY.format(pkid=frame.pkid)}change_photo"
+            self.etcd.put(key, "next")
+            if frame.watch.connected:
+                self.scheduler.schedule(0, frame.process_event, "change_photo", "next")
+        self._schedule_event()
+
+    def run(self):
+        self.scheduler.run_until(self.opts["hours"] * 3600)
+        return self.records
+
+
+def _run_group(nums, opts):
+    random.seed(opts["seed"] + nums[0])
+    return Fleet(nums, opts).run()
+
+
+def _percentiles(vals):
+    if not vals:
+        return {}
+    vals = sorted(vals)
+
+    def pct(num):
+        return vals[min(len(vals) - 1, int(len(vals) * num / 100))]
+
+    return {"p50": pct(50), "p95": pct(95), "p99": pct(99), "max": vals[-1]}
+
+
+def summarize(records, opts):
+    hours = opts["hours"]
+    duration = hours * 3600
+    by_kind = collections.defaultdict(list)
+    for record in records:
+        by_kind[record[2]].append(record)
+    kinds = {}
+    for kind, recs in sorted(by_kind.items()):
+        windows = collections.Counter(int(when // RATE_WINDOW) for when, num, knd, lat in recs)
+        per_frame = collections.Counter(num for when, num, knd, lat in recs if num is not None)
+        frame_rates = [per_frame.get(num, 0) / hours for num in range(opts["frames"])]
+        kinds[kind] = {
+            "total": len(recs),
+            "mean_per_sec": len(recs) / duration,
+            "peak_per_sec": max(windows.values()) / RATE_WINDOW,
+            "per_frame_per_hour": {
+                "mean": statistics.mean(frame_rates),
+                "min": min(frame_rates),
+                "max": max(frame_rates),
+            },
+        }
+    latencies = [lat for when, num, kind, lat in by_kind.get("register", [])]
+    storms = []
+    connects = [when for when, num, kind, lat in by_kind.get("watch_connect", [])]
+    for start, minutes in opts["outages"]:
+        restored = (start + minutes) * 60
+        after = [when - restored for when in connects if restored <= when < restored + STORM_WINDOW]
+        seconds = collections.Counter(int(when) for when in after)
+        storms.append(
+            {
+                "outage_start_min": start,
+                "outage_minutes": minutes,
+                "attempts_during": sum(1 for when in connects if start * 60 <= when < restored),
+                "attempts_after": len(after),
+                "peak_per_sec": max(seconds.values()) if seconds else 0,
+                "all_reconnected_after_secs": max(after) if after else None,
+            }
+        )
+    return {
+        "options": {key: val for key, val in opts.items() if key not in ("reg_url", "dl_url")},
+        "requests": kinds,
+        "register_latency_secs": _percentiles(latencies),
+        "watch_storms": storms,
+    }
+
+
+def report(summary):
+    opts = summary["options"]
+    print(f"{opts['frames']} frames for {opts['hours']} simulated hours")
+    print(f"{'request':<16}{'total':>9}{'mean/s':>10}{'peak/s':>10}{'frame/h':>10}{'max/h':>8}")
+    for kind, stats in summary["requests"].items():
+        per_frame = stats["per_frame_per_hour"]
+        print(
+            f"{kind:<16}{stats['total']:>9}{stats['mean_per_sec']:>10.3f}"
+            f"{stats['peak_per_sec']:>10.3f}{per_frame['mean']:>10.2f}{per_frame['max']:>8.1f}"
+        )
+    latency = summary["register_latency_secs"]
+    if latency:
+        print(
+            "Registration latency (real): "
+            + ", ".join(f"{key} {val * 1000:.1f} ms" for key, val in latency.items())
+        )
+    for storm in summary["watch_storms"]:
+        print(
+            f"etcd outage at {storm['outage_start_min']} min for {storm['outage_minutes']} min: "
+            f"{storm['attempts_during']} watch attempts during, {storm['attempts_after']} after, "
+            f"peak {storm['peak_per_sec']}/s, all back after "
+            f"{storm['all_reconnected_after_secs'] or 0:.0f} s"
+        )
+
+
+def _parse_outage(val):
+    start, minutes = val.split(":")
+    return [float(start), float(minutes)]
+
+
+def main():
+    aparser = argparse.ArgumentParser(description="Simulate a fleet of frames")
+    aparser.add_argument("--frames", type=int, default=100)
+    aparser.add_argument("--hours", type=float, default=24)
+    aparser.add_argument("--images", type=int, default=1000, help="Images per frame")
+    aparser.add_argument("--interval", type=int, default=10, help="Minutes between photos")
+    aparser.add_argument("--variance", type=int, default=0, help="Interval variance percent")
+    aparser.add_argument("--halflife", action="store_true")
+    aparser.add_argument(
+        "--stagger", type=float, default=0, help="Spread the frames' start over this many seconds"
+    )
+    aparser.add_argument("--outage", action="append", type=_parse_outage, default=[])
+    aparser.add_argument(
+        "--events-per-hour", type=float, default=0, help="change_photo events across the fleet"
+    )
+    aparser.add_argument("--processes", type=int, default=1)
+    aparser.add_argument("--seed", type=int, default=0)
+    aparser.add_argument("--output", help="Write the summary to this JSON file")
+    args = aparser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="photoviewer-sim-")
+    # The frame's paths all hang off the home directory, and are set when utils
+    # is first imported.
+    os.environ["HOME"] = workdir
+    os.makedirs(os.path.join(workdir, "projects", "photoviewer"), exist_ok=True)
+    import standins
+
+    server = standins.RegistrationServer(standins.make_image_names(args.images)).start()
+    opts = {
+        "frames": args.frames,
+        "hours": args.hours,
+        "images": args.images,
+        "interval": args.interval,
+        "variance": args.variance,
+        "halflife": args.halflife,
+        "stagger": args.stagger,
+        "outages": args.outage,
+        "events_per_hour": args.events_per_hour / args.processes,
+        "seed": args.seed,
+        "reg_url": server.reg_url,
+        "dl_url": server.dl_url,
+    }
+    nums = list(range(args.frames))
+    groups = [nums[idx :: args.processes] for idx in range(args.processes)]
+    start = time.perf_counter()
+    try:
+        if args.processes == 1:
+            records = _run_group(nums, opts)
+        else:
+            records = []
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as pool:
+                for recs in pool.map(_run_group, groups, itertools.repeat(opts)):
+                    records.extend(recs)
+    finally:
+        server.stop()
+    opts["events_per_hour"] = args.events_per_hour
+    summary = summarize(records, opts)
+    summary["server"] = {"registrations": server.registrations, "not_modified": server.not_modified}
+    summary["wall_seconds"] = time.perf_counter() - start
+    report(summary)
+    print(f"Simulated in {summary['wall_seconds']:.1f} s")
+    if args.output:
+        with open(args.output, "w") as ff:
+            json.dump(summary, ff, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import json
+import threading
+import uuid
+
+import utils
+from utils import debug, error, info
+
+# How long to wait for more changes before writing the snapshot, in seconds.
+# Moving to the next photo changes the snapshot every time, so this keeps the
+# SD card from being written on every change.
+SAVE_DELAY = 30
+
+
+class Snapshot(object):
+    """Saves and restores the frame's last known state, so that it can start
+    showing photos before it has heard from the servers.
+
+    The rotation's image names are most of the state, but change only when the
+    image list does, so they are kept in their own file and written only when
+    they change. The main file names the image list it goes with, and a
+    snapshot whose two files don't match isn't used.
+
+    Saves are held for `delay` seconds on the `scheduler`, so that only the
+    latest state of a burst of changes is written. Both files are replaced
+    atomically, and a lock keeps saves from different threads apart.
+    """
+
+    def __init__(self, scheduler, pth=None, names_pth=None, delay=SAVE_DELAY):
+        self.scheduler = scheduler
+        self.pth = pth or utils.SNAPSHOT_FILE
+        self.names_pth = names_pth or utils.NAMES_FILE
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = None
+        self.pending_names = None
+        self.job = None
+        # The version of the rotation's names that are on disk, and the ID
+        # that the main file refers to them by
+        self.names_version = None
+        self.names_id = None
+
+    def _load(self, pth):
+        with open(pth) as ff:
+            return json.load(ff)
+
+    def read(self):
+        """Returns the saved state, with the image names in its rotation, or
+        an empty dict if there isn't a usable snapshot.
+        """
+        try:
+            state = self._load(self.pth)
+            names = self._load(self.names_pth)
+        except (OSError, ValueError) as e:
+            info(f"No usable state snapshot: {e}")
+            return {}
+        names_id = state.pop("names_id", None)
+        if not names_id or names.get("id") != names_id:
+            info("State snapshot doesn't match the saved image names; not using it")
+            return {}
+        state.setdefault("rotation", {})["names"] = names.get("names", [])
+        # The rotation made from this state starts at version 0.
+        self.names_version = 0
+        self.names_id = names_id
+        return state
+
+    def save(self, state, names, names_version):
+        """Saves the state soon. `names` is the rotation's list of image names,
+        and is only copied and written if `names_version` shows that it has
+        changed since it was last saved.
+        """
+        with self.lock:
+            self.pending = state
+            if names_version != self.names_version:
+                self.pending_names = (list(names), names_version)
+            if self.job is None:
+                self.job = self.scheduler.schedule(self.delay, self.flush, name="save_snapshot")
+
+    def flush(self):
+        """Writes any pending save now. Returns True if anything was written."""
+        with self.write_lock:
+            with self.lock:
+                state, self.pending = self.pending, None
+                pending_names, self.pending_names = self.pending_names, None
+                job, self.job = self.job, None
+            if job:
+                job.cancel()
+            if state is None:
+                return False
+            try:
+                if pending_names:
+                    names, names_version = pending_names
+                    names_id = uuid.uuid4().hex
+                    utils.atomic_write(self.names_pth, json.dumps({"id": names_id, "names": names}))
+                    self.names_version, self.names_id = names_version, names_id
+                    debug(f"Saved {len(names)} image names")
+                state = dict(state, names_id=self.names_id)
+                utils.atomic_write(self.pth, json.dumps(state))
+            except OSError as e:
+                error(f"Could not save state snapshot: {e}")
+                with self.lock:
+                    # Try again with the next save, unless there's a newer one.
+                    if self.pending is None:
+                        self.pending = state
+                    if self.pending_names is None and pending_names:
+                        if self.names_version != pending_names[1]:
+                            self.pending_names = pending_names
+                return False
+        debug("State snapshot saved")
+        return True
@@ -0,0 +1,237 @@
+"""Local stand-ins for the servers the frame talks to, so that it can be
+benchmarked and simulated without a network.
+
+FakeEtcd replaces the etcd client: assign one to utils.etcd_client. The
+RegistrationServer answers registration requests and serves image downloads
+from a single local HTTP server.
+"""
+
+import hashlib
+import http.server
+import io
+import json
+import queue
+import socketserver
+import threading
+import types
+import urllib.parse
+
+from etcd3 import events as etcd_events
+from etcd3 import watch as etcd_watch
+from etcd3.etcdrpc import kv_pb2, rpc_pb2
+
+# Size of the placeholder images served for downloads
+IMAGE_SIZE = (640, 480)
+
+
+class FakeEtcd(object):
+    """An in-memory stand-in for the etcd3 client, with the calls that utils
+    makes: status(), get(), put() and watch_prefix_response(). Watch responses
+    have the same shape as the real client's: a WatchResponse whose events
+    have been wrapped as PutEvents, built from real protobuf messages.
+
+    If `listener` is given, it is called with the name of the call and the key
+    for every request, so that the load can be measured.
+    """
+
+    def __init__(self, listener=None):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.revision = 1
+        # Every event, in revision order, so that watches can start from an
+        # earlier revision
+        self.history = []
+        self.watchers = []
+        self.listener = listener
+
+    def _request(self, name, key=None):
+        if self.listener:
+            self.listener(name, key)
+
+    def status(self):
+        self._request("status")
+        return types.SimpleNamespace(version="fake", leader=None)
+
+    def get(self, key):
+        self._request("get", key)
+        with self.lock:
+            entry = self.data.get(key)
+        if entry is None:
+            return None, None
+        val, mod_revision = entry
+        return val, types.SimpleNamespace(key=key.encode("utf-8"), mod_revision=mod_revision)
+
+    def put(self, key, val):
+        """Stores the value, and sends a PUT event to any matching watches. Dicts
+        and lists are stored as JSON, the way the frame's keys are.
+        """
+        self._request("put", key)
+        if isinstance(val, (dict, list)):
+            val = json.dumps(val)
+        if isinstance(val, str):
+            val = val.encode("utf-8")
+        with self.lock:
+            self.revision += 1
+            self.data[key] = (val, self.revision)
+            event = kv_pb2.Event(
+                type=kv_pb2.Event.PUT,
+                kv=kv_pb2.KeyValue(key=key.encode("utf-8"), value=val, mod_revision=self.revision),
+            )
+            event = etcd_events.new_event(event)
+            self.history.append((self.revision, key, event))
+            response = etcd_watch.WatchResponse(
+                rpc_pb2.ResponseHeader(revision=self.revision), [event]
+            )
+            watchers = [queue_ for prefix, queue_ in self.watchers if key.startswith(prefix)]
+        for queue_ in watchers:
+            queue_.put(response)
+
+    def watch_prefix_response(self, prefix, start_revision=None, progress_notify=False):
+        """Returns an iterator of watch responses and a function that ends it.
+        Changes from `start_revision` on are sent first, in a single batched
+        response; without it, only changes made after the call are sent.
+        """
+        self._request("watch", prefix)
+        responses = queue.Queue()
+        entry = (prefix, responses)
+        with self.lock:
+            if start_revision:
+                missed = [
+                    event
+                    for revision, key, event in self.history
+                    if revision >= start_revision and key.startswith(prefix)
+                ]
+                if missed:
+                    header = rpc_pb2.ResponseHeader(revision=self.revision)
+                    responses.put(etcd_watch.WatchResponse(header, missed))
+            self.watchers.append(entry)
+
+        def cancel():
+            with self.lock:
+                if entry in self.watchers:
+                    self.watchers.remove(entry)
+            responses.put(None)
+
+        def iterate():
+            while True:
+                response = responses.get()
+                if response is None:
+                    return
+                yield response
+
+        return iterate(), cancel
+
+    def close_watches(self):
+        """Ends every open watch stream, as if the server had dropped them."""
+        with self.lock:
+            watchers, self.watchers = self.watchers, []
+        for prefix, responses in watchers:
+            responses.put(None)
+
+
+def make_image_names(count):
+    return [f"img{num:07d}.jpg" for num in range(count)]
+
+
+def make_jpeg(size=IMAGE_SIZE, seed=0):
+    """Returns the bytes of a small JPEG with a gradient, so it compresses like
+    a photo rather than like noise.
+    """
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize(size).point(lambda val: (val + seed) % 256)
+    img = Image.merge(
+        "RGB", [gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), gradient]
+    )
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+class _RegistrationHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        # Closing each connection keeps idle clients from holding server threads.
+        self.send_header("Connection", "close")
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+        with server.lock:
+            server.registrations += 1
+            images = list(server.images)
+            version = server.version
+        if self.headers.get("If-None-Match") == version:
+            with server.lock:
+                server.not_modified += 1
+            self._send(304, headers={"ETag": version})
+            return
+        pkid = form.get("pkid", [server.pkid])[0] or server.pkid
+        body = json.dumps({"pkid": pkid, "version": version, "images": images})
+        self._send(200, body.encode("utf-8"), headers={"ETag": version})
+
+    def do_GET(self):
+        self.server.downloads += 1
+        self._send(200, self.server.image_bytes, content_type="image/jpeg")
+
+
+class RegistrationServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Answers registration requests with the current image list, and serves
+    the same small JPEG for any GET, standing in for the download host.
+
+    Use `reg_url` and `dl_url` in photo.cfg.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, images=(), pkid="bench", port=0):
+        super().__init__(("127.0.0.1", port), _RegistrationHandler)
+        self.lock = threading.Lock()
+        self.pkid = pkid
+        self.registrations = 0
+        self.not_modified = 0
+        self.downloads = 0
+        self.images = []
+        self.version = None
+        self.set_images(images)
+        self.image_bytes = make_jpeg()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def reg_url(self):
+        return f"{self.url}/register"
+
+    @property
+    def dl_url(self):
+        return f"{self.url}/images/"
+
+    def set_images(self, images):
+        with self.lock:
+            self.images = list(images)
+            digest = hashlib.sha1("\n".join(self.images).encode("utf-8")).hexdigest()
+            self.version = f'"{digest[:16]}"'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="registration", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
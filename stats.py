@@ -0,0 +1,210 @@
+import collections
+import mmap
+import os
+import struct
+import threading
+
+import utils
+from utils import debug, info
+
+STATS_FILE = os.path.join(utils.APPDIR, "stats.dat")
+NAMES_FILE = os.path.join(utils.APPDIR, "stats.names")
+# Display count, last shown (epoch seconds), total seconds on screen
+RECORD = struct.Struct("<Idd")
+INITIAL_CAPACITY = 1024
+# Number of random candidates compared for each weighted pick
+CANDIDATES = 8
+# Number of photos remembered for going back in weighted mode
+HISTORY_SIZE = 100
+
+
+class DisplayStats(object):
+    """Per-image display statistics, kept in fixed-size records in a
+    memory-mapped file. Each image gets the next record slot the first time it
+    is seen, and the slots are listed, one name per line, in NAMES_FILE.
+
+    Updates write straight into the mapped records, and loading only has to
+    read the names, so neither depends on the size of the catalog.
+
+    If `stats_file` is None, the records are kept in anonymous memory and
+    nothing is saved.
+    """
+
+    def __init__(self, stats_file=STATS_FILE, names_file=NAMES_FILE):
+        self.stats_file = stats_file
+        self.names_file = names_file
+        self.lock = threading.Lock()
+        self.slots = {}
+        self._map = None
+        if stats_file is None:
+            self._names_ff = self._data_ff = None
+            self._resize(INITIAL_CAPACITY)
+            return
+        if os.path.exists(names_file):
+            with open(names_file) as ff:
+                for line in ff:
+                    self.slots[line.rstrip("\n")] = len(self.slots)
+        self._names_ff = open(names_file, "a")
+        self._data_ff = open(stats_file, "a+b")
+        size = os.fstat(self._data_ff.fileno()).st_size
+        capacity = max(INITIAL_CAPACITY, size // RECORD.size, len(self.slots))
+        self._resize(capacity)
+        info(f"Loaded display stats for {len(self.slots)} images")
+
+    def _resize(self, capacity):
+        if not self._data_ff:
+            new_map = mmap.mmap(-1, capacity * RECORD.size)
+            if self._map:
+                new_map.write(self._map[:])
+                self._map.close()
+            self._map = new_map
+            self.capacity = capacity
+            return
+        if self._map:
+            self._map.close()
+        self._data_ff.truncate(capacity * RECORD.size)
+        self.capacity = capacity
+        self._map = mmap.mmap(self._data_ff.fileno(), capacity * RECORD.size)
+
+    def _slot(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = len(self.slots)
+            if self._names_ff:
+                self._names_ff.write(f"{name}\n")
+                self._names_ff.flush()
+            if slot >= self.capacity:
+                self._resize(self.capacity * 2)
+        return slot
+
+    def get(self, name):
+        """Returns a tuple of (display count, last shown time, total seconds on
+        screen) for the image.
+        """
+        with self.lock:
+            slot = self.slots.get(name)
+            if slot is None:
+                return (0, 0.0, 0.0)
+            return RECORD.unpack_from(self._map, slot * RECORD.size)
+
+    def last_shown(self, name):
+        return self.get(name)[1]
+
+    def record_shown(self, name, when):
+        with self.lock:
+            offset = self._slot(name) * RECORD.size
+            count, last, seconds = RECORD.unpack_from(self._map, offset)
+            RECORD.pack_into(self._map, offset, count + 1, when, seconds)
+
+    def add_seconds(self, name, seconds):
+        with self.lock:
+            offset = self._slot(name) * RECORD.size
+            count, last, total = RECORD.unpack_from(self._map, offset)
+            RECORD.pack_into(self._map, offset, count, last, total + seconds)
+
+    def flush(self):
+        with self.lock:
+            if self._data_ff:
+                self._map.flush()
+
+    def close(self):
+        with self.lock:
+            self._map.close()
+            if self._data_ff:
+                self._data_ff.close()
+                self._names_ff.close()
+
+
+class WeightedSelector(object):
+    """Chooses the next photo with a bias towards the ones that haven't been
+    shown for the longest time. For each pick, a few images are chosen at
+    random from the rotation, and the one shown least recently wins, so the
+    cost doesn't depend on the size of the catalog.
+
+    It has the same current(), step() and upcoming() methods as Rotation. The
+    photos it picks are remembered, so going back and then forward again
+    retraces them.
+    """
+
+    def __init__(self, rotation, stats, candidates=CANDIDATES, state=None):
+        self.rotation = rotation
+        self.stats = stats
+        self.candidates = candidates
+        state = state or {}
+        self.history = collections.deque(state.get("history", []), maxlen=HISTORY_SIZE)
+        # Position in the history; photos after it are upcoming.
+        self.position = state.get("position", len(self.history) - 1)
+
+    def _pick(self, exclude):
+        best = None
+        best_time = None
+        for num in range(self.candidates):
+            fname = self.rotation.random_name()
+            if fname in exclude and len(self.rotation) > len(exclude):
+                continue
+            shown = self.stats.last_shown(fname)
+            if best is None or shown < best_time:
+                best, best_time = fname, shown
+        return best or self.rotation.random_name()
+
+    def _valid(self, fname):
+        return fname in self.rotation
+
+    def current(self):
+        if not self.rotation:
+            return None
+        if 0 <= self.position < len(self.history):
+            fname = self.history[self.position]
+            if self._valid(fname):
+                return fname
+        return self.step()
+
+    def _ahead(self):
+        return list(self.history)[self.position + 1 :]
+
+    def upcoming(self, count):
+        """Returns the next `count` photos, picking them now if necessary so
+        that they will be the ones shown.
+        """
+        count = min(count, len(self.rotation) - 1)
+        ahead = self._ahead()
+        valid = [fname for fname in ahead if self._valid(fname)]
+        if len(valid) != len(ahead):
+            # Some have been removed from the rotation since they were picked.
+            for num in ahead:
+                self.history.pop()
+            for fname in valid:
+                self._append(fname)
+        while len(valid) < count:
+            recent = list(self.history)[max(0, self.position - count) :]
+            fname = self._pick(set(recent))
+            valid.append(fname)
+            self._append(fname)
+        return valid[:count]
+
+    def _append(self, fname):
+        if len(self.history) == self.history.maxlen:
+            self.position -= 1
+        self.history.append(fname)
+
+    def step(self, forward=True):
+        if not self.rotation:
+            return None
+        if not forward:
+            while self.position > 0:
+                self.position -= 1
+                if self._valid(self.history[self.position]):
+                    return self.history[self.position]
+            debug("No earlier photos to go back to")
+            return self.current()
+        while self.position + 1 < len(self.history):
+            self.position += 1
+            if self._valid(self.history[self.position]):
+                return self.history[self.position]
+        fname = self._pick(set(list(self.history)[-2:]))
+        self._append(fname)
+        self.position = len(self.history) - 1
+        return fname
+
+    def state(self):
+        return {"history": list(self.history), "position": self.position}
@@ -0,0 +1,58 @@
+import math
+import random
+import statistics
+
+import photo
+
+SAMPLES = 20000
+
+
+def minute_by_minute(interval, rand):
+    """Minutes until a change when the photo is checked at the end of each
+    minute, the way halflife mode was first written.
+    """
+    prob = photo.HALFLIFE_FACTOR / (interval / 60)
+    minutes = 1
+    while rand() >= prob:
+        minutes += 1
+    return minutes
+
+
+def test_halflife_distribution():
+    interval = 10 * 60
+    prob = photo.HALFLIFE_FACTOR / (interval / 60)
+    # The number of minutes after which half of the photos have changed
+    halflife = math.log(0.5) / math.log(1 - prob)
+    rand = random.Random(1234).random
+    minutes = [photo.halflife_delay(interval, rand) / 60 for num in range(SAMPLES)]
+    assert all(val >= 1 and val == int(val) for val in minutes)
+    # Changes come at the end of a minute, so half have changed by the end of
+    # the minute the half-life falls in, give or take sampling.
+    assert math.ceil(halflife) <= statistics.median(minutes) <= math.ceil(halflife) + 1
+    # The share of photos changed within each number of minutes, from the
+    # median out to the tail, matches the geometric distribution.
+    for limit in (halflife, 2 * halflife, 3 * halflife, 5 * halflife):
+        changed = sum(1 for val in minutes if val <= limit) / SAMPLES
+        expected = 1 - (1 - prob) ** math.floor(limit)
+        assert abs(changed - expected) < 0.015, limit
+    # A photo outlasts three half-lives about an eighth of the time; a little
+    # more, since changes only come at the end of a minute.
+    tail = sum(1 for val in minutes if val > 3 * halflife) / SAMPLES
+    assert abs(tail - (1 - prob) ** math.floor(3 * halflife)) < 0.01
+    assert 0.125 < tail < 0.15
+    assert abs(statistics.mean(minutes) - 1 / prob) < 0.5
+
+
+def test_halflife_matches_checking_each_minute():
+    interval = 20 * 60
+    rand = random.Random(99).random
+    direct = sorted(photo.halflife_delay(interval, rand) / 60 for num in range(SAMPLES))
+    checked = sorted(minute_by_minute(interval, rand) for num in range(SAMPLES))
+    for pct in (10, 50, 90, 99):
+        idx = SAMPLES * pct // 100
+        assert abs(direct[idx] - checked[idx]) <= max(1, checked[idx] * 0.05)
+
+
+def test_short_intervals_change_every_minute():
+    assert photo.halflife_delay(30) == 60
+    assert photo.halflife_delay(60, lambda: 0.0) == 60
@@ -0,0 +1,45 @@
+import pytest
+
+import check_heartbeat
+import proc
+from test_proc import make_process
+
+
+@pytest.fixture
+def frame(tmp_path, monkeypatch):
+    """A /proc tree with photo.py running as pid 100, and its pid file. Returns
+    the lines written to the heartbeat log and the number of restarts.
+    """
+    proc_root = tmp_path / "proc"
+    proc_root.mkdir()
+    make_process(proc_root, 100, "python", ["python", "/home/pi/photo.py"])
+    make_process(proc_root, 200, "bash", ["bash"])
+    pid_file = tmp_path / "photo.pid"
+    pid_file.write_text("100")
+    monkeypatch.setattr(check_heartbeat, "PID_FILE", str(pid_file))
+    monkeypatch.setattr(proc, "PROC_ROOT", str(proc_root))
+    result = {"log": [], "restarts": 0}
+    monkeypatch.setattr(check_heartbeat, "printit", result["log"].append)
+
+    def restart():
+        result["restarts"] += 1
+
+    monkeypatch.setattr(check_heartbeat, "restart", restart)
+    monkeypatch.setattr(check_heartbeat, "get_health", lambda: (None, "Not running"))
+    result["pid_file"] = pid_file
+    return result
+
+
+def test_running_but_not_listening_is_restarted(frame):
+    check_heartbeat.main()
+    assert frame["restarts"] == 1
+    assert frame["log"][0].startswith("RESTARTING!")
+
+
+@pytest.mark.parametrize("pid", ["200", "300", ""])
+def test_stopped_frame_is_left_alone(frame, pid):
+    # The pid is someone else's, gone, or unreadable.
+    frame["pid_file"].write_text(pid)
+    check_heartbeat.main()
+    assert frame["restarts"] == 0
+    assert frame["log"] == ["Not running"]
@@ -0,0 +1,32 @@
+import logging
+import queue
+
+import utils
+
+
+def prepared(msg, args=None):
+    record = logging.LogRecord("photo", logging.INFO, __file__, 1, msg, args, None)
+    return utils.LogQueueHandler(queue.Queue()).prepare(record)
+
+
+def test_mutable_values_are_logged_as_they_were():
+    state = {"position": 1}
+    names = ["a.jpg"]
+    record = prepared(utils.LogMessage(("State:", state, names, 3)))
+    state["position"] = 2
+    names.append("b.jpg")
+    assert record.getMessage() == "State: {'position': 1} ['a.jpg'] 3"
+
+
+def test_plain_values_are_left_for_the_writer():
+    msg = utils.LogMessage(("Showing photo", "a.jpg", 3, 1.5, None))
+    assert prepared(msg).msg is msg
+
+
+def test_standard_args_are_formatted_when_mutable():
+    names = ["a.jpg"]
+    record = prepared("Images: %s", (names,))
+    names.append("b.jpg")
+    assert record.getMessage() == "Images: ['a.jpg']"
+    record = prepared("%d images", (3,))
+    assert (record.msg, record.args) == ("%d images", (3,))
@@ -0,0 +1,127 @@
+import os
+import re
+import sys
+
+import pytest
+
+import proc
+
+# Stands in for cec-client. Like the real one, it says it's ready once it has
+# opened the adapter, and answers 'pow' with the power status. It also
+# understands 'die', to exit without being asked, and reports no power status
+# for address 9, so that a command can time out.
+STUB_CEC_CLIENT = """\
+#!{python}
+import os, sys, time
+if os.environ.get("STUB_CEC_SLOW_START"):
+    time.sleep(60)
+print("opening a connection to the CEC adapter...")
+print(f"pid {{os.getpid()}} waiting for input", flush=True)
+for line in sys.stdin:
+    cmd = line.split()
+    if cmd == ["q"]:
+        sys.exit(0)
+    if cmd == ["die"]:
+        sys.exit(1)
+    if cmd[:1] == ["pow"] and cmd[1:] != ["9"]:
+        print(f"power status: on (pid {{os.getpid()}})", flush=True)
+"""
+PID_PAT = re.compile(r"power status: (\S+) \(pid (\d+)\)")
+
+
+def make_process(proc_root, pid, name, cmdline):
+    pth = proc_root / str(pid)
+    pth.mkdir()
+    (pth / "comm").write_text(f"{name}\n")
+    (pth / "cmdline").write_bytes(b"\0".join(arg.encode("utf-8") for arg in cmdline) + b"\0")
+
+
+def test_find_processes(tmp_path):
+    make_process(tmp_path, 1, "systemd", ["/sbin/init"])
+    make_process(tmp_path, 120, "chromium-browse", ["chromium-browser", "--kiosk"])
+    make_process(tmp_path, 121, "chromium", ["chromium", "--type=renderer"])
+    make_process(tmp_path, 300, "python3", ["python3", "photo.py"])
+    # Not processes
+    (tmp_path / "self").mkdir()
+    (tmp_path / "uptime").write_text("1.0 1.0\n")
+    # A process that exited while /proc was being read
+    (tmp_path / "400").mkdir()
+    assert sorted(proc.find_processes("chromium", str(tmp_path))) == [120, 121]
+    assert proc.find_processes("python", str(tmp_path)) == [300]
+    assert proc.is_running("systemd", str(tmp_path))
+    assert not proc.is_running("firefox", str(tmp_path))
+
+
+def test_iter_processes_reads_command_lines(tmp_path):
+    make_process(tmp_path, 120, "chromium-browse", ["chromium-browser", "--kiosk", "a b"])
+    assert list(proc.iter_processes(str(tmp_path))) == [
+        (120, "chromium-browse", ["chromium-browser", "--kiosk", "a b"])
+    ]
+
+
+@pytest.fixture
+def cec_binary(tmp_path):
+    pth = tmp_path / "cec-client"
+    pth.write_text(STUB_CEC_CLIENT.format(python=sys.executable))
+    pth.chmod(0o755)
+    return str(pth)
+
+
+@pytest.fixture
+def client(cec_binary):
+    clt = proc.CecClient(cec_binary, timeout=2, start_timeout=5)
+    yield clt
+    clt.close()
+
+
+def power_status(client, address=0):
+    mtch = client.send(f"pow {address}", expect=PID_PAT)
+    return mtch.group(1), int(mtch.group(2))
+
+
+def test_cec_commands_share_one_process(client):
+    status, pid = power_status(client)
+    assert status == "on"
+    client.power_on()
+    assert power_status(client) == ("on", pid)
+    assert client.power_status() == "on"
+
+
+def test_cec_client_restarts_after_it_dies(client):
+    status, first_pid = power_status(client)
+    client.send("die")
+    client.proc.wait(5)
+    status, second_pid = power_status(client)
+    assert status == "on"
+    assert second_pid != first_pid
+
+
+def test_cec_client_restarts_after_being_killed(client):
+    status, first_pid = power_status(client)
+    os.kill(first_pid, 9)
+    client.proc.wait(5)
+    assert power_status(client)[1] != first_pid
+
+
+def test_cec_command_timeout(client):
+    power_status(client)
+    client.timeout = 0.3
+    with pytest.raises(proc.CecError, match="Timed out"):
+        power_status(client, 9)
+    # The process is still usable afterwards.
+    assert power_status(client)[0] == "on"
+
+
+def test_cec_start_timeout(cec_binary, monkeypatch):
+    monkeypatch.setenv("STUB_CEC_SLOW_START", "1")
+    clt = proc.CecClient(cec_binary, timeout=0.3, start_timeout=0.3)
+    with pytest.raises(proc.CecError, match="Timed out"):
+        clt.power_on()
+    # The process that never became ready isn't kept.
+    assert clt.proc is None
+
+
+def test_missing_cec_client(tmp_path):
+    clt = proc.CecClient(str(tmp_path / "missing"))
+    with pytest.raises(proc.CecError, match="Could not start"):
+        clt.power_on()
@@ -0,0 +1,139 @@
+import concurrent.futures
+import os
+
+import pytest
+from PIL import Image, ImageChops, ImageEnhance
+
+import image
+import render
+import standins
+from renditions import make_key, RenditionStore
+
+PROFILE = (1.0, 1.2, 1.0)
+OUTPUT = render.output_spec((320, 240))
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    pth = tmp_path / "images"
+    pth.mkdir()
+    return pth
+
+
+def add_image(image_dir, fname, seed=0):
+    (image_dir / fname).write_bytes(standins.make_jpeg(seed=seed))
+
+
+@pytest.fixture
+def store(tmp_path):
+    pth = tmp_path / "renditions"
+    pth.mkdir()
+    return RenditionStore(str(pth))
+
+
+def rendered(store, image_dir, fname):
+    src_hash = store.source_hash(fname, os.path.join(image_dir, fname))
+    return store.has(make_key(src_hash, PROFILE, "H", OUTPUT))
+
+
+def test_downloaded_images_are_rendered(store, image_dir):
+    renderer = render.Renderer(store, workers=1, image_dir=str(image_dir))
+    add_image(image_dir, "early.jpg", seed=1)
+    # Images that arrive before the first full run wait for it.
+    renderer.add("early.jpg")
+    assert renderer.wait(5)
+    assert not rendered(store, image_dir, "early.jpg")
+
+    add_image(image_dir, "first.jpg", seed=2)
+    renderer.start(*PROFILE, "H", OUTPUT)
+    assert renderer.wait(60)
+    assert rendered(store, image_dir, "early.jpg")
+    assert rendered(store, image_dir, "first.jpg")
+
+    add_image(image_dir, "later.jpg", seed=3)
+    renderer.add("later.jpg")
+    assert renderer.wait(60)
+    assert rendered(store, image_dir, "later.jpg")
+    # Rendering one image leaves the others' renditions alone.
+    assert rendered(store, image_dir, "first.jpg")
+
+
+def test_missing_images_are_skipped(store, image_dir):
+    result = render.render_all(
+        *PROFILE, image_dir=str(image_dir), store=store, workers=1, fnames=["gone.jpg"]
+    )
+    assert result == (0, 0, 0)
+
+
+def meminfo(tmp_path, available_kb):
+    pth = tmp_path / "meminfo"
+    pth.write_text("MemTotal:        1000000 kB\nMemAvailable:   %8d kB\n" % available_kb)
+    return str(pth)
+
+
+def test_workers_are_bounded_by_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    # A 1 GB Pi with about 700 MB free runs a single worker.
+    monkeypatch.setattr(render, "MEMINFO", meminfo(tmp_path, 700 * 1024))
+    assert render.default_workers(768) == 1
+    # 4 GB free fits five 768 MB workers, but there are only four CPUs.
+    monkeypatch.setattr(render, "MEMINFO", meminfo(tmp_path, 4096 * 1024))
+    assert render.default_workers(768) == 4
+    assert render.default_workers(1536) == 2
+    # A worker without a limit could use any amount.
+    assert render.default_workers(0) == 1
+
+
+# A photo whose pixels need several times the image budget below, and the
+# budget it has to be processed in
+LARGE_SIZE = (6000, 4000)
+LARGE_BUDGET_MB = 16
+
+
+@pytest.mark.parametrize("output", [None, render.output_spec((1920, 1080))])
+def test_large_images_fit_the_worker_limit(tmp_path, output):
+    src = str(tmp_path / "large.jpg")
+    # Grayscale, so that making it here doesn't need much memory either.
+    Image.linear_gradient("L").resize(LARGE_SIZE).save(src, "JPEG", quality=90)
+    out = str(tmp_path / "out.jpg")
+    max_bytes = render.image_budget(render.WORKER_MB, LARGE_BUDGET_MB)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, initializer=render._init_worker, initargs=(render.WORKER_MB * render.MB,)
+    ) as pool:
+        err, seconds, peak_rss = pool.submit(
+            render._render_one, src, out, PROFILE, "H", output, max_bytes
+        ).result()
+    assert err is None
+    with Image.open(out) as img:
+        # Decoded at a reduced scale, since even the resampled copy at full
+        # resolution wouldn't fit in the budget.
+        assert img.mode == "RGB"
+        assert img.width * img.height * 3 * 2 <= max_bytes
+        assert img.width / img.height == pytest.approx(1.5, rel=0.01)
+
+
+def enhanced(img, bright, contrast, saturation):
+    """The corrections as they were made before _correct, one after another."""
+    img = ImageEnhance.Brightness(img).enhance(bright)
+    img = ImageEnhance.Contrast(img).enhance(contrast)
+    return ImageEnhance.Color(img).enhance(saturation)
+
+
+@pytest.mark.parametrize(
+    "profile", [(1.2, 1.1, 1.3), (0.8, 1.3, 0.7), (1.0, 0.9, 1.0), (1.1, 1.0, 0.0)]
+)
+def test_corrections_match_image_enhance(profile):
+    # Taller than a strip, with every level in each channel.
+    size = (300, image.STRIP_ROWS * 2 + 50)
+    img = Image.merge(
+        "RGB",
+        [
+            Image.linear_gradient("L").resize(size),
+            Image.linear_gradient("L").rotate(90).resize(size),
+            Image.effect_noise(size, 64),
+        ],
+    )
+    expected = enhanced(img, *profile)
+    image._correct(img, *profile)
+    for band in ImageChops.difference(img, expected).getextrema():
+        assert band[1] <= 1, profile
@@ -0,0 +1,56 @@
+import threading
+
+import render
+import standins
+from renditions import RenditionStore
+
+PROFILE = (1.0, 1.0, 1.0)
+
+
+def test_stores_sharing_a_directory_keep_each_others_renditions(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    root = tmp_path / "renditions"
+    root.mkdir()
+    # As if the frame and render.py had each loaded the store.
+    frame = RenditionStore(str(root))
+    manual = RenditionStore(str(root))
+    (image_dir / "a.jpg").write_bytes(standins.make_jpeg(seed=1))
+    assert render.render_all(*PROFILE, image_dir=str(image_dir), store=frame, workers=1)[0] == 1
+    (image_dir / "b.jpg").write_bytes(standins.make_jpeg(seed=2))
+    # This run must not prune the rendition of a.jpg that it didn't know of.
+    rendered, skipped, failed = render.render_all(
+        *PROFILE, image_dir=str(image_dir), store=manual, workers=1
+    )
+    assert (rendered, skipped, failed) == (1, 1, 0)
+    for name in ("a.jpg", "b.jpg"):
+        key = manual.lookup(name, PROFILE, "H")
+        assert key
+        assert (root / key[:2] / manual.filename(key)).exists()
+    # The frame sees both once it next renders.
+    render.render_all(*PROFILE, image_dir=str(image_dir), store=frame, workers=1)
+    assert frame.lookup("b.jpg", PROFILE, "H")
+
+
+def test_locked_keeps_other_stores_out(tmp_path):
+    first = RenditionStore(str(tmp_path))
+    second = RenditionStore(str(tmp_path))
+    events = []
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with first.locked():
+            holding.set()
+            release.wait(5)
+            events.append("first done")
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    assert holding.wait(5)
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    with second.locked():
+        events.append("second in")
+    thread.join()
+    assert events == ["first done", "second in"]
@@ -0,0 +1,75 @@
+import sys
+import threading
+
+import pytest
+
+from shuffle import Rotation
+
+# How long each thread keeps changing or reading the rotation, in seconds
+RACE_SECONDS = 1
+
+
+@pytest.fixture
+def switch_often():
+    """Makes threads switch as often as possible, so that races show up."""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def check_consistent(rotation):
+    assert rotation.positions == {fname: idx for idx, fname in enumerate(rotation.names) if fname}
+    assert sorted(rotation.free) == [idx for idx, fname in enumerate(rotation.names) if not fname]
+
+
+def test_changes_from_other_threads(switch_often):
+    lists = [[f"img{num}.jpg" for num in range(start, start + 500)] for start in (0, 250)]
+    rotation = Rotation(lists[0])
+    stop = threading.Event()
+    errors = []
+
+    def run(func):
+        try:
+            while not stop.is_set():
+                func()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def change():
+        for images in lists:
+            rotation.set_images(images)
+
+    def move():
+        rotation.step()
+        rotation.upcoming(3)
+        rotation.state()
+
+    threads = [threading.Thread(target=run, args=(func,)) for func in (change, change, move)]
+    for thread in threads:
+        thread.start()
+    stop.wait(RACE_SECONDS)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    check_consistent(rotation)
+
+
+def test_large_removal_keeps_the_current_image():
+    images = [f"img{num}.jpg" for num in range(1000)]
+    rotation = Rotation(images)
+    for num in range(10):
+        rotation.step()
+    shown = rotation.current()
+    # Remove most of the images, but not the one on screen.
+    removed = [fname for fname in images if fname != shown][:900]
+    rotation.update([], removed)
+    assert len(rotation.names) == len(rotation) == 100
+    check_consistent(rotation)
+    assert rotation.current() == shown
+    assert shown not in rotation.upcoming(99)
+    # Every remaining image comes up once in the pass.
+    seen = {rotation.step() for num in range(99)}
+    assert seen | {shown} == set(rotation.names)
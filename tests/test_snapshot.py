@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+
+import pytest
+
+import utils
+from scheduler import Scheduler
+from shuffle import Rotation
+from snapshot import Snapshot
+
+
+@pytest.fixture
+def scheduler():
+    sched = Scheduler()
+    sched.start()
+    yield sched
+    sched.stop()
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Records the path of every file written through utils.atomic_write()."""
+    written = []
+    atomic_write = utils.atomic_write
+
+    def record(pth, text):
+        written.append(os.path.basename(pth))
+        atomic_write(pth, text)
+
+    monkeypatch.setattr(utils, "atomic_write", record)
+    return written
+
+
+def make_snapshot(scheduler, tmp_path, delay=60):
+    return Snapshot(
+        scheduler, str(tmp_path / "state.json"), str(tmp_path / "names.json"), delay=delay
+    )
+
+
+def state_for(rotation):
+    return {"rotation": rotation.state(), "list_version": "v1"}
+
+
+def test_names_are_written_only_when_they_change(scheduler, tmp_path, writes):
+    snap = make_snapshot(scheduler, tmp_path)
+    rotation = Rotation([f"img{num}.jpg" for num in range(100)])
+    snap.save(state_for(rotation), rotation.names, rotation.version)
+    snap.flush()
+    assert writes == ["names.json", "state.json"]
+    rotation.step()
+    snap.save(state_for(rotation), rotation.names, rotation.version)
+    snap.flush()
+    assert writes[2:] == ["state.json"]
+    rotation.update(["new.jpg"], [])
+    snap.save(state_for(rotation), rotation.names, rotation.version)
+    snap.flush()
+    assert writes[3:] == ["names.json", "state.json"]
+
+
+def test_saves_are_coalesced(scheduler, tmp_path, writes):
+    snap = make_snapshot(scheduler, tmp_path, delay=0.2)
+    rotation = Rotation(["a.jpg", "b.jpg", "c.jpg"])
+    for num in range(10):
+        rotation.step()
+        snap.save(state_for(rotation), rotation.names, rotation.version)
+    assert writes == []
+    done = threading.Event()
+    scheduler.schedule(0.5, done.set)
+    assert done.wait(5)
+    assert writes == ["names.json", "state.json"]
+    saved = make_snapshot(scheduler, tmp_path).read()
+    assert saved["rotation"]["shuffle"] == rotation.shuffle.state()
+
+
+def test_round_trip(scheduler, tmp_path):
+    snap = make_snapshot(scheduler, tmp_path)
+    rotation = Rotation(["a.jpg", "b.jpg", "c.jpg"])
+    rotation.update([], ["b.jpg"])
+    rotation.step()
+    snap.save(state_for(rotation), rotation.names, rotation.version)
+    snap.flush()
+
+    restored_snap = make_snapshot(scheduler, tmp_path)
+    state = restored_snap.read()
+    restored = Rotation(state=state["rotation"])
+    assert restored.names == rotation.names
+    assert restored.current() == rotation.current()
+    assert state["list_version"] == "v1"
+    # The names on disk are current for the restored rotation.
+    restored_snap.save(state_for(restored), restored.names, restored.version)
+    assert restored_snap.pending_names is None
+
+
+def test_mismatched_files_are_not_used(scheduler, tmp_path):
+    snap = make_snapshot(scheduler, tmp_path)
+    rotation = Rotation(["a.jpg", "b.jpg"])
+    snap.save(state_for(rotation), rotation.names, rotation.version)
+    snap.flush()
+    names_file = tmp_path / "names.json"
+    names = json.loads(names_file.read_text())
+    names["id"] = "other"
+    names_file.write_text(json.dumps(names))
+    assert make_snapshot(scheduler, tmp_path).read() == {}
+
+
+def test_concurrent_saves_leave_a_valid_snapshot(scheduler, tmp_path):
+    snap = make_snapshot(scheduler, tmp_path)
+    rotation = Rotation([f"img{num}.jpg" for num in range(1000)])
+
+    def save_many():
+        for num in range(50):
+            snap.save(state_for(rotation), rotation.names, rotation.version)
+            snap.flush()
+
+    threads = [threading.Thread(target=save_many) for num in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    state = make_snapshot(scheduler, tmp_path).read()
+    assert len(state["rotation"]["names"]) == 1000
+    assert sorted(os.listdir(tmp_path)) == ["names.json", "state.json"]
+
+
+def test_atomic_write_keeps_permissions(tmp_path):
+    pth = str(tmp_path / "photo.cfg")
+    utils.atomic_write(pth, "one")
+    assert os.stat(pth).st_mode & 0o777 == 0o644
+    os.chmod(pth, 0o600)
+    utils.atomic_write(pth, "two")
+    assert os.stat(pth).st_mode & 0o777 == 0o600
+    assert open(pth).read() == "two"
+    assert os.listdir(tmp_path) == ["photo.cfg"]
@@ -0,0 +1,157 @@
+import gc
+import http.client
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import photo
+import utils
+from channel import PhotoChannel
+from standins import FakeEtcd
+from watchdog import Watchdog
+
+ROUNDS = 30
+TIMEOUT = 5
+PREFIX = "/frames/soak/"
+
+
+class StopWatch(Exception):
+    pass
+
+
+def fd_count():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(check, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def frame(monkeypatch):
+    """Runs the webserver under its supervisor, and a watch on a FakeEtcd, for
+    a stand-in frame.
+    """
+    if not os.path.isdir("/proc/self/fd"):
+        pytest.skip("needs /proc")
+    monkeypatch.setattr(photo, "PORT", free_port())
+    etcd = FakeEtcd()
+    monkeypatch.setattr(utils, "etcd_client", etcd)
+    monkeypatch.setattr(utils, "etcd_checked_at", None)
+    monkeypatch.setattr(utils, "backoff_delay", lambda attempt, *args: 0.01)
+    mgr = make_frame()
+    mgr.etcd = etcd
+    mgr.webserver = photo.ServerSupervisor(mgr)
+    mgr.webserver.start()
+    assert mgr.webserver.ready.wait(TIMEOUT)
+
+    stopping = threading.Event()
+
+    def heartbeat():
+        if stopping.is_set():
+            raise StopWatch
+
+    def watch():
+        try:
+            utils.watch(PREFIX, lambda key, data: None, heartbeat=heartbeat)
+        except StopWatch:
+            pass
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    yield mgr
+    stopping.set()
+    etcd.close_watches()
+    watcher.join(TIMEOUT)
+    mgr.webserver.stop()
+
+
+def make_frame():
+    mgr = type("Frame", (object,), {})()
+    mgr.server_mode = "threaded"
+    mgr.max_connections = photo.MAX_CONNECTIONS
+    mgr.channel = PhotoChannel()
+    mgr.watchdog = Watchdog()
+    return mgr
+
+
+def get(conn, path, headers=None):
+    conn.request("GET", path, headers=headers or {})
+    resp = conn.getresponse()
+    body = resp.read()
+    assert resp.status in (200, 304), path
+    return resp, body
+
+
+def browser_session(mgr):
+    """What a browser does between reloads: fetch the page, listen for an
+    event, and make a few requests over a kept-alive connection.
+    """
+    seq = mgr.channel.publish(
+        "http://localhost:9001/img/a.jpg", ["http://localhost:9001/img/b.jpg"]
+    )
+    conn = http.client.HTTPConnection("127.0.0.1", photo.PORT, timeout=TIMEOUT)
+    try:
+        resp, body = get(conn, "/", {"Accept-Encoding": "gzip"})
+        get(conn, "/", {"If-None-Match": resp.getheader("ETag")})
+        get(conn, f"/status?format=json&since={seq - 1}")
+        get(conn, "/health")
+        get(conn, "/metrics")
+    finally:
+        conn.close()
+    # The event stream is dropped when the page reloads.
+    events = http.client.HTTPConnection("127.0.0.1", photo.PORT, timeout=TIMEOUT)
+    try:
+        events.request("GET", "/events", headers={"Last-Event-ID": str(seq - 1)})
+        resp = events.getresponse()
+        while not resp.fp.readline().startswith(b"data:"):
+            pass
+    finally:
+        events.close()
+
+
+def reconnect_watch(etcd):
+    etcd.close_watches()
+    assert wait_until(lambda: etcd.watchers)
+
+
+def restart_webserver(mgr):
+    restarts = mgr.webserver.restarts
+    mgr.webserver.httpd.shutdown()
+    assert wait_until(lambda: mgr.webserver.restarts > restarts and mgr.webserver.ready.is_set())
+
+
+def test_file_descriptors_are_stable(frame):
+    assert wait_until(lambda: frame.etcd.watchers)
+
+    def one_round(num):
+        browser_session(frame)
+        reconnect_watch(frame.etcd)
+        if num % 10 == 0:
+            restart_webserver(frame)
+
+    # Let everything open what it keeps open.
+    one_round(0)
+    one_round(1)
+    gc.collect()
+    baseline = fd_count()
+    for num in range(2, ROUNDS):
+        one_round(num)
+    # The last event stream's handler ends at the next photo change.
+    frame.channel.publish("http://localhost:9001/img/c.jpg")
+    gc.collect()
+    assert wait_until(lambda: fd_count() <= baseline), (fd_count(), baseline)
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+import utils
+from standins import FakeEtcd
+
+PREFIX = "/frames/test/"
+
+
+class StopWatch(Exception):
+    pass
+
+
+@pytest.fixture
+def etcd(monkeypatch):
+    fake = FakeEtcd()
+    monkeypatch.setattr(utils, "etcd_client", fake)
+    monkeypatch.setattr(utils, "etcd_checked_at", None)
+    monkeypatch.setattr(utils, "backoff_delay", lambda attempt: 0.01)
+    return fake
+
+
+def start_watch(received, start_revision=None):
+    """Runs utils.watch() on a thread. Returns a function that ends it."""
+    stopping = threading.Event()
+    changed = threading.Condition()
+
+    def callback(key, data):
+        with changed:
+            received.append((key, data))
+            changed.notify_all()
+
+    def heartbeat():
+        if stopping.is_set():
+            raise StopWatch
+
+    def run():
+        try:
+            utils.watch(PREFIX, callback, start_revision=start_revision, heartbeat=heartbeat)
+        except StopWatch:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def wait_for(count):
+        with changed:
+            assert changed.wait_for(lambda: len(received) >= count, timeout=5)
+
+    def stop(etcd):
+        stopping.set()
+        etcd.close_watches()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    return wait_for, stop
+
+
+def test_events_are_delivered(etcd):
+    received = []
+    wait_for, stop = start_watch(received)
+    # Let the watch open before anything is written.
+    while not etcd.watchers:
+        threading.Event().wait(0.01)
+    etcd.put(f"{PREFIX}settings", {"name": "den"})
+    etcd.put(f"{PREFIX}images", ["a.jpg"])
+    wait_for(2)
+    stop(etcd)
+    assert received == [("settings", {"name": "den"}), ("images", ["a.jpg"])]
+
+
+def test_changes_during_reconnect_are_not_lost(etcd):
+    received = []
+    wait_for, stop = start_watch(received)
+    while not etcd.watchers:
+        threading.Event().wait(0.01)
+    etcd.put(f"{PREFIX}settings", {"name": "one"})
+    wait_for(1)
+    # Drop the stream, and make changes before the watch is reopened.
+    etcd.close_watches()
+    for num in range(2, 5):
+        etcd.put(f"{PREFIX}settings", {"name": f"{num}"})
+    wait_for(4)
+    stop(etcd)
+    assert [data["name"] for key, data in received] == ["one", "2", "3", "4"]
+
+
+def test_watch_resumes_from_start_revision(etcd):
+    etcd.put(f"{PREFIX}settings", {"name": "old"})
+    etcd.put("/frames/other/settings", {"name": "elsewhere"})
+    etcd.put(f"{PREFIX}settings", {"name": "new"})
+    received = []
+    wait_for, stop = start_watch(received, start_revision=etcd.revision)
+    wait_for(1)
+    stop(etcd)
+    assert received == [("settings", {"name": "new"})]
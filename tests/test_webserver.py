@@ -0,0 +1,230 @@
+import http.client
+import json
+import threading
+import time
+import types
+
+import pytest
+
+import assets
+import photo
+import utils
+from channel import PhotoChannel
+from watchdog import Watchdog
+
+# Longest a request may take before the server counts as blocked
+TIMEOUT = 5
+
+
+class Frame(object):
+    """The parts of ImageManager that the webserver uses."""
+
+    def __init__(self):
+        self.channel = PhotoChannel()
+        self.watchdog = Watchdog()
+        self.webserver = types.SimpleNamespace(ready=threading.Event(), restarts=0)
+        self.webserver.ready.set()
+
+
+@pytest.fixture
+def serve():
+    """Returns a function that starts a server of the given class for a Frame,
+    and returns the frame and the server's port.
+    """
+    servers = []
+
+    def start(server_class):
+        server = server_class(("127.0.0.1", 0), photo.PhotoHandler)
+        server.mgr = Frame()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        return server.mgr, server.server_address[1]
+
+    yield start
+    for server, thread in servers:
+        server.stopping.set()
+        server.mgr.channel.wake()
+        server.stop()
+        server.server_close()
+        thread.join(TIMEOUT)
+
+
+def get(port, path, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+    try:
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.read().decode("utf-8")
+    finally:
+        conn.close()
+
+
+def test_single_server_events_do_not_hold_the_thread(serve):
+    frame, port = serve(photo.SinglePhotoServer)
+    frame.channel.publish("http://localhost:9001/img/a.jpg", ["http://localhost:9001/img/b.jpg"])
+    status, body = get(port, "/events")
+    assert status == 200
+    assert "id: 1\n" in body
+    assert "a.jpg" in body and "b.jpg" in body
+    # Nothing newer, so the response ends without an event.
+    status, body = get(port, "/events", {"Last-Event-ID": "1"})
+    assert status == 200
+    assert "data:" not in body
+    status, body = get(port, "/health")
+    assert status == 200
+
+
+# Longest a photo change may take to reach a waiting browser
+DELIVERY_BOUND = 0.5
+# Most lines read from an event stream while waiting for an event
+MAX_LINES = 20
+
+
+def open_events(port, headers=None):
+    """Opens an event stream, and returns the connection and a function that
+    reads the next event's data line.
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+    conn.request("GET", "/events", headers=headers or {})
+    resp = conn.getresponse()
+    assert resp.status == 200
+    # The retry line comes first. A change published after it is sent even if
+    # the handler hasn't started waiting yet.
+    assert resp.fp.readline().startswith(b"retry:")
+
+    def next_event():
+        # Keepalives only come every BROWSER_CYCLE, so a few lines are enough.
+        for num in range(MAX_LINES):
+            line = resp.fp.readline()
+            assert line, "stream ended"
+            if line.startswith(b"data:"):
+                return json.loads(line[len(b"data:") :])
+        pytest.fail(f"No event in {MAX_LINES} lines")
+
+    return conn, next_event
+
+
+def test_events_reach_browsers_promptly(serve):
+    frame, port = serve(photo.PhotoServer)
+    streams = [open_events(port) for num in range(5)]
+    delays = []
+    try:
+        for num in range(20):
+            url = f"http://localhost:9001/img/{num}.jpg"
+            start = time.perf_counter()
+            seq = frame.channel.publish(url, [])
+            for conn, next_event in streams:
+                message = next_event()
+                assert message["seq"] == seq and message["url"] == url
+            delays.append(time.perf_counter() - start)
+    finally:
+        for conn, next_event in streams:
+            conn.close()
+    assert max(delays) < DELIVERY_BOUND, delays
+
+
+def test_status_returns_promptly_after_a_change(serve):
+    frame, port = serve(photo.PhotoServer)
+    frame.channel.publish("http://localhost:9001/img/a.jpg")
+    result = {}
+
+    def poll():
+        result["reply"] = get(port, "/status?format=json&since=1")
+        result["finished"] = time.perf_counter()
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    # Give the request time to start waiting.
+    time.sleep(0.2)
+    published = time.perf_counter()
+    frame.channel.publish("http://localhost:9001/img/b.jpg")
+    poller.join(TIMEOUT)
+    status, body = result["reply"]
+    assert json.loads(body)["url"].endswith("b.jpg")
+    assert result["finished"] - published < DELIVERY_BOUND
+
+
+def test_events_after_a_restart_start_over(serve):
+    frame, port = serve(photo.PhotoServer)
+    frame.channel.publish("http://localhost:9001/img/a.jpg")
+    frame.channel.publish("http://localhost:9001/img/b.jpg")
+    # The browser last saw event 500 from before the frame restarted.
+    conn, next_event = open_events(port, {"Last-Event-ID": "500"})
+    try:
+        message = next_event()
+        assert message["seq"] == 2 and message["url"].endswith("b.jpg")
+        frame.channel.publish("http://localhost:9001/img/c.jpg")
+        message = next_event()
+        assert message["seq"] == 3 and message["url"].endswith("c.jpg")
+    finally:
+        conn.close()
+
+
+# Long-polls kept open while other pages are requested
+POLLS = 8
+# Longest /log or / may take while the polls are open
+PAGE_BOUND = 0.5
+
+
+def test_pages_are_fast_while_polls_are_open(serve, tmp_path, monkeypatch):
+    log_file = tmp_path / "photo.log"
+    log_file.write_text("".join(f"line {num}\n" for num in range(2000)))
+    monkeypatch.setattr(utils, "LOG_FILE", str(log_file))
+    frame, port = serve(photo.PhotoServer)
+    seq = frame.channel.publish("http://localhost:9001/img/a.jpg")
+    replies = []
+    polls = [
+        threading.Thread(target=lambda: replies.append(get(port, f"/status?since={seq}")))
+        for num in range(POLLS)
+    ]
+    for poll in polls:
+        poll.start()
+    # Give the requests time to start waiting.
+    time.sleep(0.2)
+    for path, expected in (("/log", "line 1999"), ("/", "<html>")):
+        start = time.perf_counter()
+        status, body = get(port, path)
+        elapsed = time.perf_counter() - start
+        assert status == 200 and expected in body
+        assert elapsed < PAGE_BOUND, (path, elapsed)
+    # The polls were still waiting the whole time.
+    assert not replies
+    frame.channel.publish("http://localhost:9001/img/b.jpg")
+    for poll in polls:
+        poll.join(TIMEOUT)
+    assert [body for status, body in replies] == ["http://localhost:9001/img/b.jpg"] * POLLS
+
+
+# Minutes of a long-polling browser's requests
+BROWSER_MINUTES = 5
+
+
+def test_browser_session_uses_one_connection(serve, tmp_path, monkeypatch):
+    log_file = tmp_path / "photo.log"
+    log_file.write_text("line\n" * 100)
+    monkeypatch.setattr(utils, "LOG_FILE", str(log_file))
+    frame, port = serve(photo.PhotoServer)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=TIMEOUT)
+
+    def request(path, headers=None):
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status in (200, 304)
+        return resp
+
+    connections = photo.HTTP_CONNECTIONS.value
+    try:
+        etag = request("/").getheader("ETag")
+        file_reads = assets.FILE_READS.value
+        for minute in range(BROWSER_MINUTES):
+            seq = frame.channel.publish(f"http://localhost:9001/img/{minute}.jpg")
+            request(f"/status?format=json&since={seq - 1}")
+            request("/log")
+            assert request("/", {"If-None-Match": etag}).status == 304
+        assert photo.HTTP_CONNECTIONS.value - connections == 1
+        # main.html is served from memory once it has been read.
+        assert assets.FILE_READS.value == file_reads
+    finally:
+        conn.close()
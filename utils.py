@@ -1,52 +1,140 @@
+import atexit
 import configparser
 import functools
 import inspect
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import re
 import six
 from six.moves import StringIO
-import socket
-from subprocess import Popen, PIPE
+import tempfile
 import time
 
 import etcd3
+from etcd3 import events as etcd_events
 from etcd3 import exceptions as etcd_exceptions
 import pudb
 import tenacity
 
+import metrics
+import proc
 
 APPDIR = os.path.expanduser("~/projects/photoviewer")
 CONFIG_FILE = os.path.join(APPDIR, "photo.cfg")
-HEARTBEAT_FLAG_FILE = os.path.join(APPDIR, "HEARTBEAT")
+SNAPSHOT_FILE = os.path.join(APPDIR, "state.json")
+# The rotation's image names, kept apart from the snapshot because they are
+# large and rarely change
+NAMES_FILE = os.path.join(APPDIR, "names.json")
+IMAGE_DIR = os.path.join(APPDIR, "images")
+RENDITION_DIR = os.path.join(APPDIR, "renditions")
 
 LOG = None
+LOG_LISTENER = None
 LOG_LEVEL = logging.INFO
+# Rotate the log when it reaches this size, keeping this many old logs.
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 LOG_DIR = os.path.join(APPDIR, "log")
 # Make sure that all the necessary directories exist.
-for pth in (APPDIR, LOG_DIR):
+for pth in (APPDIR, LOG_DIR, IMAGE_DIR, RENDITION_DIR):
     os.makedirs(pth, exist_ok=True)
 LOG_FILE = os.path.join(LOG_DIR, "photo.log")
+# Size of the blocks read when scanning the log backwards
+LOG_BLOCK_SIZE = 64 * 1024
 
 MINUTE_SECS = 60
 HOUR_SECS = MINUTE_SECS * 60
 DAY_SECS = HOUR_SECS * 24
 RETRY_INTERVAL = 5
+# Upper limit for the delay between watch reconnection attempts
+MAX_RETRY_INTERVAL = 300
+# How long a successful etcd health check is trusted
+HEALTH_CHECK_INTERVAL = 60
 etcd_client = None
+# Monotonic time of the last successful etcd health check
+etcd_checked_at = None
 BASE_KEY = "/{pkid}:"
+ETCD_READ_SECONDS = metrics.histogram(
+    "photoviewer_etcd_read_seconds", "Time taken to read a key from etcd"
+)
+WATCH_CONNECT_SECONDS = metrics.histogram(
+    "photoviewer_watch_connect_seconds", "Time taken to open the etcd watch stream"
+)
+WATCH_DISPATCH_SECONDS = metrics.histogram(
+    "photoviewer_watch_dispatch_seconds", "Time taken to handle an etcd watch event"
+)
+WATCH_EVENTS = metrics.counter("photoviewer_watch_events_total", "etcd watch events received")
+WATCH_RECONNECTS = metrics.counter(
+    "photoviewer_watch_reconnects_total", "Times the etcd watch stream was reopened"
+)
+LOG_WRITTEN = metrics.counter(
+    "photoviewer_log_written_chars_total", "Characters written to the log file"
+)
 
 
 class EtcdConnectionError(Exception):
     pass
 
 
+# Values that can't change between being logged and being written, so they can
+# be formatted later on the writer thread
+PLAIN_TYPES = (str, int, float, type(None))
+
+
+def _plain(vals):
+    return all(isinstance(val, PLAIN_TYPES) for val in vals)
+
+
+class LogMessage(object):
+    """Holds the parts of a log message, and only joins them into a string when
+    the message is actually written.
+    """
+
+    __slots__ = ("msgs",)
+
+    def __init__(self, msgs):
+        self.msgs = msgs
+
+    def __str__(self):
+        return " ".join([f"{msg}" for msg in self.msgs])
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Passes records to the writer thread unformatted. The standard
+    QueueHandler formats each record in the calling thread, which is the work
+    we want to keep off the hot paths.
+
+    Values that could change before the writer thread gets to them, such as
+    lists and dicts, are formatted here instead, so that the log shows them as
+    they were when they were logged.
+    """
+
+    def prepare(self, record):
+        if isinstance(record.msg, LogMessage):
+            msgs = record.msg.msgs
+            if not _plain(msgs):
+                record.msg = LogMessage(
+                    [msg if isinstance(msg, PLAIN_TYPES) else f"{msg}" for msg in msgs]
+                )
+        elif record.args:
+            args = record.args.values() if isinstance(record.args, dict) else record.args
+            if not _plain(args):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
 def logit(level, *msgs):
     if not LOG:
         _setup_logging()
-    text = " ".join([f"{msg}" for msg in msgs])
-    log_method = getattr(LOG, level)
-    log_method(text)
+    levelno = logging.getLevelName(level.upper())
+    if not LOG.isEnabledFor(levelno):
+        return
+    LOG.log(levelno, LogMessage(msgs))
 
 
 info = functools.partial(logit, "info")
@@ -69,17 +157,6 @@ def trace():
     pudb.set_trace()
 
 
-def runproc(cmd, wait=True):
-    if wait:
-        kwargs = dict(stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    else:
-        kwargs = dict(stdin=None, stdout=None, stderr=None)
-    proc = Popen([cmd], shell=True, close_fds=True, **kwargs)
-    if wait:
-        stdout_text, stderr_text = proc.communicate()
-        return stdout_text.decode("utf-8"), stderr_text.decode("utf-8")
-
-
 def human_time(seconds):
     """Given a time value in seconds, returns a more human-readable string."""
     days, seconds = divmod(seconds, DAY_SECS)
@@ -95,6 +172,13 @@ def human_time(seconds):
     return f"{seconds}s"
 
 
+def get_freespace(pth="."):
+    stat = os.statvfs(pth)
+    freespace = stat.f_frsize * stat.f_bavail
+    debug("Free disk space =", freespace)
+    return freespace
+
+
 def parse_config_file():
     parser = configparser.ConfigParser()
     try:
@@ -112,14 +196,31 @@ def safe_get(parser, section, option, default=None):
         return default
 
 
-def set_heartbeat_flag():
-    with open(HEARTBEAT_FLAG_FILE, "w"):
-        pass
-
-
-def clear_heartbeat_flag(val=None):
-    if os.path.exists(HEARTBEAT_FLAG_FILE):
-        os.unlink(HEARTBEAT_FLAG_FILE)
+def atomic_write(pth, text):
+    """Writes the file by way of a temporary file that is synced and then
+    renamed over it, so that a crash or power loss leaves either the old
+    contents or the new, never a partial file. Each write has its own
+    temporary file, so writes from different threads can't mix.
+    """
+    dirname, basename = os.path.split(os.path.abspath(pth))
+    fd, tmp = tempfile.mkstemp(prefix=f".{basename}.", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, "w") as ff:
+            ff.write(text)
+            ff.flush()
+            os.fsync(ff.fileno())
+        try:
+            # mkstemp() makes the file private; keep the permissions it had.
+            os.chmod(tmp, os.stat(pth).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, pth)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
 
 
 def normalize_interval(time_, units):
@@ -128,12 +229,30 @@ def normalize_interval(time_, units):
     return time_ * factor
 
 
-@tenacity.retry(wait=tenacity.wait_exponential())
+def backoff_delay(attempt, base=RETRY_INTERVAL, cap=MAX_RETRY_INTERVAL):
+    """Returns how long to wait before retry number `attempt` (starting at 0).
+    The delay doubles with each attempt up to `cap`, and is randomized so that
+    a fleet of frames doesn't reconnect all at once after an outage.
+    """
+    delay = min(cap, base * 2**attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def mark_etcd_unhealthy():
+    """Forces the next call to get_etcd_client() to check the connection."""
+    global etcd_checked_at
+    etcd_checked_at = None
+
+
+@tenacity.retry(wait=tenacity.wait_random_exponential(max=MAX_RETRY_INTERVAL))
 def get_etcd_client():
-    global etcd_client
+    global etcd_client, etcd_checked_at
     if not etcd_client:
         etcd_client = etcd3.client(host="dodata")
         debug("Created client", etcd_client)
+    now = time.monotonic()
+    if etcd_checked_at is not None and now - etcd_checked_at < HEALTH_CHECK_INTERVAL:
+        return etcd_client
     # Make sure the client connection is still good
     try:
         status = etcd_client.status()
@@ -141,13 +260,19 @@ def get_etcd_client():
     except etcd_exceptions.ConnectionFailedError as e:
         error(f"Couldn't connect to the etcd server: {str(e)}")
         raise EtcdConnectionError
+    etcd_checked_at = now
     return etcd_client
 
 
 def read_key(key):
     """Returns the value of the specified key, or None if it is not present."""
     clt = get_etcd_client()
-    val, meta = clt.get(key)
+    try:
+        with ETCD_READ_SECONDS.time():
+            val, meta = clt.get(key)
+    except etcd_exceptions.ConnectionFailedError:
+        mark_etcd_unhealthy()
+        raise
     if val is not None:
         val = six.ensure_text(val)
         return json.loads(val)
@@ -156,16 +281,47 @@ def read_key(key):
 def write_key(key, val):
     clt = get_etcd_client()
     payload = json.dumps(val)
-    clt.put(key, payload)
+    try:
+        clt.put(key, payload)
+    except etcd_exceptions.ConnectionFailedError:
+        mark_etcd_unhealthy()
+        raise
+
+
+def _dispatch_event(prefix, event, callback):
+    if isinstance(event, etcd_events.DeleteEvent):
+        debug("Ignoring delete event", event)
+        return
+    full_key = str(event.key, "UTF-8")
+    key = full_key.split(prefix)[-1]
+    value = str(event.value, "UTF-8")
+    try:
+        data = json.loads(value)
+    except ValueError:
+        debug("VALUE ERROR!")
+        return
+    try:
+        callback(key, data)
+    except Exception as e:
+        error(f"Error handling event for key '{key}': {e}")
 
 
-def watch(prefix, callback):
+def watch(prefix, callback, start_revision=None, heartbeat=None):
     """Watches the specified prefix for changes, and posts those changes to the
     supplied callback function. The callback must accept two parameters,
     representing the key and value.
+
+    If `heartbeat` is given, it is called with no arguments whenever the watch
+    makes progress, including progress notifications and reconnection attempts.
+
+    A single watch stream is kept open. The revision of the last event seen is
+    tracked, so that when the stream has to be reopened it resumes right after
+    that event, and no changes are lost.
     """
     info("Starting watch for", prefix)
     debug("WATCH", prefix, callback)
+    next_revision = start_revision
+    attempt = 0
 
     while True:
         clt = None
@@ -174,54 +330,133 @@ def watch(prefix, callback):
                 clt = get_etcd_client()
             except EtcdConnectionError:
                 info("FAILED TO GET CLIENT; SLEEPING...")
-                time.sleep(RETRY_INTERVAL)
+                if heartbeat:
+                    heartbeat()
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+        kwargs = {"progress_notify": True}
+        if next_revision:
+            kwargs["start_revision"] = next_revision
+        cancel = None
         try:
-            debug(f"WATCHING PREFIX '{prefix}'")
-            event = clt.watch_prefix_once(prefix, timeout=30)
-            info("Got etcd event")
-            debug("Event", type(event), event)
-            # Make sure it isn't a connection event
-            if not hasattr(event, "key"):
-                error(str(event))
-                continue
-            full_key = str(event.key, "UTF-8")
-            key = full_key.split(prefix)[-1]
-            value = str(event.value, "UTF-8")
-            data = json.loads(value)
-            callback(key, data)
-        except ValueError as e:
-            debug("VALUE ERROR!")
-        except etcd_exceptions.WatchTimedOut as e:
-            debug("TIMED OUT")
-
-
-def check_port(port, host="localhost"):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex((host, port))
-    debug("Checking port", port, "Result=", result)
-    # A result of zero means the port is open
-    return result == 0
+            debug(f"WATCHING PREFIX '{prefix}' from revision {next_revision}")
+            with WATCH_CONNECT_SECONDS.time():
+                responses, cancel = clt.watch_prefix_response(prefix, **kwargs)
+            for response in responses:
+                attempt = 0
+                if heartbeat:
+                    heartbeat()
+                if not response.events:
+                    # Progress notifications have no events, but still tell us
+                    # how far the watch has got. The header of a response with
+                    # events can be ahead of them while a batch is caught up,
+                    # so it isn't used there.
+                    next_revision = max(next_revision or 0, response.header.revision + 1)
+                # The client has already wrapped these as PutEvent/DeleteEvent.
+                for event in response.events:
+                    info("Got etcd event")
+                    debug("Event", type(event), event)
+                    WATCH_EVENTS.inc()
+                    with WATCH_DISPATCH_SECONDS.time():
+                        _dispatch_event(prefix, event, callback)
+                    next_revision = max(next_revision or 0, event.mod_revision + 1)
+            info("Watch stream ended")
+        except etcd_exceptions.RevisionCompactedError as e:
+            error(
+                f"Events from revision {next_revision} were compacted; "
+                f"resuming from {e.compacted_revision}"
+            )
+            next_revision = e.compacted_revision
+            continue
+        except Exception as e:
+            error(f"Watch on '{prefix}' failed: {e}")
+            mark_etcd_unhealthy()
+        finally:
+            if cancel:
+                try:
+                    cancel()
+                except Exception:
+                    pass
+        if heartbeat:
+            heartbeat()
+        WATCH_RECONNECTS.inc()
+        delay = backoff_delay(attempt)
+        info(f"Reconnecting watch in {round(delay, 1)} seconds")
+        time.sleep(delay)
+        attempt += 1
 
 
 def check_browser():
-    out, err = runproc("pgrep chromium")
-    return bool(out)
+    return proc.is_running("chromium")
 
 
 def start_browser(url):
-    cmd = (
-        "chromium-browser --kiosk --ignore-certificate-errors "
-        f"--disable-restore-session-state {url}"
-    )
-    info(f"Starting webbrowser with command: {cmd}")
-    out, err = runproc(cmd)
-    info(f"Result: {out}. Error: {err}")
+    cmd = [
+        "chromium-browser",
+        "--kiosk",
+        "--ignore-certificate-errors",
+        "--disable-restore-session-state",
+        url,
+    ]
+    info(f"Starting webbrowser with command: {' '.join(cmd)}")
+    try:
+        browser = proc.spawn(cmd)
+    except OSError as e:
+        error(f"Could not start the webbrowser: {e}")
+        return
+    info(f"Webbrowser started with pid {browser.pid}")
+
+
+class CountingStream(object):
+    """Wraps the log file to count what is written to it."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        LOG_WRITTEN.inc(len(text))
+        return self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class CountingFileHandler(logging.handlers.RotatingFileHandler):
+    def _open(self):
+        return CountingStream(super()._open())
 
 
 def _setup_logging():
-    global LOG
+    """Log calls only put the record on a queue; a background thread formats
+    them and writes them to a log file that is rotated by size.
+    """
+    global LOG, LOG_LISTENER
+    LOG = logging.getLogger("photo")
+    hnd = CountingFileHandler(
+        LOG_FILE or "temp_logit.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    hnd.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    LOG_LISTENER = logging.handlers.QueueListener(log_queue, hnd)
+    LOG_LISTENER.start()
+    # Make sure that everything queued gets written on exit.
+    atexit.register(LOG_LISTENER.stop)
+    LOG.addHandler(LogQueueHandler(log_queue))
+    LOG.setLevel(LOG_LEVEL)
+
+
+def setup_worker_logging():
+    """Sets up logging in a worker process. The parent's writer thread isn't
+    copied into child processes, so they write to the log file directly. The
+    WatchedFileHandler reopens the file if the parent rotates it.
+    """
+    global LOG, LOG_LISTENER
     LOG = logging.getLogger("photo")
-    hnd = logging.FileHandler(LOG_FILE or "temp_logit.log")
+    for hnd in list(LOG.handlers):
+        LOG.removeHandler(hnd)
+    LOG_LISTENER = None
+    hnd = logging.handlers.WatchedFileHandler(LOG_FILE or "temp_logit.log")
     formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
     hnd.setFormatter(formatter)
     LOG.addHandler(hnd)
@@ -269,12 +504,54 @@ def log_point(msg="", levels=None):
     return s
 
 
-def read_log(numlines, filter=None):
-    ret = []
+def reverse_lines(pth, block_size=LOG_BLOCK_SIZE):
+    """Yields the lines of the file from last to first. The file is read
+    backwards from the end in blocks, so only one block (plus any partial line)
+    is held in memory at a time.
+    """
+    with open(pth, "rb") as ff:
+        pos = ff.seek(0, os.SEEK_END)
+        partial = b""
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            ff.seek(pos)
+            lines = (ff.read(size) + partial).split(b"\n")
+            # The first line may continue in the previous block.
+            partial = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode("utf-8", errors="replace")
+        yield partial.decode("utf-8", errors="replace")
+
+
+def log_files():
+    """Returns the current log file followed by any rotated logs, newest first.
+    Compressed logs are skipped, since they can't be read backwards.
+    """
+    files = [LOG_FILE]
+    num = 1
+    while os.path.exists(f"{LOG_FILE}.{num}"):
+        files.append(f"{LOG_FILE}.{num}")
+        num += 1
+    return [pth for pth in files if os.path.exists(pth)]
+
+
+def iter_log(numlines, filter=None):
+    """Yields up to `numlines` log lines containing `filter`, newest first. If
+    `numlines` is zero or less, all matching lines are returned.
+    """
     filter = filter or ""
-    with open(LOG_FILE, "r") as ff:
-        lines = [line.strip() for line in ff.readlines() if filter in line]
-    lines.sort(reverse=True)
-    if numlines > 0:
-        lines = lines[:numlines]
-    return "\n".join(lines)
+    count = 0
+    for pth in log_files():
+        for line in reverse_lines(pth):
+            line = line.strip()
+            if not line or filter not in line:
+                continue
+            yield line
+            count += 1
+            if count == numlines:
+                return
+
+
+def read_log(numlines, filter=None):
+    return "\n".join(iter_log(numlines, filter))
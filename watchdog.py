@@ -0,0 +1,128 @@
+import threading
+import time
+
+from utils import error, info
+
+# How often the watchdog looks for stalled components
+CHECK_INTERVAL = 15
+
+
+class Component(object):
+    """Something that is expected to beat at least every `timeout` seconds
+    while it's active.
+    """
+
+    __slots__ = ("name", "timeout", "restart", "active", "last_beat", "restarts")
+
+    def __init__(self, name, timeout, restart, active, now):
+        self.name = name
+        self.timeout = timeout
+        self.restart = restart
+        self.active = active
+        self.last_beat = now
+        self.restarts = 0
+
+    def age(self, now):
+        return now - self.last_beat
+
+    def stalled(self, now):
+        return self.active and self.age(now) > self.timeout
+
+
+class Watchdog(object):
+    """Keeps track of when each of the frame's components last made progress.
+    The heartbeats are only kept in memory, and are timed with the monotonic
+    clock, so nothing is written to disk and changes to the wall clock don't
+    matter.
+
+    A thread checks the components every `check_interval` seconds, and calls
+    the restart function of any that have stalled. Components without one are
+    just reported as unhealthy by status(), so that whatever is watching the
+    frame from outside can restart the whole service.
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.clock = clock
+        self.started_at = clock()
+        self.lock = threading.Lock()
+        self.components = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def register(self, name, timeout, restart=None, active=True):
+        with self.lock:
+            self.components[name] = Component(name, timeout, restart, active, self.clock())
+
+    def beat(self, name, timeout=None):
+        """Records progress by the component, and marks it active. If `timeout`
+        is given, the next beat is due within that many seconds.
+        """
+        with self.lock:
+            comp = self.components[name]
+            comp.last_beat = self.clock()
+            comp.active = True
+            if timeout is not None:
+                comp.timeout = timeout
+
+    def suspend(self, name):
+        """The component isn't expected to beat until its next beat."""
+        with self.lock:
+            self.components[name].active = False
+
+    def status(self):
+        """Returns a dict describing the health of each component, and whether
+        they are all healthy.
+        """
+        now = self.clock()
+        with self.lock:
+            components = {
+                comp.name: {
+                    "active": comp.active,
+                    "age": round(comp.age(now), 1),
+                    "timeout": comp.timeout,
+                    "healthy": not comp.stalled(now),
+                    "restarts": comp.restarts,
+                }
+                for comp in self.components.values()
+            }
+        return {
+            "healthy": all(comp["healthy"] for comp in components.values()),
+            "uptime": round(now - self.started_at, 1),
+            "components": components,
+        }
+
+    def check(self):
+        """Restarts any stalled components that can be restarted."""
+        now = self.clock()
+        with self.lock:
+            stalled = [comp for comp in self.components.values() if comp.stalled(now)]
+            for comp in stalled:
+                if comp.restart:
+                    comp.restarts += 1
+                    # Give it a full timeout to recover before trying again.
+                    comp.last_beat = now
+        for comp in stalled:
+            if not comp.restart:
+                error(f"Watchdog: '{comp.name}' has stalled; it can't be restarted")
+                continue
+            error(f"Watchdog: '{comp.name}' has stalled; restarting it")
+            try:
+                comp.restart()
+            except Exception as e:
+                error(f"Watchdog: could not restart '{comp.name}': {e}")
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self.thread.start()
+        info("Watchdog started")
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopping.wait(self.check_interval):
+            self.check()